@@ -0,0 +1,150 @@
+# app/asgi.py
+"""
+生產環境用的 ASGI 入口。
+
+/api/chat 改以 astream 非同步串流，不會在整個 LLM 呼叫期間佔用一條執行緒；
+其餘路由 (首頁、上傳、LINE Webhook) 仍由原本的 Flask app 透過 WSGI 轉接處理。
+
+啟動方式：
+    python run.py --prod
+    或 uvicorn app.asgi:asgi_app --host 0.0.0.0 --port 5000
+    或 gunicorn -c gunicorn.conf.py (pre-fork，多個工作行程共用預先載入的模型與索引)
+"""
+import asyncio
+import uuid
+
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:  # 未安裝 a2wsgi 時退回 Starlette 內建 (已標示淘汰) 的轉接器
+    from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from app import main as flask_main
+from src.config import CHAT_MAX_CONCURRENCY, CHAT_MAX_QUEUE, CHAT_QUEUE_TIMEOUT
+from src.metrics import registry, new_trace_id, stage_timer, REQUESTS, IN_FLIGHT, STAGE_ERRORS
+
+
+class ConcurrencyLimiter:
+    """
+    限制同時執行的串流數量，並提供有上限的等待佇列。
+
+    佇列已滿或等待逾時的請求會被拒絕，由呼叫端回應 429 (背壓)。
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.waiting = 0
+        self.in_flight = 0
+
+    async def acquire(self) -> bool:
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            return False
+        self.waiting += 1
+        waiter = asyncio.ensure_future(self._semaphore.acquire())
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except BaseException as e:
+            # 逾時 (或請求被取消) 的同時可能剛好取得名額，此時取消不會生效，須歸還名額
+            waiter.cancel()
+            waiter.add_done_callback(self._release_if_acquired)
+            if isinstance(e, asyncio.TimeoutError):
+                return False
+            raise
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        return True
+
+    def _release_if_acquired(self, waiter: asyncio.Future):
+        if not waiter.cancelled() and waiter.exception() is None:
+            self._semaphore.release()
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+
+chat_limiter = ConcurrencyLimiter(CHAT_MAX_CONCURRENCY, CHAT_MAX_QUEUE, CHAT_QUEUE_TIMEOUT)
+
+registry.gauge("rag_chat_waiting", "ASGI chat requests waiting for a concurrency slot.",
+               callback=lambda: chat_limiter.waiting)
+
+
+async def chat(request: Request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return JSONResponse({"error": "Request body must be valid JSON"}, status_code=400)
+    if not isinstance(data, dict):
+        return JSONResponse({"error": "Request body must be a JSON object"}, status_code=400)
+    message = data.get('message')
+    session_id = data.get('session_id', str(uuid.uuid4()))
+    if not message:
+        return JSONResponse({"error": "Message is required"}, status_code=400)
+    if not flask_main.warmup.ready:
+        return JSONResponse(
+            {"error": "Service is warming up, please retry later.", "warmup": flask_main.warmup.to_dict()},
+            status_code=503,
+            headers={"Retry-After": "5"},
+        )
+
+    trace_id = new_trace_id(request.headers.get('X-Request-ID'))
+    REQUESTS.inc(1, "asgi")
+    if not await chat_limiter.acquire():
+        STAGE_ERRORS.inc(1, "chat_rejected")
+        return JSONResponse(
+            {"error": "Server is busy, please retry later."},
+            status_code=429,
+            headers={"Retry-After": "1"},
+        )
+
+    # 在請求開始時取得當下世代的 RAG 鏈，上傳文件後的世代切換不會影響進行中的串流
+    chain = flask_main.rag_engine.current().chain
+    IN_FLIGHT.inc(1, "asgi")
+    released = False
+
+    def release_once():
+        nonlocal released
+        if not released:
+            released = True
+            chat_limiter.release()
+            IN_FLIGHT.dec(1, "asgi")
+
+    async def generate():
+        # 用戶端斷線時 Starlette 會取消此產生器，astream 及其上游 LLM 呼叫隨之被取消
+        new_trace_id(trace_id)
+        try:
+            with stage_timer("chat_request", session_id=session_id):
+                async for chunk in chain.astream(
+                    {"input": message}, config={"configurable": {"session_id": session_id}}
+                ):
+                    if "answer" in chunk:
+                        yield chunk['answer']
+        finally:
+            release_once()
+
+    # background 作為保險：若產生器從未開始執行，回應結束後仍會釋放名額
+    return StreamingResponse(generate(), media_type='text/plain', headers={"X-Trace-ID": trace_id},
+                             background=BackgroundTask(release_once))
+
+
+async def chat_stats(request: Request):
+    return JSONResponse({
+        "in_flight": chat_limiter.in_flight,
+        "waiting": chat_limiter.waiting,
+        "max_concurrency": CHAT_MAX_CONCURRENCY,
+        "max_queue": CHAT_MAX_QUEUE,
+    })
+
+
+asgi_app = Starlette(routes=[
+    Route('/api/chat', chat, methods=['POST']),
+    Route('/api/chat/stats', chat_stats, methods=['GET']),
+    Mount('/', app=WSGIMiddleware(flask_main.app)),
+])
@@ -1,15 +1,52 @@
 import os
+import queue
 import threading
-from flask import current_app
+import time
+from collections import OrderedDict, deque
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import Configuration, ApiClient, MessagingApi, PushMessageRequest, TextMessage
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
 
+from src.config import LINE_WORKER_THREADS, LINE_QUEUE_MAX_DEPTH, LINE_QUEUE_OVERFLOW_POLICY
+from src.metrics import new_trace_id, observe_stage, stage_timer, REQUESTS, IN_FLIGHT
+
+BUSY_MESSAGE = "目前詢問人數較多，請稍後再試一次。"
+ERROR_MESSAGE = "抱歉，處理您的請求時發生了內部錯誤。"
+
+
+class _PendingJob:
+    """同一使用者尚未處理的訊息；處理前陸續到達的訊息會被合併成一次 RAG 呼叫。"""
+
+    def __init__(self, message: str):
+        self.messages = [message]
+        self.enqueued_at = time.monotonic()
+
+
 class LineBotManager:
-    def __init__(self, app=None):
+    def __init__(self, app=None, max_workers: int = LINE_WORKER_THREADS,
+                 max_queue_depth: int = LINE_QUEUE_MAX_DEPTH,
+                 overflow_policy: str = LINE_QUEUE_OVERFLOW_POLICY):
         self.app = app
         self.rag_chain = None
+        self.max_workers = max_workers
+        self.max_queue_depth = max_queue_depth
+        self.overflow_policy = overflow_policy
+
+        # 依使用者排隊的待處理工作；同一使用者同時只會有一個工作在執行
+        self._pending = OrderedDict()
+        self._running_users = set()
+        self._condition = threading.Condition()
+        self._workers = []
+        # 被拒絕的使用者由單一通知執行緒推送忙碌訊息；佇列有上限，同一使用者只排一則
+        self._busy_queue = queue.Queue(maxsize=max(1, max_queue_depth))
+        self._busy_users = set()
+
+        self.processed_count = 0
+        self.coalesced_count = 0
+        self.dropped_count = 0
+        self._latencies = deque(maxlen=1000)
+
         if app is not None:
             self.init_app(app)
 
@@ -20,14 +57,19 @@ class LineBotManager:
 
         channel_secret = os.getenv('LINE_CHANNEL_SECRET')
         channel_access_token = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
-        
+
         if not channel_secret or not channel_access_token:
             print("警告：LINE Channel Secret 或 Access Token 未設定。LINE Bot 功能將無法使用。")
             self.handler = None
             self.configuration = None
+            self.messaging_api = None
             return
 
         self.configuration = Configuration(access_token=channel_access_token)
+        # 連線池大小與工作執行緒數一致，所有推送共用同一個 ApiClient
+        self.configuration.connection_pool_maxsize = self.max_workers
+        self.api_client = ApiClient(self.configuration)
+        self.messaging_api = MessagingApi(self.api_client)
         self.handler = WebhookHandler(channel_secret)
 
         self.handler.add(
@@ -35,6 +77,34 @@ class LineBotManager:
             message=TextMessageContent
         )(lambda event, destination: self.handle_message(event))
 
+        self._start_workers()
+
+    def _start_workers(self):
+        for i in range(self.max_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"line-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        if self.overflow_policy == "reject":
+            notifier = threading.Thread(target=self._busy_notifier_loop, name="line-busy-notifier", daemon=True)
+            notifier.start()
+            self._workers.append(notifier)
+
+    def reset_after_fork(self):
+        """
+        pre-fork 部署時於工作行程中呼叫：fork 不會複製主行程的執行緒，
+        需重新建立鎖與工作執行緒 (也重建連線池，避免與主行程共用 socket)。
+        """
+        self._condition = threading.Condition()
+        self._pending.clear()
+        self._running_users.clear()
+        self._busy_queue = queue.Queue(maxsize=max(1, self.max_queue_depth))
+        self._busy_users = set()
+        self._workers = []
+        if self.handler is not None:
+            self.api_client = ApiClient(self.configuration)
+            self.messaging_api = MessagingApi(self.api_client)
+            self._start_workers()
+
     def set_rag_chain(self, chain):
         self.rag_chain = chain
         print("✅ RAG chain has been set in the LineBotManager instance.")
@@ -43,7 +113,7 @@ class LineBotManager:
         if not self.handler:
             print("錯誤：LineBotManager 未成功初始化。")
             return 'Configuration error', 500
-            
+
         signature = request.headers['X-Line-Signature']
         body = request.get_data(as_text=True)
 
@@ -61,21 +131,99 @@ class LineBotManager:
             print("錯誤：RAG 鏈尚未在 LineBotManager 實例中初始化。")
             return
 
-        thread = threading.Thread(target=self._process_in_background, args=(event, current_app._get_current_object()))
-        thread.start()
+        user_id = event.source.user_id
+        user_message = event.message.text
+
+        with self._condition:
+            job = self._pending.get(user_id)
+            if job is not None:
+                # 此使用者已有等待中的工作：合併訊息，不額外佔用佇列位置
+                job.messages.append(user_message)
+                self.coalesced_count += 1
+                return
 
-    def _process_in_background(self, event, app):
-        """在背景執行緒中處理所有耗時的 RAG 處理和訊息推送。"""
-        # 使用傳入的 app 物件來建立應用程式上下文
-        with app.app_context():
-            user_id = event.source.user_id
-            user_message = event.message.text
-            
-            print(f"背景執行緒：為 {user_id} 處理訊息: {user_message}")
+            if len(self._pending) >= self.max_queue_depth and not self._handle_overflow(user_id):
+                return
+
+            self._pending[user_id] = _PendingJob(user_message)
+            self._condition.notify()
+
+    def _handle_overflow(self, user_id) -> bool:
+        """佇列已滿時依策略處理；回傳 True 表示仍可將新訊息排入佇列。"""
+        self.dropped_count += 1
+        if self.overflow_policy == "drop_oldest":
+            for old_user_id in self._pending:
+                if old_user_id not in self._running_users:
+                    del self._pending[old_user_id]
+                    print(f"LINE 佇列已滿，捨棄 {old_user_id} 最舊的請求。")
+                    return True
+            return False
+
+        print(f"LINE 佇列已滿 ({len(self._pending)})，拒絕 {user_id} 的請求。")
+        if self.overflow_policy == "reject" and user_id not in self._busy_users:
+            try:
+                self._busy_queue.put_nowait(user_id)
+                self._busy_users.add(user_id)
+            except queue.Full:
+                # 通知佇列也滿了：不再為此訊息額外推送，避免湧入時無限制地累積工作
+                pass
+        return False
+
+    def _busy_notifier_loop(self):
+        while True:
+            user_id = self._busy_queue.get()
+            with self._condition:
+                self._busy_users.discard(user_id)
+            try:
+                self._push(user_id, BUSY_MESSAGE)
+            except Exception as e:
+                print(f"推送忙碌訊息給 {user_id} 失敗: {e}")
+
+    def _next_job(self):
+        """取出最早排隊、且該使用者目前沒有執行中工作的請求。"""
+        with self._condition:
+            while True:
+                for user_id in self._pending:
+                    if user_id not in self._running_users:
+                        self._running_users.add(user_id)
+                        return user_id, self._pending.pop(user_id)
+                self._condition.wait()
+
+    def _worker_loop(self):
+        while True:
+            user_id, job = self._next_job()
+            # 每個工作各自一個 trace ID，並記錄在佇列中等待的時間
+            new_trace_id()
+            REQUESTS.inc(1, "line")
+            observe_stage("line_queue_wait", time.monotonic() - job.enqueued_at, coalesced=len(job.messages))
+            IN_FLIGHT.inc(1, "line")
+            try:
+                with stage_timer("line_job"):
+                    self._process_job(user_id, job)
+            except Exception as e:
+                print(f"LINE 背景處理發生未預期錯誤: {e}")
+            finally:
+                IN_FLIGHT.dec(1, "line")
+                with self._condition:
+                    self._running_users.discard(user_id)
+                    self._latencies.append(time.monotonic() - job.enqueued_at)
+                    self.processed_count += 1
+                    # 此使用者可能在執行期間又有新訊息排隊，喚醒其他工作執行緒
+                    self._condition.notify_all()
+
+    def _process_job(self, user_id, job):
+        """在背景工作執行緒中處理所有耗時的 RAG 處理和訊息推送。"""
+        # 使用綁定的 app 物件來建立應用程式上下文
+        with self.app.app_context():
+            # 取得當下的 RAG 鏈；處理途中即使切換世代，此次回覆仍在同一條鏈上完成
+            rag_chain = self.rag_chain
+            user_message = "\n".join(job.messages)
+
+            print(f"背景執行緒：為 {user_id} 處理訊息 (合併 {len(job.messages)} 則): {user_message}")
 
             response_content = ""
             try:
-                for chunk in self.rag_chain.stream(
+                for chunk in rag_chain.stream(
                     {"input": user_message},
                     config={"configurable": {"session_id": user_id}}
                 ):
@@ -83,15 +231,37 @@ class LineBotManager:
                         response_content += chunk['answer']
             except Exception as e:
                 print(f"RAG 鏈處理時發生錯誤: {e}")
-                response_content = "抱歉，處理您的請求時發生了內部錯誤。"
+                response_content = ERROR_MESSAGE
 
             print(f"背景執行緒：準備推送訊息給 {user_id}: {response_content}")
+            self._push(user_id, response_content)
+
+    def _push(self, user_id, text):
+        self.messaging_api.push_message(
+            PushMessageRequest(
+                to=user_id,
+                messages=[TextMessage(text=text)]
+            )
+        )
 
-            with ApiClient(self.configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=response_content)]
-                    )
-                )
\ No newline at end of file
+    def get_stats(self) -> dict:
+        """回傳佇列深度與處理延遲 (從收到訊息到推送完成) 等統計。"""
+        with self._condition:
+            latencies = sorted(self._latencies)
+            stats = {
+                "queue_depth": len(self._pending),
+                "running": len(self._running_users),
+                "workers": self.max_workers,
+                "max_queue_depth": self.max_queue_depth,
+                "overflow_policy": self.overflow_policy,
+                "processed": self.processed_count,
+                "coalesced": self.coalesced_count,
+                "dropped": self.dropped_count,
+            }
+        if latencies:
+            stats["latency_seconds"] = {
+                "avg": sum(latencies) / len(latencies),
+                "p50": latencies[len(latencies) // 2],
+                "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            }
+        return stats
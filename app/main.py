@@ -1,3 +1,4 @@
+import gc
 import os
 import uuid
 from pathlib import Path
@@ -13,10 +14,25 @@ sys.path.append(str(Path(__file__).parent.parent))
 
 # 導入 RAG 核心模組
 from src.llm.gemini import get_gemini_model
-from src.data_processing.document_loader import load_documents
-from src.data_processing.text_splitter import split_documents
-from src.vector_store.chroma_manager import ChromaManager
-from src.rag.chain import create_conversational_rag_chain
+from src.data_processing.indexer import sync_directory
+from src.vector_store.chroma_manager import ChromaManager, load_embedding_model, BM25_INDEX_FILENAME
+from src.vector_store.bm25_index import BM25Index
+from src.vector_store.artifact import resolve_artifact
+from src.rag.chain import create_conversational_rag_chain, create_batch_rag_chain
+from src.rag.batch import parse_batch_items, run_batch, iter_jsonl
+from src.rag.cache import RAGCache
+from src.rag.ReRank import create_reranker
+from src.rag.engine import RAGEngine
+from src.data_processing.jobs import IngestionJobManager
+from src.metrics import registry, new_trace_id, stage_timer, REQUESTS, IN_FLIGHT
+from src.config import (
+    INDEX_ARTIFACT_DIR,
+    RAG_BACKGROUND_WARMUP,
+    RAG_PREFORK_PRELOAD,
+    BATCH_MAX_ITEMS,
+    BATCH_MAX_CONCURRENCY,
+)
+from app.warmup import WarmupState
 
 # --- 【修改處】---
 # 導入我們新建的 LineBotManager 類別
@@ -30,29 +46,166 @@ app = Flask(__name__)
 line_bot_manager = LineBotManager(app)
 
 # --- 2. 初始化 RAG 引擎 ---
-print("正在初始化 RAG 引擎...")
-llm = get_gemini_model()
+# 模型、索引與 RAG 鏈在暖機時建立 (預設於背景執行)，匯入此模組後即可開始接受連線；
+# 暖機完成前 /readyz 回應 503，/api/chat 等端點回應 503 並附上 Retry-After。
 DOCUMENTS_DIR = str(Path(__file__).parent.parent / "data" / "documents")
 CHROMA_DB_DIR = str(Path(__file__).parent.parent / "data" / "db")
 CHROMA_COLLECTION_NAME = "rag_collection"
-chroma_manager = ChromaManager(CHROMA_DB_DIR, CHROMA_COLLECTION_NAME)
-
-raw_docs = load_documents(DOCUMENTS_DIR)
-retriever = None
-if raw_docs:
-    split_docs = split_documents(raw_docs)
-    chroma_manager.add_documents(split_docs)
-    retriever = chroma_manager.create_hybrid_retriever(split_docs)
-else:
-    retriever = chroma_manager.get_vector_retriever()
 
-# 建立 RAG 鏈實例
-conversational_rag_chain = create_conversational_rag_chain(llm, retriever)
+llm = None
+chroma_manager = None
+rag_cache = None
+reranker = None
+# 以唯讀方式載入的索引成品中繼資料 (設定 INDEX_ARTIFACT_DIR 時)
+index_artifact = None
+# pre-fork 時主行程預先載入、fork 後由工作行程以 copy-on-write 共用的物件
+_preloaded = {}
+
+warmup = WarmupState()
+
+# RAG 引擎持有目前的檢索器與 RAG 鏈，上傳後的新世代會原子性地替換進來
+rag_engine = RAGEngine()
+
+# --- 3. 【修改處】每次切換世代時，都將新的 RAG 鏈注入到 LineBotManager 實例中 ---
+rag_engine.add_listener(lambda generation: line_bot_manager.set_rag_chain(generation.chain))
+
+def build_generation():
+    """以目前的索引建立新的檢索器與 RAG 鏈，並切換為使用中的世代。"""
+    version = rag_engine.reserve_version()
+    retriever = chroma_manager.create_hybrid_retriever()
+    # 快取綁定新世代的版本號：切換前不會被讀寫，切換後舊世代的結果不會再寫入
+    cache = rag_cache.for_generation(version)
+    chain = create_conversational_rag_chain(llm, retriever, cache=cache, reranker=reranker)
+    batch_chain = create_batch_rag_chain(llm, retriever, cache=cache, reranker=reranker)
+    return rag_engine.swap(retriever, chain, batch_chain, version=version)
+
+def _resolve_index_artifact():
+    resolved = resolve_artifact(INDEX_ARTIFACT_DIR)
+    if resolved is None:
+        raise RuntimeError(f"{INDEX_ARTIFACT_DIR} 中沒有可用的索引成品，請先執行 "
+                           f"python -m src.data_processing.build_index --output {INDEX_ARTIFACT_DIR}")
+    return resolved
+
+def preload():
+    """
+    pre-fork 部署時於主行程呼叫：載入嵌入模型與 BM25 索引後再 fork，
+    所有工作行程共用同一份記憶體 (copy-on-write)，不需各自載入數 GB 的模型。
+
+    主行程不執行任何推論，也不開啟向量資料庫連線 (SQLite 連線與執行緒不能跨 fork 共用)；
+    這些在各工作行程的 post_fork_init() 中進行。
+    """
+    print("正在預先載入嵌入模型與索引 (pre-fork)...")
+    _preloaded["embeddings"] = load_embedding_model()
+    if INDEX_ARTIFACT_DIR:
+        artifact_path, metadata = _resolve_index_artifact()
+        _preloaded["artifact"] = (artifact_path, metadata)
+        _preloaded["bm25_index"] = BM25Index.load(os.path.join(artifact_path, BM25_INDEX_FILENAME))
+    # 將目前所有物件移出 GC 追蹤，避免工作行程的垃圾回收寫入物件標頭而觸發分頁複製
+    gc.collect()
+    gc.freeze()
+    print("✅ 預先載入完成，等待 fork 工作行程。")
+
+def initialize_rag(state: WarmupState):
+    """載入模型與索引、建立 RAG 鏈並預熱；完成後 /readyz 才會回報就緒。"""
+    global llm, chroma_manager, rag_cache, reranker, index_artifact
+
+    state.set_phase("loading_models")
+    llm = get_gemini_model()
+    embeddings = _preloaded.get("embeddings") or load_embedding_model()
+
+    state.set_phase("loading_index")
+    if INDEX_ARTIFACT_DIR:
+        # 讀取建置好的成品：不掃描文件、不切割、不嵌入
+        artifact_path, metadata = _preloaded.get("artifact") or _resolve_index_artifact()
+        print(f"正在載入索引成品 {metadata['version']} ({metadata['chunks']} 個片段)...")
+        manager = ChromaManager(artifact_path, metadata["collection_name"],
+                                embedding_function=embeddings, read_only=True,
+                                bm25_index=_preloaded.get("bm25_index"),
+                                backend=metadata.get("vector_backend", "chroma"))
+        index_artifact = metadata
+    else:
+        manager = ChromaManager(CHROMA_DB_DIR, CHROMA_COLLECTION_NAME, embedding_function=embeddings)
+        # 增量同步：只嵌入新增或變更的檔案，並移除已刪除檔案的向量
+        sync_directory(DOCUMENTS_DIR, manager)
+    chroma_manager = manager
+
+    state.set_phase("building_chain")
+    # 檢索/答案快取跨 RAG 鏈重建共用，切換到新世代時自動失效
+    rag_cache = RAGCache(
+        embeddings=manager.embedding_function,
+        fetch_documents=manager.get_documents_by_ids,
+        current_generation=rag_engine.current_version,
+    )
+    # 檢索後的重新評分器 (分數快取同樣跨世代共用)
+    reranker = create_reranker(manager.embedding_function)
+    build_generation()
+
+    state.set_phase("warming")
+    # 第一次推論會初始化模型的執行環境 (較慢)，在就緒前先跑一次，避免由第一個請求承擔
+    manager.embedding_function.embed_queries(["熱島效應"])
+
+def start_warmup(background: bool = RAG_BACKGROUND_WARMUP):
+    warmup.run(initialize_rag, background=background)
+
+def post_fork_init():
+    """pre-fork 部署時於每個工作行程 fork 後呼叫：重建執行緒並開始背景暖機。"""
+    line_bot_manager.reset_after_fork()
+    start_warmup()
 
-# --- 3. 【修改處】將 RAG 鏈注入到 LineBotManager 實例中 ---
-line_bot_manager.set_rag_chain(conversational_rag_chain)
+def run_ingestion_job(job):
+    """背景索引工作：在旁更新索引、建立新世代並切換，最後清除舊世代才需要的片段。"""
+    chroma_manager.begin_update()
+    try:
+        stats = sync_directory(DOCUMENTS_DIR, chroma_manager, progress_callback=job.update_progress)
+        generation = build_generation()
+    finally:
+        chroma_manager.finish_update()
+    return {"stats": stats, "generation": generation.version}
 
-print("✅ RAG 引擎初始化完成，並已注入 LINE Manager 實例！")
+ingestion_jobs = IngestionJobManager(run_ingestion_job)
+
+# --- 觀測指標：抓取 /metrics 時才讀取的即時量測值 ---
+def _cache_metrics():
+    if not warmup.ready:
+        return {}
+    stats = rag_cache.stats()
+    embedding_stats = chroma_manager.embedding_function.stats()
+    return {
+        ("retrieval", "hits"): stats["retrieval"]["hits"],
+        ("retrieval", "misses"): stats["retrieval"]["misses"],
+        ("answer", "hits"): stats["answer"]["hits"],
+        ("answer", "misses"): stats["answer"]["misses"],
+        ("embedding", "hits"): embedding_stats["hits"],
+        ("embedding", "misses"): embedding_stats["misses"],
+        ("query_embedding", "hits"): embedding_stats["queries"]["hits"],
+        ("query_embedding", "misses"): embedding_stats["queries"]["misses"],
+    }
+
+def _queue_metrics():
+    line_stats = line_bot_manager.get_stats()
+    return {
+        ("line_pending",): line_stats["queue_depth"],
+        ("line_running",): line_stats["running"],
+        ("ingestion_pending",): ingestion_jobs.pending_count(),
+    }
+
+registry.gauge("rag_cache_lookups", "Cache hits / misses per tier.", ("tier", "result"), callback=_cache_metrics)
+registry.gauge("rag_queue_depth", "Queued and running background work.", ("queue",), callback=_queue_metrics)
+registry.gauge("rag_index_version", "Current index version.",
+               callback=lambda: chroma_manager.index_version if chroma_manager is not None else 0)
+registry.gauge("rag_generation", "Active RAG generation.",
+               callback=lambda: rag_engine.current().version if rag_engine.current() is not None else 0)
+registry.gauge("rag_ready", "1 once models and indexes are loaded.", callback=lambda: int(warmup.ready))
+
+if RAG_PREFORK_PRELOAD:
+    # 由 gunicorn.conf.py 設定：主行程只預先載入，暖機在每個工作行程 fork 後開始
+    preload()
+else:
+    start_warmup()
+
+def not_ready_response():
+    body = {"error": "Service is warming up, please retry later.", "warmup": warmup.to_dict()}
+    return jsonify(body), 503, {"Retry-After": "5"}
 
 # --- 4. API 路由定義 ---
 
@@ -62,48 +215,120 @@ def index():
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
-    data = request.json
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict): return jsonify({"error": "Request body must be a JSON object"}), 400
     message = data.get('message')
     session_id = data.get('session_id', str(uuid.uuid4()))
     if not message: return jsonify({"error": "Message is required"}), 400
+    if not warmup.ready: return not_ready_response()
+    # 在請求開始時取得當下的 RAG 鏈，即使途中切換世代，此請求仍在舊鏈上完成
+    conversational_rag_chain = rag_engine.current().chain
+    # 用戶端可用 X-Request-ID 指定 trace ID，否則自動產生；結構化日誌與回應標頭都會帶上
+    trace_id = new_trace_id(request.headers.get('X-Request-ID'))
+    REQUESTS.inc(1, "http")
     def generate():
-        stream = conversational_rag_chain.stream({"input": message}, config={"configurable": {"session_id": session_id}})
-        for chunk in stream:
-            if "answer" in chunk:
-                yield chunk['answer']
-    return Response(generate(), mimetype='text/plain')
+        # 回應本體在 view 回傳後才被迭代，需在此重新設定 trace ID
+        new_trace_id(trace_id)
+        IN_FLIGHT.inc(1, "http")
+        try:
+            with stage_timer("chat_request", session_id=session_id):
+                stream = conversational_rag_chain.stream({"input": message}, config={"configurable": {"session_id": session_id}})
+                for chunk in stream:
+                    if "answer" in chunk:
+                        yield chunk['answer']
+        finally:
+            IN_FLIGHT.dec(1, "http")
+    return Response(generate(), mimetype='text/plain', headers={"X-Trace-ID": trace_id})
 
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    """
+    批次問答：上傳 JSONL 檔案 (multipart 的 file 欄位) 或直接以 JSONL 作為請求本體，
+    每完成一題就以 application/x-ndjson 串流回傳一行結果 (格式見 src/rag/batch.py)。
+    """
+    lines = request.files['file'].stream if 'file' in request.files else request.get_data().splitlines()
+    try:
+        items = parse_batch_items(lines)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not items: return jsonify({"error": "No questions provided"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Too many questions (max {BATCH_MAX_ITEMS})."}), 413
+    if not warmup.ready: return not_ready_response()
+    concurrency = min(request.args.get('concurrency', BATCH_MAX_CONCURRENCY, type=int), BATCH_MAX_CONCURRENCY)
+    # 整批都在請求開始時的世代上執行
+    batch_chain = rag_engine.current().batch_chain
+    embeddings = chroma_manager.embedding_function
+    trace_id = new_trace_id(request.headers.get('X-Request-ID'))
+    def generate():
+        new_trace_id(trace_id)
+        IN_FLIGHT.inc(1, "batch")
+        try:
+            with stage_timer("batch_request", documents=len(items)):
+                yield from iter_jsonl(run_batch(batch_chain, items, embeddings, max_concurrency=concurrency))
+        finally:
+            IN_FLIGHT.dec(1, "batch")
+    return Response(generate(), mimetype='application/x-ndjson', headers={"X-Trace-ID": trace_id})
 
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
-    global retriever, conversational_rag_chain, llm
     if 'file' not in request.files: return jsonify({"error": "No file part"}), 400
     file = request.files['file']
     if file.filename == '': return jsonify({"error": "No selected file"}), 400
+    if not warmup.ready: return not_ready_response()
+    if chroma_manager.read_only:
+        return jsonify({"error": "Index is read-only; rebuild the index artifact to add documents."}), 409
     
     filename = file.filename
     file_path = os.path.join(DOCUMENTS_DIR, filename)
     file.save(file_path)
 
-    print(f"偵測到新文件 '{filename}'，正在重新索引...")
-    raw_docs = load_documents(DOCUMENTS_DIR)
-    split_docs = split_documents(raw_docs)
-    chroma_manager.add_documents(split_docs)
-    
-    retriever = chroma_manager.create_hybrid_retriever(split_docs)
-    conversational_rag_chain = create_conversational_rag_chain(llm, retriever)
-    
-    # 【修改處】將更新後的 RAG 鏈也設定到 LINE manager 實例中
-    app.line_bot_manager.set_rag_chain(conversational_rag_chain)
-    
-    print("✅ 文件索引與 RAG 鏈更新完成！")
-    return jsonify({"message": f"File '{filename}' uploaded and indexed successfully."})
+    # 索引在背景執行，請求立即回傳 job ID，可透過狀態端點查詢進度
+    job = ingestion_jobs.submit(f"upload:{filename}")
+    print(f"偵測到新文件 '{filename}'，已排入索引工作 {job.id}。")
+    return jsonify({
+        "message": f"File '{filename}' uploaded, indexing in background.",
+        "job_id": job.id,
+        "status_url": f"/api/upload/{job.id}",
+    }), 202
+
+@app.route('/api/upload/<job_id>', methods=['GET'])
+def upload_status(job_id):
+    job = ingestion_jobs.get(job_id)
+    if job is None: return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict())
 
 # --- 【修改處】Webhook 路由現在呼叫 manager 的方法 ---
 @app.route("/webhook", methods=['POST'])
 def webhook():
     return app.line_bot_manager.handle_webhook_request(request)
 
+@app.route("/api/line/stats", methods=['GET'])
+def line_stats():
+    return jsonify(app.line_bot_manager.get_stats())
+
+@app.route("/healthz", methods=['GET'])
+def healthz():
+    """存活檢查：行程可以回應即為正常 (暖機期間也回應 200)。"""
+    return jsonify({"status": "ok"})
+
+@app.route("/readyz", methods=['GET'])
+def readyz():
+    """就緒檢查：模型與索引載入完成才回應 200，負載平衡器據此決定是否導入流量。"""
+    generation = rag_engine.current()
+    body = {
+        "status": "ready" if warmup.ready else "warming_up",
+        "warmup": warmup.to_dict(),
+        "generation": generation.version if generation is not None else None,
+        "index_version": chroma_manager.index_version if chroma_manager is not None else None,
+        "index_artifact": index_artifact["version"] if index_artifact is not None else None,
+    }
+    return jsonify(body), 200 if warmup.ready else 503
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
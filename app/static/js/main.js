@@ -85,6 +85,36 @@ document.addEventListener('DOMContentLoaded', () => {
         if (e.key === 'Enter') handleSendMessage();
     });
 
+    async function pollUploadStatus(statusUrl, fileName) {
+        while (true) {
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            try {
+                const response = await fetch(statusUrl);
+                const job = await response.json();
+                if (!response.ok) {
+                    uploadStatus.textContent = `錯誤: ${job.error}`;
+                    return;
+                }
+                if (job.status === 'succeeded') {
+                    uploadStatus.textContent = `${fileName} 已完成索引。`;
+                    return;
+                }
+                if (job.status === 'failed') {
+                    uploadStatus.textContent = `${fileName} 索引失敗: ${job.error}`;
+                    return;
+                }
+                const { files_done, files_total } = job.progress;
+                uploadStatus.textContent = job.status === 'queued'
+                    ? `${fileName} 等待索引中...`
+                    : `${fileName} 索引中... (${files_done}/${files_total})`;
+            } catch (error) {
+                console.error('Status polling error:', error);
+                uploadStatus.textContent = "無法取得索引進度，請檢查後端服務。";
+                return;
+            }
+        }
+    }
+
     uploadForm.addEventListener('submit', async (e) => {
         e.preventDefault();
         const file = fileInput.files[0];
@@ -105,6 +135,8 @@ document.addEventListener('DOMContentLoaded', () => {
             const result = await response.json();
             if (response.ok) {
                 uploadStatus.textContent = result.message;
+                // 索引在背景進行，定期查詢工作狀態直到完成
+                pollUploadStatus(result.status_url, file.name);
             } else {
                 uploadStatus.textContent = `錯誤: ${result.error}`;
             }
@@ -0,0 +1,68 @@
+# app/warmup.py
+import threading
+import time
+from typing import Callable, Optional
+
+
+class WarmupState:
+    """
+    背景暖機的進度，供 /readyz 回報。
+
+    階段：starting → loading_models → loading_index → building_chain → warming → ready (或 failed)
+    """
+
+    def __init__(self):
+        self.phase = "starting"
+        self.error: Optional[str] = None
+        self.started_at = time.time()
+        self.ready_at: Optional[float] = None
+        self._ready = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def set_phase(self, phase: str):
+        self.phase = phase
+        print(f"[暖機] {phase} ({time.time() - self.started_at:.1f}s)")
+
+    def mark_ready(self):
+        self.phase = "ready"
+        self.ready_at = time.time()
+        self._ready.set()
+        print(f"✅ 暖機完成，耗時 {self.ready_at - self.started_at:.1f} 秒，開始接受請求。")
+
+    def mark_failed(self, error: Exception):
+        self.phase = "failed"
+        self.error = str(error)
+        print(f"錯誤：暖機失敗: {error}")
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def run(self, initialize: Callable[["WarmupState"], None], background: bool = True):
+        """執行初始化；background 時在背景執行緒中進行，呼叫端可立即開始接受連線。"""
+        def target():
+            try:
+                initialize(self)
+                self.mark_ready()
+            except Exception as e:
+                self.mark_failed(e)
+                if not background:
+                    raise
+
+        if not background:
+            target()
+            return
+        self._thread = threading.Thread(target=target, name="rag-warmup", daemon=True)
+        self._thread.start()
+
+    def to_dict(self) -> dict:
+        return {
+            "ready": self.ready,
+            "phase": self.phase,
+            "error": self.error,
+            "uptime_seconds": round(time.time() - self.started_at, 3),
+            "warmup_seconds": round(self.ready_at - self.started_at, 3) if self.ready_at else None,
+        }
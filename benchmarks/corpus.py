@@ -0,0 +1,40 @@
+# benchmarks/corpus.py
+"""產生基準測試用的合成繁體中文語料與問題。"""
+import os
+import random
+from typing import List
+
+from .fakes import _VOCABULARY
+
+_TOPICS = ["熱島效應", "綠屋頂", "通風廊道", "透水鋪面", "都市森林", "冷屋頂", "水體降溫", "遮蔭設計"]
+
+
+def _sentence(rng: random.Random) -> str:
+    words = rng.choices(_VOCABULARY, k=rng.randint(8, 20))
+    return rng.choice(_TOPICS) + "與" + "".join(words) + "。"
+
+
+def generate_corpus(directory: str, num_files: int, paragraphs_per_file: int, seed: int = 42) -> int:
+    """在 directory 中產生 num_files 個 .txt 文件，回傳總字元數。"""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    total_chars = 0
+    for i in range(num_files):
+        paragraphs = [
+            "".join(_sentence(rng) for _ in range(rng.randint(3, 8)))
+            for _ in range(paragraphs_per_file)
+        ]
+        text = "\n\n".join(paragraphs)
+        total_chars += len(text)
+        with open(os.path.join(directory, f"doc_{i:05d}.txt"), "w", encoding="utf-8") as f:
+            f.write(text)
+    return total_chars
+
+
+def generate_questions(num_questions: int, seed: int = 7) -> List[str]:
+    rng = random.Random(seed)
+    templates = ["{topic}如何降低{word}？", "{topic}對{word}有什麼影響？", "請說明{topic}與{word}的關係。"]
+    return [
+        rng.choice(templates).format(topic=rng.choice(_TOPICS), word=rng.choice(_VOCABULARY))
+        for _ in range(num_questions)
+    ]
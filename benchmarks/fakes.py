@@ -0,0 +1,136 @@
+# benchmarks/fakes.py
+"""離線基準測試用的確定性假模型：不需要 Google API 金鑰，也不需要下載 bge-m3。"""
+import asyncio
+import hashlib
+import threading
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+_VOCABULARY = (
+    "都市 熱島 效應 氣溫 綠地 屋頂 綠化 通風 廊道 建築 密度 柏油 反照率 蒸發 散熱 "
+    "夜間 日間 郊區 人工 排熱 空調 交通 植栽 水體 遮蔭 材料 政策 規劃 健康 能源"
+).split()
+
+
+class FakeRateLimitError(Exception):
+    """模擬 API 回應 429 (配額用盡)。"""
+
+    code = 429
+
+
+def _seed(text: str) -> int:
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    確定性的假聊天模型。
+
+    回應內容由提示的雜湊決定 (相同提示永遠得到相同回應)，
+    並以 first_token_latency 與 tokens_per_second 模擬真實 LLM 的延遲與串流速度。
+    前 fail_times 次呼叫拋出 FakeRateLimitError，calls 記錄實際收到的呼叫數，
+    用來測試 src/llm/guarded.py 的重試與相同提示合併。
+    """
+
+    first_token_latency: float = 0.3
+    tokens_per_second: float = 50.0
+    response_tokens: int = 40
+    fail_times: int = 0
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-benchmark-chat"
+
+    def _response_tokens(self, messages: List[BaseMessage]) -> List[str]:
+        prompt = "\n".join(str(m.content) for m in messages)
+        rng = np.random.default_rng(_seed(prompt))
+        return [_VOCABULARY[i] for i in rng.integers(0, len(_VOCABULARY), self.response_tokens)]
+
+    def _begin_call(self):
+        self.calls += 1
+        if self.calls <= self.fail_times:
+            raise FakeRateLimitError("429 Resource has been exhausted (fake)")
+
+    def _token_delay(self) -> float:
+        return 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        self._begin_call()
+        tokens = self._response_tokens(messages)
+        time.sleep(self.first_token_latency + self._token_delay() * len(tokens))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                         **kwargs: Any) -> ChatResult:
+        self._begin_call()
+        tokens = self._response_tokens(messages)
+        await asyncio.sleep(self.first_token_latency + self._token_delay() * len(tokens))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None,
+                **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        self._begin_call()
+        time.sleep(self.first_token_latency)
+        for token in self._response_tokens(messages):
+            time.sleep(self._token_delay())
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        self._begin_call()
+        await asyncio.sleep(self.first_token_latency)
+        for token in self._response_tokens(messages):
+            await asyncio.sleep(self._token_delay())
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    確定性的假嵌入：向量由文字雜湊決定並正規化為單位長度。
+    cost_per_text 可用來模擬 CPU 上的嵌入成本 (秒/每段文字)，
+    cost_per_call 模擬每次前向運算的固定成本 (秒/每次呼叫，批次越大攤得越薄)。
+    和 CPU 上的真實模型一樣，同時的呼叫會依序執行 (一次前向運算已用滿所有核心)。
+    """
+
+    def __init__(self, size: int = 1024, cost_per_text: float = 0.0, cost_per_call: float = 0.0):
+        self.size = size
+        self.cost_per_text = cost_per_text
+        self.cost_per_call = cost_per_call
+        self.model_name = f"fake-embeddings-{size}"
+        self.calls = 0
+        self.texts_embedded = 0
+        self._lock = threading.Lock()
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.random.default_rng(_seed(text)).standard_normal(self.size).astype(np.float32)
+        vector /= np.linalg.norm(vector)
+        return vector.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        self.texts_embedded += len(texts)
+        if self.cost_per_text or self.cost_per_call:
+            with self._lock:
+                time.sleep(self.cost_per_call + self.cost_per_text * len(texts))
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
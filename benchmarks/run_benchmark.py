@@ -0,0 +1,293 @@
+# benchmarks/run_benchmark.py
+"""
+RAG 管線的離線端到端基準測試。
+
+以確定性的假 LLM 與假嵌入取代 Gemini 與 bge-m3，不需要 API 金鑰或下載模型，
+即可量測：
+
+- 匯入吞吐量 (chunks/s)：合成語料 → sync_directory → ChromaManager。
+- 各階段延遲 (p50/p95/p99)：問題重寫、查詢擴展、BM25、向量 MMR、融合、上下文組裝、重新排序、生成。
+- 並行對話吞吐量：以 astream 同時執行完整的 create_conversational_rag_chain。
+- 熱門問題同時湧入：相同的提示並行送出時，實際送到模型的呼叫數 (--llm-guard 時經過 single-flight 合併)。
+- 峰值記憶體 (ru_maxrss)。
+
+結果寫成 JSON，可用 --compare 與先前 commit 的結果比較。
+
+使用方式 (於專案根目錄執行)：
+    python -m benchmarks.run_benchmark --docs 200 --output results/bench.json
+    python -m benchmarks.run_benchmark --compare results/bench_before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List
+
+# 離線執行：未指定 tokenizer 時以估計的 token 數切割，不需要 bge-m3 的 tokenizer 檔案
+os.environ.setdefault("SPLITTER_TOKENIZER", "estimate")
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+from src.data_processing.indexer import sync_directory
+from src.vector_store.chroma_manager import ChromaManager
+from src.vector_store.bm25_index import BM25IndexRetriever
+from src.vector_store.hybrid_retriever import reciprocal_rank_fusion
+from src.rag.chain import (
+    create_conversational_rag_chain,
+    create_rewrite_question_chain,
+    create_question_answer_chain,
+)
+from src.rag.query_expansion import create_query_expansion_chain
+from src.rag.ReRank import reorder_documents
+from src.rag.context import assemble_context
+
+from src.llm.guarded import GuardedChatModel, RateLimiter
+from src.config import RETRIEVAL_MAX_DOCUMENTS
+
+from .fakes import FakeChatModel, FakeEmbeddings
+from .corpus import generate_corpus, generate_questions
+
+STAGES = ("rewrite", "expansion", "bm25", "vector_mmr", "fusion", "context_assembly", "reorder",
+          "generation_first_token", "generation")
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """回傳以毫秒表示的 p50/p95/p99 與平均值。"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+        "p50_ms": pick(0.50),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+    }
+
+
+@contextmanager
+def timed(samples: Dict[str, List[float]], stage: str):
+    start = time.perf_counter()
+    yield
+    samples.setdefault(stage, []).append(time.perf_counter() - start)
+
+
+def peak_memory_mb() -> Dict[str, float]:
+    """ru_maxrss 在 Linux 以 KB、在 macOS 以 bytes 為單位。"""
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "self_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        "children_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent.parent,
+            stderr=subprocess.DEVNULL, text=True,
+        ).strip()
+    except Exception:
+        return "unknown"
+
+
+def bench_ingestion(documents_dir: str, db_dir: str, embeddings, workers: int, backend: str) -> tuple:
+    manager = ChromaManager(db_dir, "benchmark_collection", embedding_function=embeddings, backend=backend)
+    start = time.perf_counter()
+    stats = sync_directory(documents_dir, manager, workers=workers)
+    elapsed = time.perf_counter() - start
+    chunks = sum(len(entry["chunk_ids"]) for entry in manager.manifest.sources.values())
+    return manager, {
+        "files": stats,
+        "chunks": chunks,
+        "seconds": elapsed,
+        "chunks_per_second": chunks / elapsed if elapsed > 0 else 0.0,
+        "embedding_cache": manager.embedding_function.stats(),
+    }
+
+
+def bench_stages(manager: ChromaManager, llm, questions: List[str]) -> Dict[str, dict]:
+    """以管線的各個元件逐一計時，找出延遲來自哪個階段。"""
+    rewrite_chain = create_rewrite_question_chain(llm)
+    expansion_chain = create_query_expansion_chain(llm)
+    qa_chain = create_question_answer_chain(llm)
+    bm25_retriever = BM25IndexRetriever(
+        index=manager.bm25_index, fetch_documents=manager.get_documents_by_ids, k=5
+    )
+    vector_retriever = manager.get_vector_retriever()
+    chat_history = [HumanMessage(content=questions[0]), AIMessage(content="這是先前的回答。")]
+
+    samples: Dict[str, List[float]] = {}
+    for question in questions:
+        with timed(samples, "rewrite"):
+            standalone = rewrite_chain.invoke({"input": question, "chat_history": chat_history})
+        with timed(samples, "expansion"):
+            expansion_chain.invoke({"question": standalone})
+        with timed(samples, "bm25"):
+            bm25_docs = bm25_retriever.invoke(standalone)
+        with timed(samples, "vector_mmr"):
+            vector_docs = vector_retriever.invoke(standalone)
+        with timed(samples, "fusion"):
+            fused = reciprocal_rank_fusion([(0.5, bm25_docs), (0.5, vector_docs)],
+                                           limit=RETRIEVAL_MAX_DOCUMENTS)
+        with timed(samples, "context_assembly"):
+            assembled = assemble_context(fused)
+        with timed(samples, "reorder"):
+            context = reorder_documents(assembled)
+
+        start = time.perf_counter()
+        first_token = None
+        for _ in qa_chain.stream({"input": question, "chat_history": [], "context": context}):
+            if first_token is None:
+                first_token = time.perf_counter() - start
+        samples.setdefault("generation_first_token", []).append(first_token or 0.0)
+        samples.setdefault("generation", []).append(time.perf_counter() - start)
+
+    return {stage: percentiles(samples.get(stage, [])) for stage in STAGES}
+
+
+async def bench_concurrent_chat(manager: ChromaManager, llm, questions: List[str],
+                                concurrency: int) -> dict:
+    """以 astream 並行執行完整 RAG 鏈，量測吞吐量與首字延遲。"""
+    chain = create_conversational_rag_chain(llm, manager.create_hybrid_retriever())
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, first_tokens = [], []
+
+    async def one(index: int, question: str):
+        async with semaphore:
+            start = time.perf_counter()
+            first_token = None
+            async for chunk in chain.astream(
+                {"input": question},
+                config={"configurable": {"session_id": f"bench-{index}"}},
+            ):
+                if "answer" in chunk and first_token is None:
+                    first_token = time.perf_counter() - start
+            latencies.append(time.perf_counter() - start)
+            first_tokens.append(first_token or 0.0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i, q) for i, q in enumerate(questions)))
+    elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests": len(questions),
+        "seconds": elapsed,
+        "requests_per_second": len(questions) / elapsed if elapsed > 0 else 0.0,
+        "latency": percentiles(latencies),
+        "first_token": percentiles(first_tokens),
+    }
+
+
+async def bench_llm_burst(llm, fake: FakeChatModel, question: str, concurrency: int) -> dict:
+    """同一個問題同時湧入 (例如在 LINE 群組中廣播)：量測實際送到模型的呼叫數與延遲。"""
+    qa_chain = create_question_answer_chain(llm)
+    calls_before = fake.calls
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        qa_chain.ainvoke({"input": question, "chat_history": [], "context": []}) for _ in range(concurrency)
+    ))
+    return {
+        "requests": concurrency,
+        "model_calls": fake.calls - calls_before,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def compare(current: dict, baseline_path: str):
+    """列出與先前結果相比，各階段 p50/p95 與吞吐量的變化。"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    def delta(new, old):
+        if not old:
+            return "n/a"
+        return f"{(new - old) / old * 100:+.1f}%"
+
+    print(f"\n與 {baseline_path} (commit {baseline.get('commit', '?')}) 比較：")
+    for stage in STAGES:
+        new, old = current["stages"].get(stage, {}), baseline.get("stages", {}).get(stage, {})
+        if new and old:
+            print(f"  {stage:<24} p50 {new['p50_ms']:9.2f}ms ({delta(new['p50_ms'], old['p50_ms'])})"
+                  f"  p95 {new['p95_ms']:9.2f}ms ({delta(new['p95_ms'], old['p95_ms'])})")
+    for section, key in (("ingestion", "chunks_per_second"), ("concurrent_chat", "requests_per_second")):
+        new = current[section][key]
+        old = baseline.get(section, {}).get(key)
+        print(f"  {section + '.' + key:<40} {new:9.2f} ({delta(new, old)})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG 管線的離線基準測試")
+    parser.add_argument("--docs", type=int, default=100, help="合成文件數")
+    parser.add_argument("--paragraphs", type=int, default=20, help="每份文件的段落數")
+    parser.add_argument("--questions", type=int, default=50, help="量測各階段延遲所用的問題數")
+    parser.add_argument("--concurrency", type=int, default=16, help="並行對話數")
+    parser.add_argument("--chat-requests", type=int, default=100, help="並行對話測試的總請求數")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="假 LLM 的首字延遲 (秒)")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="假 LLM 每秒輸出的 token 數")
+    parser.add_argument("--embedding-cost", type=float, default=0.0, help="假嵌入每段文字的耗時 (秒)")
+    parser.add_argument("--embedding-call-cost", type=float, default=0.0,
+                        help="假嵌入每次前向運算的固定耗時 (秒)，用來觀察查詢微批次的效果")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="匯入時的行程數")
+    parser.add_argument("--vector-backend", default="chroma", choices=("chroma", "numpy"),
+                        help="向量索引後端 (比較 chroma 與 numpy 時各跑一次並以 --compare 對照)")
+    parser.add_argument("--llm-guard", action="store_true",
+                        help="以 GuardedChatModel 包裝假 LLM (single-flight 與重試，不限流)")
+    parser.add_argument("--output", default=None, help="結果 JSON 的輸出路徑")
+    parser.add_argument("--compare", default=None, help="要比較的先前結果 JSON")
+    args = parser.parse_args()
+
+    fake_llm = FakeChatModel(first_token_latency=args.llm_latency, tokens_per_second=args.token_rate)
+    llm = GuardedChatModel(model=fake_llm, limiter=RateLimiter(0, 0)) if args.llm_guard else fake_llm
+    embeddings = FakeEmbeddings(cost_per_text=args.embedding_cost, cost_per_call=args.embedding_call_cost)
+
+    with tempfile.TemporaryDirectory(prefix="rag-bench-") as workdir:
+        documents_dir = os.path.join(workdir, "documents")
+        total_chars = generate_corpus(documents_dir, args.docs, args.paragraphs)
+        print(f"已產生 {args.docs} 份合成文件，共 {total_chars} 字元。")
+
+        manager, ingestion = bench_ingestion(documents_dir, os.path.join(workdir, "db"),
+                                             embeddings, args.workers, args.vector_backend)
+        stages = bench_stages(manager, llm, generate_questions(args.questions))
+        concurrent_chat = asyncio.run(bench_concurrent_chat(
+            manager, llm, generate_questions(args.chat_requests, seed=11), args.concurrency
+        ))
+        llm_burst = asyncio.run(bench_llm_burst(llm, fake_llm, generate_questions(1)[0], args.concurrency))
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "parameters": vars(args),
+        "corpus_chars": total_chars,
+        "ingestion": ingestion,
+        "stages": stages,
+        "concurrent_chat": concurrent_chat,
+        "llm_burst": llm_burst,
+        "peak_memory": peak_memory_mb(),
+    }
+
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"結果已寫入 {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
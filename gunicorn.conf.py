@@ -0,0 +1,43 @@
+# gunicorn.conf.py
+"""
+pre-fork 部署設定：gunicorn -c gunicorn.conf.py
+
+主行程以 preload_app 匯入應用程式並預先載入嵌入模型與 BM25 索引 (app.main.preload)，
+fork 出的工作行程以 copy-on-write 共用這些記憶體；各工作行程在 post_fork 中
+重建執行緒、開啟自己的向量資料庫連線，並於背景暖機 (/readyz 就緒前回應 503)。
+
+多個工作行程必須搭配 INDEX_ARTIFACT_DIR：各工作行程以唯讀方式載入同一份建置好的索引成品
+(上傳端點回應 409，索引改以 build_index 重建)。未設定時只啟動一個工作行程，
+可寫入的 data/db 由該行程獨佔 (啟動時同步文件、處理上傳)；明確指定多個工作行程則拒絕啟動，
+避免多個行程同時寫入同一份清單、BM25 索引、向量集合與嵌入快取，
+或上傳只在收到請求的工作行程中切換世代而其他工作行程繼續使用舊索引。
+"""
+import os
+
+from dotenv import load_dotenv
+
+# 與 app.main 相同從 .env 讀取設定，工作行程數的預設值需要知道是否設定了 INDEX_ARTIFACT_DIR
+load_dotenv()
+
+# 必須在匯入應用程式前設定，讓 app.main 在主行程中只預先載入而不開始暖機
+os.environ.setdefault("RAG_PREFORK_PRELOAD", "true")
+
+wsgi_app = "app.asgi:asgi_app"
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+workers = int(os.getenv("WEB_CONCURRENCY", "4" if os.getenv("INDEX_ARTIFACT_DIR") else "1"))
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+
+def on_starting(server):
+    if server.cfg.workers > 1 and not os.getenv("INDEX_ARTIFACT_DIR"):
+        raise RuntimeError(
+            f"以 {server.cfg.workers} 個工作行程啟動時必須設定 INDEX_ARTIFACT_DIR (唯讀索引成品)；"
+            f"請先執行 python -m src.data_processing.build_index --output data/index 並設定 "
+            f"INDEX_ARTIFACT_DIR=data/index，或將 WEB_CONCURRENCY 設為 1。"
+        )
+
+
+def post_fork(server, worker):
+    from app import main
+    main.post_fork_init()
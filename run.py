@@ -1,7 +1,17 @@
+import os
+import sys
+
 from app.main import app
 
 if __name__ == "__main__":
-    # 將主機設置為 '0.0.0.0' 可以讓同一個區域網路下的其他設備
-    # debug=True 會在程式碼變更時自動重啟伺服器，方便開發。
-    # 生產環境中應設置為 False。
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    port = int(os.environ.get("PORT", 5000))
+
+    if "--prod" in sys.argv:
+        # 生產模式：以 uvicorn 執行 ASGI app，/api/chat 使用非同步串流與併發上限。
+        import uvicorn
+        uvicorn.run("app.asgi:asgi_app", host='0.0.0.0', port=port)
+    else:
+        # 將主機設置為 '0.0.0.0' 可以讓同一個區域網路下的其他設備
+        # debug=True 會在程式碼變更時自動重啟伺服器，方便開發。
+        # 生產環境中應設置為 False，並改用 python run.py --prod。
+        app.run(host='0.0.0.0', port=port, debug=True)
@@ -1,4 +1,5 @@
 # src/config.py
+import os
 
 # --- AI 人設與問答提示 (QA Prompt) ---
 # 這裡定義了 AI 作為熱島效應專家的角色和行為。
@@ -20,13 +21,157 @@ just reformulate it if needed and otherwise return it as is."""
 
 
 # --- 查詢擴展提示 (Query Expansion Prompt) ---
-QUERY_EXPANSION_PROMPT_TEMPLATE = """You are an AI assistant specializing in query expansion.
-Your task is to rewrite a given user query into 1 different versions.
-The expanded queries should cover different angles, use synonyms, or rephrase the original intent.
-Return ONLY the expanded queries, separated by newlines.
+# 提示定義於 src/rag/query_expansion.py 的 QUERY_EXPANSION_PROMPT (變體數由 QUERY_EXPANSION_COUNT 決定)。
 
-Original Query:
-{question}
 
-Expanded Queries:"""
 
+# --- 向量嵌入設定 (Embedding Settings) ---
+# 嵌入模型名稱，同時作為嵌入快取鍵的一部分 (更換模型時快取自動失效)。
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "BAAI/bge-m3")
+# 每次送進模型的最大文字數量 (僅針對快取未命中的文字)。
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+# 嵌入快取每個 NumPy 分片 (shard) 最多存放的向量數。
+EMBEDDING_CACHE_SHARD_SIZE = int(os.getenv("EMBEDDING_CACHE_SHARD_SIZE", "4096"))
+# 查詢向量的記憶體 LRU 快取大小 (以正規化後的查詢文字為鍵)。
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "4096"))
+# 跨請求微批次：同時到達的查詢合併成一次前向運算的最大筆數，與第一筆到達後最多等待的毫秒數 (0 表示不等待)。
+QUERY_EMBEDDING_MAX_BATCH = int(os.getenv("QUERY_EMBEDDING_MAX_BATCH", "32"))
+QUERY_EMBEDDING_MAX_WAIT_MS = float(os.getenv("QUERY_EMBEDDING_MAX_WAIT_MS", "5"))
+
+
+# --- 向量索引後端設定 (Vector Store Settings) ---
+# 向量索引後端：chroma (ChromaDB PersistentClient) 或 numpy (行程內、memory-map 的矩陣檔)。
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "chroma")
+# numpy 後端的向量儲存型別：float16、int8 (記憶體減半，精度略降) 或 float32。
+NUMPY_VECTOR_DTYPE = os.getenv("NUMPY_VECTOR_DTYPE", "float16")
+# numpy 後端的 IVF 粗分群數 (0 為停用，一律暴力搜尋)；向量數達 NUMPY_IVF_MIN_VECTORS 才啟用。
+NUMPY_IVF_LISTS = int(os.getenv("NUMPY_IVF_LISTS", "0"))
+# 每個查詢掃描的最近分群數；越大召回率越高、速度越慢。
+NUMPY_IVF_PROBE = int(os.getenv("NUMPY_IVF_PROBE", "8"))
+NUMPY_IVF_MIN_VECTORS = int(os.getenv("NUMPY_IVF_MIN_VECTORS", "20000"))
+
+
+# --- RAG 管線設定 (Pipeline Settings) ---
+# 快速模式：無對話歷史時略過問題重寫，並讓檢索與查詢擴展並行執行。
+RAG_FAST_PIPELINE = os.getenv("RAG_FAST_PIPELINE", "true").lower() == "true"
+# 檢索前各階段 (問題重寫、查詢擴展) 的逾時秒數，逾時則退回未擴展的查詢。
+PRE_RETRIEVAL_STAGE_TIMEOUT = float(os.getenv("PRE_RETRIEVAL_STAGE_TIMEOUT", "5"))
+# 查詢擴展產生的查詢變體數；每個變體各自檢索後以 RRF 融合 (0 則不做查詢擴展)。
+QUERY_EXPANSION_COUNT = int(os.getenv("QUERY_EXPANSION_COUNT", "3"))
+# RRF 融合的平滑常數 k：score = Σ weight / (k + rank)。
+RRF_K = int(os.getenv("RRF_K", "60"))
+# 融合後送往重新評分的片段數上限。
+RETRIEVAL_MAX_DOCUMENTS = int(os.getenv("RETRIEVAL_MAX_DOCUMENTS", "10"))
+
+
+# --- 檢索後重新評分設定 (Reranking Settings) ---
+# 評分器：lexical (詞彙覆蓋率 + 向量相似度，不需額外模型)、cross_encoder 或 none (不重新評分)。
+RERANKER_TYPE = os.getenv("RERANKER_TYPE", "lexical")
+RERANKER_MODEL_NAME = os.getenv("RERANKER_MODEL_NAME", "BAAI/bge-reranker-base")
+# 重新評分後送進提示的片段數上限。
+RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", "3"))
+# 分數門檻 (留空則不設門檻)；cross-encoder 與 lexical 的分數尺度不同，需分別調整。
+RERANK_SCORE_THRESHOLD = float(os.environ["RERANK_SCORE_THRESHOLD"]) if os.getenv("RERANK_SCORE_THRESHOLD") else None
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "16"))
+# lexical 評分器中詞彙覆蓋率的權重 (其餘為向量相似度)。
+RERANK_LEXICAL_WEIGHT = float(os.getenv("RERANK_LEXICAL_WEIGHT", "0.3"))
+# (查詢, chunk ID) 分數快取的項目上限。
+RERANK_CACHE_MAX_ENTRIES = int(os.getenv("RERANK_CACHE_MAX_ENTRIES", "8192"))
+# 送進 QA 提示的參考資料 (去重、合併相鄰片段後) 的估計 token 數上限。
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "2000"))
+
+
+# --- RAG 快取設定 (Cache Settings) ---
+# 檢索快取與語意答案快取的存活時間 (秒)。
+RAG_CACHE_TTL_SECONDS = float(os.getenv("RAG_CACHE_TTL_SECONDS", "3600"))
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.getenv("RETRIEVAL_CACHE_MAX_ENTRIES", "1024"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "512"))
+# 獨立問題向量的餘弦相似度達此門檻時，直接重用快取的答案。
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.95"))
+
+
+# --- 服務設定 (Serving Settings) ---
+# 生產模式 (ASGI) 下同時串流中的 /api/chat 請求上限。
+CHAT_MAX_CONCURRENCY = int(os.getenv("CHAT_MAX_CONCURRENCY", "256"))
+# 等待空位的請求數上限，超過時立即回應 429。
+CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", "512"))
+# 在佇列中等待空位的最長秒數，逾時回應 429。
+CHAT_QUEUE_TIMEOUT = float(os.getenv("CHAT_QUEUE_TIMEOUT", "10"))
+
+
+# --- LINE Bot 背景處理設定 (LINE Worker Settings) ---
+# 處理 LINE 訊息的背景工作執行緒數量 (同時也是 Messaging API 連線池大小)。
+LINE_WORKER_THREADS = int(os.getenv("LINE_WORKER_THREADS", "8"))
+# 等待處理的使用者數上限 (同一使用者的多則訊息只佔一個位置)。
+LINE_QUEUE_MAX_DEPTH = int(os.getenv("LINE_QUEUE_MAX_DEPTH", "200"))
+# 佇列已滿時的處理策略：reject (回覆忙碌訊息)、drop_oldest (捨棄最舊的請求)、drop (直接捨棄)。
+LINE_QUEUE_OVERFLOW_POLICY = os.getenv("LINE_QUEUE_OVERFLOW_POLICY", "reject")
+
+
+# --- 對話歷史設定 (Session History Settings) ---
+# 歷史記錄後端：memory (行程內) 或 sqlite (多個工作行程共用)。
+SESSION_STORE_BACKEND = os.getenv("SESSION_STORE_BACKEND", "memory")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "data/sessions.sqlite")
+# 記憶體後端最多保留的 session 數 (LRU 淘汰)。
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "10000"))
+# session 閒置超過此秒數即被淘汰。
+SESSION_IDLE_TTL_SECONDS = float(os.getenv("SESSION_IDLE_TTL_SECONDS", "21600"))
+# 每個 session 送進提示的歷史訊息上限 (則數與估計 token 數)。
+SESSION_MAX_MESSAGES = int(os.getenv("SESSION_MAX_MESSAGES", "12"))
+SESSION_MAX_TOKENS = int(os.getenv("SESSION_MAX_TOKENS", "1500"))
+
+
+# --- 文件匯入設定 (Ingestion Settings) ---
+# 解析與切割文件的行程數；設為 1 則在目前行程內依序處理。
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(min(4, os.cpu_count() or 1))))
+# 每批寫入向量資料庫的片段數上限。
+INGEST_BATCH_CHUNKS = int(os.getenv("INGEST_BATCH_CHUNKS", "256"))
+# 每批片段文字的記憶體上限 (位元組)；超過即先寫入，確保語料庫不會整個駐留在記憶體中。
+INGEST_MAX_BATCH_BYTES = int(os.getenv("INGEST_MAX_BATCH_BYTES", str(32 * 1024 * 1024)))
+
+
+# --- 觀測設定 (Observability Settings) ---
+# 啟用後，每個階段的耗時與 trace ID 會以 JSON 結構化日誌輸出到 stderr。
+TRACE_LOG_ENABLED = os.getenv("RAG_TRACE_LOG", "false").lower() == "true"
+# /metrics 中各階段分位數 (p50/p95/p99) 所依據的最近樣本數。
+METRICS_WINDOW_SIZE = int(os.getenv("METRICS_WINDOW_SIZE", "1024"))
+
+
+# --- 啟動與部署設定 (Startup Settings) ---
+# 索引成品根目錄 (由 python -m src.data_processing.build_index 建置)；設定後工作行程以唯讀方式
+# 載入 CURRENT 所指的版本，啟動時不再掃描文件目錄與重新嵌入。留空則沿用啟動時增量同步的模式。
+INDEX_ARTIFACT_DIR = os.getenv("INDEX_ARTIFACT_DIR", "")
+# 建置新成品後保留的版本數 (供回溯)。
+INDEX_ARTIFACT_KEEP = int(os.getenv("INDEX_ARTIFACT_KEEP", "3"))
+# 啟動後先開始接受連線 (/healthz、/readyz)，模型與索引在背景載入；設為 false 則在匯入時同步載入。
+RAG_BACKGROUND_WARMUP = os.getenv("RAG_BACKGROUND_WARMUP", "true").lower() == "true"
+# pre-fork 部署 (gunicorn --preload)：主行程只預先載入嵌入模型與 BM25 索引，fork 後由各工作行程暖機。
+RAG_PREFORK_PRELOAD = os.getenv("RAG_PREFORK_PRELOAD", "false").lower() == "true"
+
+
+# --- 批次問答設定 (Batch QA Settings) ---
+# /api/batch 與批次 CLI 同時執行的題數上限。
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+# /api/batch 單次請求的題數上限 (CLI 不受此限)。
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+
+
+# --- LLM 呼叫保護設定 (LLM Call Guard Settings) ---
+# 同一時間內完全相同的提示只送出一次，串流結果轉發給所有等待者 (single-flight)。
+LLM_SINGLE_FLIGHT = os.getenv("LLM_SINGLE_FLIGHT", "true").lower() == "true"
+# 用戶端限流：每分鐘請求數與 token 數 (依 API 配額設定；0 表示不限)。
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "300"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "1000000"))
+# 可重試錯誤 (429、5xx、逾時) 的重試次數與退避時間 (秒，指數退避加隨機抖動)。
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1.0"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "20"))
+
+
+# --- 文件切割設定 (Text Splitting Settings) ---
+# 片段大小與相鄰片段的重疊，以嵌入模型的 token 數計算。
+CHUNK_SIZE_TOKENS = int(os.getenv("CHUNK_SIZE_TOKENS", "512"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "64"))
+# 計算 token 數的 tokenizer：Hugging Face 模型名稱或 tokenizer.json 路徑 (預設與嵌入模型相同)，只從本機載入；
+# 設為 estimate 時以估計的 token 數切割 (不需要 tokenizer 檔案)。
+SPLITTER_TOKENIZER = os.getenv("SPLITTER_TOKENIZER", EMBEDDING_MODEL_NAME)
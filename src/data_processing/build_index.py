@@ -0,0 +1,108 @@
+# src/data_processing/build_index.py
+"""
+建置版本化的索引成品 (向量資料庫 + BM25 稀疏索引 + 片段清單 + 嵌入快取)。
+
+每次建置產生一個新的版本目錄，以前一版為基礎做增量同步 (未變更的檔案不重新嵌入)，
+完成後才原子性地更新 CURRENT 指標；網頁工作行程設定 INDEX_ARTIFACT_DIR 後以唯讀方式載入，
+啟動時不需掃描文件、切割或嵌入。
+
+使用方式 (於專案根目錄執行)：
+    python -m src.data_processing.build_index --documents data/documents --output data/index
+"""
+import argparse
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Optional
+
+from langchain_core.embeddings import Embeddings
+
+from src.vector_store.chroma_manager import ChromaManager
+from src.vector_store.artifact import (
+    ARTIFACT_METADATA_FILENAME,
+    new_artifact_version,
+    publish_artifact,
+    prune_artifacts,
+    resolve_artifact,
+    write_artifact_metadata,
+)
+from src.config import INDEX_ARTIFACT_DIR, INDEX_ARTIFACT_KEEP, INGEST_WORKERS, VECTOR_STORE_BACKEND
+from .indexer import sync_directory
+
+PROJECT_ROOT = Path(__file__).parent.parent.parent
+DEFAULT_DOCUMENTS_DIR = str(PROJECT_ROOT / "data" / "documents")
+DEFAULT_ARTIFACT_DIR = str(PROJECT_ROOT / "data" / "index")
+DEFAULT_COLLECTION_NAME = "rag_collection"
+
+
+def build_index_artifact(documents_dir: str, artifacts_dir: str,
+                         collection_name: str = DEFAULT_COLLECTION_NAME,
+                         embedding_function: Optional[Embeddings] = None,
+                         workers: int = INGEST_WORKERS,
+                         keep: int = INDEX_ARTIFACT_KEEP,
+                         backend: str = VECTOR_STORE_BACKEND) -> dict:
+    """
+    建置並發布一個新的索引成品，回傳其中繼資料。
+
+    建置失敗時 CURRENT 仍指向前一版，工作行程不會載入建到一半的成品。
+    """
+    os.makedirs(artifacts_dir, exist_ok=True)
+    version = new_artifact_version()
+    artifact_path = os.path.join(artifacts_dir, version)
+    if os.path.exists(artifact_path):
+        raise RuntimeError(f"成品版本 {version} 已存在，請稍後再建置。")
+
+    start = time.perf_counter()
+    previous = resolve_artifact(artifacts_dir)
+    if previous is not None and previous[1].get("vector_backend", "chroma") != backend:
+        # 換了向量索引後端時，前一版的清單與向量無法沿用，從頭建置
+        previous = None
+    if previous is not None:
+        # 以前一版為基礎：未變更的檔案直接沿用片段與向量，只嵌入新增或變更的部分
+        print(f"以成品 {previous[1]['version']} 為基礎進行增量建置...")
+        shutil.copytree(previous[0], artifact_path)
+        os.remove(os.path.join(artifact_path, ARTIFACT_METADATA_FILENAME))
+
+    manager = ChromaManager(artifact_path, collection_name, embedding_function=embedding_function,
+                            backend=backend)
+    stats = sync_directory(documents_dir, manager, workers=workers)
+
+    metadata = {
+        "version": version,
+        "collection_name": collection_name,
+        "vector_backend": backend,
+        "index_version": manager.index_version,
+        "embedding_model": manager.embedding_function.model_name,
+        "sources": len(manager.manifest.sources),
+        "chunks": sum(len(entry["chunk_ids"]) for entry in manager.manifest.sources.values()),
+        "based_on": previous[1]["version"] if previous is not None else None,
+        "stats": stats,
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "build_seconds": round(time.perf_counter() - start, 3),
+    }
+    write_artifact_metadata(artifact_path, metadata)
+    publish_artifact(artifacts_dir, version)
+    prune_artifacts(artifacts_dir, keep)
+    print(f"✅ 索引成品 {version} 建置完成：{metadata['sources']} 個檔案、{metadata['chunks']} 個片段，"
+          f"耗時 {metadata['build_seconds']:.1f} 秒。")
+    return metadata
+
+
+def main():
+    parser = argparse.ArgumentParser(description="建置版本化的索引成品")
+    parser.add_argument("--documents", default=DEFAULT_DOCUMENTS_DIR, help="文件目錄")
+    parser.add_argument("--output", default=INDEX_ARTIFACT_DIR or DEFAULT_ARTIFACT_DIR, help="成品根目錄")
+    parser.add_argument("--collection", default=DEFAULT_COLLECTION_NAME, help="向量集合名稱")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="解析與切割文件的行程數")
+    parser.add_argument("--keep", type=int, default=INDEX_ARTIFACT_KEEP, help="保留的成品版本數")
+    parser.add_argument("--backend", default=VECTOR_STORE_BACKEND, choices=("chroma", "numpy"),
+                        help="向量索引後端")
+    args = parser.parse_args()
+
+    build_index_artifact(args.documents, args.output, collection_name=args.collection,
+                         workers=args.workers, keep=args.keep, backend=args.backend)
+
+
+if __name__ == "__main__":
+    main()
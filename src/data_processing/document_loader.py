@@ -1,7 +1,7 @@
 # Module for loading and processing various document types
 # src/data_processing/document_loader.py
 from pathlib import Path
-from typing import List
+from typing import Iterator, List
 from langchain_community.document_loaders import DirectoryLoader, TextLoader
 from langchain_core.documents import Document
 
@@ -19,4 +19,37 @@ def load_documents(directory_path: str) -> List[Document]:
         show_progress=True,
         use_multithreading=True
     )
-    return loader.load()
\ No newline at end of file
+    return loader.load()
+
+# 支援的副檔名與對應的 LangChain 載入器 (PDF/DOCX 需要額外安裝 pypdf / docx2txt)
+SUPPORTED_EXTENSIONS = (".txt", ".pdf", ".docx")
+
+def list_document_files(directory_path: str) -> List[Path]:
+    """列出目錄中所有可索引的文件路徑 (依路徑排序，確保結果穩定)。"""
+    directory = Path(directory_path)
+    if not directory.is_dir():
+        return []
+    return sorted(
+        p for p in directory.rglob("*")
+        if p.is_file() and p.suffix.lower() in SUPPORTED_EXTENSIONS
+    )
+
+def _get_file_loader(file_path: str):
+    suffix = Path(file_path).suffix.lower()
+    if suffix == ".pdf":
+        from langchain_community.document_loaders import PyPDFLoader
+        return PyPDFLoader(file_path)
+    if suffix == ".docx":
+        from langchain_community.document_loaders import Docx2txtLoader
+        return Docx2txtLoader(file_path)
+    return TextLoader(file_path, encoding="utf-8")
+
+def iter_file_documents(file_path: str) -> Iterator[Document]:
+    """
+    逐頁 (PDF) 或逐檔 (TXT/DOCX) 延遲載入單一文件，不會一次把整份文件全部讀進記憶體。
+    """
+    yield from _get_file_loader(str(file_path)).lazy_load()
+
+def load_file(file_path: str) -> List[Document]:
+    """載入單一文件 (.txt / .pdf / .docx)。"""
+    return list(iter_file_documents(file_path))
@@ -0,0 +1,169 @@
+# src/data_processing/indexer.py
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from src.vector_store.manifest import assign_chunk_ids, compute_file_hash
+from src.config import INGEST_WORKERS, INGEST_BATCH_CHUNKS, INGEST_MAX_BATCH_BYTES
+from src.metrics import registry, stage_timer
+from .document_loader import list_document_files, iter_file_documents
+from .text_splitter import split_documents, splitter_signature
+
+# (來源檔案鍵, 內容雜湊, 切割後的片段)；片段為 None 表示檔案無法解析
+FileChunks = Tuple[str, str, Optional[List[Document]]]
+
+INGEST_FILES = registry.counter("rag_ingest_files_total", "Files processed by sync_directory.", ("status",))
+INGEST_CHUNKS = registry.counter("rag_ingest_chunks_total", "Chunks written to the index.")
+
+
+def load_and_split_file(file_path: str, source_key: Optional[str] = None) -> Optional[List[Document]]:
+    """
+    載入並切割單一檔案 (在工作行程中執行)。
+
+    逐頁切割，讓大型 PDF 不需要整份轉成文字後才開始切割。
+    提供 source_key 時，同時在工作行程中為片段指定 chunk ID (見 assign_chunk_ids)。
+    缺少 PDF/DOCX 選用套件或檔案損毀時回傳 None，該檔案留待下次同步再處理。
+    """
+    try:
+        chunks = []
+        for page in iter_file_documents(file_path):
+            chunks.extend(split_documents([page]))
+        if source_key is not None:
+            assign_chunk_ids(source_key, chunks)
+        return chunks
+    except ImportError as e:
+        print(f"警告：缺少解析 '{file_path}' 所需的套件，已略過。({e})")
+    except Exception as e:
+        print(f"警告：無法解析 '{file_path}'，已略過。({e})")
+    return None
+
+
+def iter_file_chunks(files: List[Tuple[str, str, str]], workers: int = INGEST_WORKERS) -> Iterator[FileChunks]:
+    """
+    以行程池平行解析與切割檔案，並以產生器逐一輸出結果。
+
+    同時提交給行程池的檔案數有上限，已切割但尚未寫入的片段不會無限累積。
+
+    Args:
+        files: (檔案路徑, 來源檔案鍵, 內容雜湊) 的列表。
+    """
+    if workers <= 1 or len(files) <= 1:
+        for path, source_key, file_hash in files:
+            yield source_key, file_hash, load_and_split_file(path, source_key)
+        return
+
+    max_in_flight = workers * 2
+    pending = {}
+    remaining = iter(files)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while len(pending) < max_in_flight:
+                item = next(remaining, None)
+                if item is None:
+                    break
+                path, source_key, file_hash = item
+                pending[executor.submit(load_and_split_file, path, source_key)] = (source_key, file_hash)
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                source_key, file_hash = pending.pop(future)
+                yield source_key, file_hash, future.result()
+
+
+def iter_batches(file_chunks: Iterator[FileChunks], max_chunks: int = INGEST_BATCH_CHUNKS,
+                 max_bytes: int = INGEST_MAX_BATCH_BYTES) -> Iterator[List[FileChunks]]:
+    """依片段數與文字大小上限，將逐檔結果組成一批一批寫入的單位。"""
+    batch, batch_chunks, batch_bytes = [], 0, 0
+    for item in file_chunks:
+        chunks = item[2] or []
+        batch.append(item)
+        batch_chunks += len(chunks)
+        batch_bytes += sum(len(doc.page_content.encode("utf-8")) for doc in chunks)
+        if batch_chunks >= max_chunks or batch_bytes >= max_bytes:
+            yield batch
+            batch, batch_chunks, batch_bytes = [], 0, 0
+    if batch:
+        yield batch
+
+
+def sync_directory(directory_path: str, chroma_manager,
+                   progress_callback: Optional[Callable[[int, int, str], None]] = None,
+                   workers: int = INGEST_WORKERS) -> dict:
+    """
+    將目錄內容與向量索引做增量同步。
+
+    - 內容雜湊未變的檔案：直接略過，不重新嵌入。
+    - 新增或變更的檔案：以「載入 → 切割 → 嵌入 → 寫入」的串流管線分批處理，
+      只寫入新片段並刪除過期片段，整個語料庫不會同時駐留在記憶體中。
+    - 已刪除的檔案：移除其所有向量。
+
+    Args:
+        progress_callback: 每處理完一個檔案時以 (已完成數, 總數, 檔名) 呼叫。
+        workers: 解析與切割檔案的行程數。
+
+    Returns:
+        各類檔案數量的統計字典。
+    """
+    with stage_timer("ingest_sync") as span:
+        stats = _sync_directory(directory_path, chroma_manager, progress_callback, workers)
+        span.set(**stats)
+    for status, count in stats.items():
+        INGEST_FILES.inc(count, status)
+    return stats
+
+
+def _sync_directory(directory_path: str, chroma_manager,
+                    progress_callback: Optional[Callable[[int, int, str], None]],
+                    workers: int) -> dict:
+    stats = {"added": 0, "updated": 0, "skipped": 0, "removed": 0, "failed": 0}
+    seen = set()
+    done = 0
+
+    files = list_document_files(directory_path)
+    changed = []
+    # 切割方式 (tokenizer、片段大小) 納入檔案雜湊，設定改變時所有檔案都會重新切割
+    signature = splitter_signature()
+    for path in files:
+        source_key = path.relative_to(Path(directory_path)).as_posix()
+        seen.add(source_key)
+        file_hash = compute_file_hash(str(path), salt=signature)
+        if chroma_manager.is_source_current(source_key, file_hash):
+            stats["skipped"] += 1
+            done += 1
+            if progress_callback is not None:
+                progress_callback(done, len(files), source_key)
+        else:
+            changed.append((str(path), source_key, file_hash))
+
+    if changed:
+        print(f"共有 {len(changed)} 個新增或變更的檔案，以 {max(1, workers)} 個行程進行匯入...")
+    for batch in iter_batches(iter_file_chunks(changed, workers)):
+        to_upsert = []
+        for source_key, file_hash, chunks in batch:
+            if chunks is None:
+                stats["failed"] += 1
+                continue
+            stats["added" if source_key not in chroma_manager.manifest.sources else "updated"] += 1
+            to_upsert.append((source_key, file_hash, chunks))
+        chunk_count = sum(len(chunks) for _, _, chunks in to_upsert)
+        with stage_timer("ingest_upsert", documents=chunk_count, files=len(to_upsert)):
+            chroma_manager.upsert_sources(to_upsert)
+        INGEST_CHUNKS.inc(chunk_count)
+
+        for source_key, _, _ in batch:
+            done += 1
+            if progress_callback is not None:
+                progress_callback(done, len(files), source_key)
+
+    for source_key in chroma_manager.indexed_sources():
+        if source_key not in seen:
+            chroma_manager.delete_source(source_key)
+            stats["removed"] += 1
+
+    chroma_manager.persist()
+    print(f"✅ 增量索引完成：新增 {stats['added']}、更新 {stats['updated']}、"
+          f"略過 {stats['skipped']}、移除 {stats['removed']}、失敗 {stats['failed']} 個檔案。")
+    return stats
@@ -0,0 +1,95 @@
+# src/data_processing/jobs.py
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+
+class IngestionJob:
+    """一次背景索引工作的狀態與進度。"""
+
+    def __init__(self, description: str):
+        self.id = uuid.uuid4().hex
+        self.description = description
+        self.status = "queued"  # queued → running → succeeded / failed
+        self.files_total = 0
+        self.files_done = 0
+        self.current_file = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def update_progress(self, files_done: int, files_total: int, current_file: Optional[str] = None):
+        self.files_done = files_done
+        self.files_total = files_total
+        self.current_file = current_file
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "description": self.description,
+            "status": self.status,
+            "progress": {
+                "files_done": self.files_done,
+                "files_total": self.files_total,
+                "current_file": self.current_file,
+            },
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class IngestionJobManager:
+    """
+    以單一背景執行緒依序執行索引工作，HTTP 請求只需排入工作並立即回傳 job ID。
+
+    工作彼此序列化執行，避免兩個上傳同時改寫同一個索引。
+    """
+
+    def __init__(self, run_job: Callable[[IngestionJob], Optional[dict]], max_history: int = 100):
+        self.run_job = run_job
+        self.max_history = max_history
+        self._jobs: "OrderedDict[str, IngestionJob]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingestion")
+
+    def submit(self, description: str) -> IngestionJob:
+        job = IngestionJob(description)
+        with self._lock:
+            self._jobs[job.id] = job
+            # 只保留最近的工作紀錄 (不移除尚未完成的工作)
+            for job_id in list(self._jobs):
+                if len(self._jobs) <= self.max_history:
+                    break
+                if self._jobs[job_id].status in ("succeeded", "failed"):
+                    del self._jobs[job_id]
+        self._executor.submit(self._run, job)
+        return job
+
+    def _run(self, job: IngestionJob):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            job.result = self.run_job(job)
+            job.status = "succeeded"
+        except Exception as e:
+            print(f"索引工作 {job.id} 失敗: {e}")
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        return self._jobs.get(job_id)
+
+    def pending_count(self) -> int:
+        """尚未完成 (排隊中或執行中) 的工作數。"""
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.status in ("queued", "running"))
@@ -1,30 +1,177 @@
 # src/data_processing/text_splitter.py
-from typing import List
+"""
+以嵌入模型的 token 數切割文件。
+
+先依段落、換行與中英文句末標點 (。！？；…!?; 與句點) 切成句子，再把句子依序裝進
+不超過 chunk_size 個 token 的片段，相鄰片段重疊約 chunk_overlap 個 token (以整句為單位)。
+token 數以 bge-m3 的 fast tokenizer (tokenizers 套件) 一次批次計算整頁的所有句子。
+tokenizer 只從本機載入 (tokenizer.json 路徑，或嵌入模型下載時已存在 Hugging Face 快取中的檔案)，
+切割不會連線；找不到時直接報錯，而不是默默改用另一種計數方式而讓所有檔案被重新切割。
+SPLITTER_TOKENIZER=estimate 時改用 token_utils 的估計值 (例如離線基準測試)。
+超過 chunk_size 的單一句子依 tokenizer 的字元位置切開，不會在嵌入時被截斷。
+"""
+import os
+import re
+from typing import List, Optional, Sequence, Tuple
+
 from langchain_core.documents import Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-def split_documents(documents: List[Document]) -> List[Document]:
+from src.rag.token_utils import estimate_tokens
+from src.config import CHUNK_SIZE_TOKENS, CHUNK_OVERLAP_TOKENS, SPLITTER_TOKENIZER
+
+# 句子邊界：句末標點 (連同其後的引號/括號與空白)、英文句點後接空白，以及換行
+_BOUNDARY_RE = re.compile(r"[。！？；!?;…]+[」』”’）)\]]*\s*|\.\s+|\n+")
+
+# (起點, 終點, token 數)
+Unit = Tuple[int, int, int]
+
+# SPLITTER_TOKENIZER 設為此值時以估計值計算 token 數
+ESTIMATE_TOKENIZER = "estimate"
+
+
+def _load_tokenizer(tokenizer_name: str):
+    """只從本機載入 fast tokenizer：tokenizer.json 路徑，或 Hugging Face 快取中該模型的 tokenizer.json。"""
+    try:
+        from tokenizers import Tokenizer
+    except ImportError as e:
+        raise RuntimeError(f"切割需要 tokenizers 套件來計算 '{tokenizer_name}' 的 token 數；"
+                           f"請安裝 tokenizers，或設定 SPLITTER_TOKENIZER={ESTIMATE_TOKENIZER}。") from e
+    if os.path.isfile(tokenizer_name):
+        return Tokenizer.from_file(tokenizer_name)
+    try:
+        from huggingface_hub import hf_hub_download
+        path = hf_hub_download(tokenizer_name, "tokenizer.json", local_files_only=True)
+    except Exception as e:
+        raise RuntimeError(f"本機找不到 tokenizer '{tokenizer_name}' 的 tokenizer.json ({e})；"
+                           f"請先下載嵌入模型、將 SPLITTER_TOKENIZER 設為 tokenizer.json 的路徑，"
+                           f"或設定 SPLITTER_TOKENIZER={ESTIMATE_TOKENIZER}。") from e
+    return Tokenizer.from_file(path)
+
+
+class TokenCounter:
+    """
+    以 fast tokenizer 的批次 API 計算 token 數；tokenizer_name 為 estimate 時以估計值代替。
+
+    每個行程只載入一次 (見 get_token_counter)，匯入的工作行程各自持有一份。
+    """
+
+    def __init__(self, tokenizer_name: str = SPLITTER_TOKENIZER):
+        self.name = tokenizer_name
+        self.tokenizer = None if tokenizer_name == ESTIMATE_TOKENIZER else _load_tokenizer(tokenizer_name)
+
+    def count(self, texts: Sequence[str]) -> List[int]:
+        if not texts:
+            return []
+        if self.tokenizer is None:
+            return [estimate_tokens(text) for text in texts]
+        return [len(encoding.ids) for encoding in self.tokenizer.encode_batch(list(texts), add_special_tokens=False)]
+
+    def cut(self, text: str, max_tokens: int) -> List[Tuple[int, int]]:
+        """將過長的文字切成每段不超過 max_tokens 個 token，回傳各段的 (字元終點, token 數)。"""
+        if self.tokenizer is None:
+            step = max(1, len(text) * max_tokens // max(1, estimate_tokens(text)))
+            pieces, previous = [], 0
+            for end in list(range(step, len(text), step)) + [len(text)]:
+                pieces.append((end, estimate_tokens(text[previous:end])))
+                previous = end
+            return pieces
+        offsets = self.tokenizer.encode(text, add_special_tokens=False).offsets
+        pieces = [(offsets[i][0], max_tokens) for i in range(max_tokens, len(offsets), max_tokens)]
+        pieces = [(end, tokens) for end, tokens in pieces if end > 0]
+        return pieces + [(len(text), len(offsets) - max_tokens * len(pieces))]
+
+
+_token_counter: Optional[TokenCounter] = None
+
+
+def get_token_counter() -> TokenCounter:
+    global _token_counter
+    if _token_counter is None:
+        _token_counter = TokenCounter()
+    return _token_counter
+
+
+def splitter_signature(chunk_size: int = CHUNK_SIZE_TOKENS, chunk_overlap: int = CHUNK_OVERLAP_TOKENS) -> str:
+    """
+    切割方式的識別字串；改變 tokenizer 或片段大小時，既有檔案會被視為變更而重新切割。
+
+    只取自設定值 (不載入 tokenizer)，主行程與各工作行程、每次執行都會得到相同的結果。
+    """
+    return f"sentence-tokens:{SPLITTER_TOKENIZER}:{chunk_size}:{chunk_overlap}"
+
+
+def _sentence_spans(text: str) -> List[Tuple[int, int]]:
+    spans, start = [], 0
+    for match in _BOUNDARY_RE.finditer(text):
+        if match.end() > start:
+            spans.append((start, match.end()))
+            start = match.end()
+    if start < len(text):
+        spans.append((start, len(text)))
+    return spans
+
+
+def _pack(units: List[Unit], chunk_size: int, chunk_overlap: int) -> List[Tuple[int, int]]:
+    """依序把句子裝進片段；下一個片段從上一個片段結尾往回、總 token 數不超過 chunk_overlap 的句子開始。"""
+    chunks = []
+    i = 0
+    while i < len(units):
+        j, total = i, 0
+        while j < len(units) and (j == i or total + units[j][2] <= chunk_size):
+            total += units[j][2]
+            j += 1
+        chunks.append((units[i][0], units[j - 1][1]))
+        if j >= len(units):
+            break
+        k, carried = j, 0
+        while k - 1 > i and carried + units[k - 1][2] <= chunk_overlap:
+            k -= 1
+            carried += units[k][2]
+        i = k
+    return chunks
+
+
+def split_text_spans(text: str, chunk_size: int = CHUNK_SIZE_TOKENS,
+                     chunk_overlap: int = CHUNK_OVERLAP_TOKENS) -> List[Tuple[int, int]]:
+    """回傳各片段在原文中的 (起點, 終點) 字元位置 (已去除頭尾空白)。"""
+    counter = get_token_counter()
+    spans = _sentence_spans(text)
+    units: List[Unit] = []
+    for (start, end), tokens in zip(spans, counter.count([text[start:end] for start, end in spans])):
+        if tokens <= chunk_size:
+            units.append((start, end, tokens))
+            continue
+        # 單一句子就超過上限：依 token 位置切開
+        previous = start
+        for point, piece_tokens in counter.cut(text[start:end], chunk_size):
+            units.append((previous, start + point, piece_tokens))
+            previous = start + point
+
+    chunks = []
+    for start, end in _pack(units, chunk_size, chunk_overlap):
+        piece = text[start:end]
+        stripped = piece.strip()
+        if stripped:
+            start += len(piece) - len(piece.lstrip())
+            chunks.append((start, start + len(stripped)))
+    return chunks
+
+
+def split_documents(documents: List[Document], chunk_size: int = CHUNK_SIZE_TOKENS,
+                    chunk_overlap: int = CHUNK_OVERLAP_TOKENS) -> List[Document]:
     """
-    使用 RecursiveCharacterTextSplitter 將文檔分割成更小的片段。
+    將文檔分割成不超過 chunk_size 個 token 的片段。
 
     Args:
         documents: 從 loader 載入的 Document 對象列表。
 
     Returns:
-        分割後的 Document 對象列表。
+        分割後的 Document 對象列表；metadata 的 start_index 為片段在原文中的字元位置，
+        組裝上下文時用來合併重疊/相鄰片段。
     """
-    # 初始化文本分割器
-    # chunk_size: 每個文本片段的最大長度（字元數）。
-    # chunk_overlap: 相鄰片段之間的重疊字元數。這有助於保持上下文的連續性。
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=800,
-        chunk_overlap=100,
-        length_function=len,
-        is_separator_regex=False,
-    )
-    
-    print(f"準備將 {len(documents)} 份文件進行分割...")
-    split_docs = text_splitter.split_documents(documents)
-    print(f"文件已成功分割成 {len(split_docs)} 個片段。")
-    
-    return split_docs
\ No newline at end of file
+    split_docs = []
+    for doc in documents:
+        for start, end in split_text_spans(doc.page_content, chunk_size, chunk_overlap):
+            split_docs.append(Document(page_content=doc.page_content[start:end],
+                                       metadata={**doc.metadata, "start_index": start}))
+    return split_docs
@@ -1,13 +1,19 @@
 # Initialization of the Gemini language model
 # src/llm/gemini.py
 import os
+from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_google_genai import ChatGoogleGenerativeAI
 
-def get_gemini_model() -> ChatGoogleGenerativeAI:
-    """獲取並配置 Gemini 模型"""
-    return ChatGoogleGenerativeAI(
+from .guarded import GuardedChatModel
+
+def get_gemini_model() -> BaseChatModel:
+    """獲取並配置 Gemini 模型 (外層加上相同提示合併、限流與重試，見 guarded.py)"""
+    gemini = ChatGoogleGenerativeAI(
         model="gemini-2.5-flash",
         google_api_key=os.getenv("GOOGLE_API_KEY"),
         temperature=0.7,
-        convert_system_message_to_human=True
-    )
\ No newline at end of file
+        convert_system_message_to_human=True,
+        # 重試由外層統一處理 (含限流與抖動)，內層只嘗試一次，避免重試次數相乘
+        max_retries=1,
+    )
+    return GuardedChatModel(model=gemini)
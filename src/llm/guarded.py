@@ -0,0 +1,440 @@
+# src/llm/guarded.py
+"""
+包在聊天模型外層的保護層：相同提示的請求合併 (single-flight)、用戶端限流與重試。
+
+- single-flight：同一時間內完全相同的提示 (訊息、stop 與呼叫參數皆相同) 只送出一次，
+  串流回來的每個片段同時轉發給所有等待者 (同步執行緒與 asyncio 皆可共用同一次呼叫)；
+- 限流：每分鐘請求數與 token 數各一個權杖桶，超出時在送出前等待，而不是等 API 回應 429；
+- 重試：可重試的錯誤 (429、5xx、逾時、連線錯誤) 以指數退避加隨機抖動 (full jitter) 重試，
+  但只在尚未收到任何片段前重試，避免串流內容重複。
+
+內層模型只以公開的 stream / astream 呼叫，因此可直接套在 benchmarks/fakes.py 的 FakeChatModel 上測試。
+"""
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel, generate_from_stream, agenerate_from_stream
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+from src.metrics import log_event, registry
+from src.rag.token_utils import estimate_tokens
+from src.config import (
+    LLM_SINGLE_FLIGHT,
+    LLM_REQUESTS_PER_MINUTE,
+    LLM_TOKENS_PER_MINUTE,
+    LLM_MAX_RETRIES,
+    LLM_RETRY_BASE_DELAY,
+    LLM_RETRY_MAX_DELAY,
+)
+
+LLM_CALLS = registry.counter(
+    "rag_llm_calls_total", "LLM calls by outcome (sent / coalesced / retried / failed).", ("outcome",))
+LLM_THROTTLE_SECONDS = registry.summary(
+    "rag_llm_throttle_seconds", "Time spent waiting for the client-side LLM rate limiter.")
+
+_RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+_RETRYABLE_NAMES = ("ResourceExhausted", "TooManyRequests", "RateLimit", "ServiceUnavailable",
+                    "DeadlineExceeded", "InternalServerError", "Timeout")
+# 內層模型不再把回呼送到外層 (外層模型已記錄本次呼叫)，也不繼承外層 Runnable 的 config
+_INNER_CONFIG = {"callbacks": [], "run_name": "guarded_inner"}
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    """判斷錯誤是否值得重試 (限流、暫時性的伺服器錯誤、逾時與連線錯誤)，會一併檢查包裝前的原始錯誤。"""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, (TimeoutError, ConnectionError)):
+            return True
+        for attr in ("code", "status_code"):
+            value = getattr(error, attr, None)
+            if isinstance(value, int) and value in _RETRYABLE_STATUS:
+                return True
+        if any(name in type(error).__name__ for name in _RETRYABLE_NAMES):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def backoff_delay(attempt: int, base: float = LLM_RETRY_BASE_DELAY, cap: float = LLM_RETRY_MAX_DELAY) -> float:
+    """第 attempt 次重試 (從 0 起算) 前的等待秒數：在 [0, min(cap, base * 2^attempt)] 之間隨機取值。"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class TokenBucket:
+    """
+    以每分鐘速率補充的權杖桶，容量預設為一分鐘的額度。
+
+    reserve() 立即扣除額度並回傳呼叫端應等待的秒數；餘額可以是負的，
+    後到的呼叫依序排在後面，不需要輪詢。per_minute <= 0 時不限流。
+    """
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill()
+            # 單次超過容量的請求只扣容量，否則永遠等不到
+            self._tokens -= min(amount, self.capacity)
+            return max(0.0, -self._tokens / self.rate)
+
+    def adjust(self, amount: float):
+        """事後修正扣除的額度 (正數多扣、負數退還)，例如以實際用量取代送出前的估計。"""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens - amount)
+
+
+class RateLimiter:
+    """每分鐘請求數與每分鐘 token 數兩個權杖桶，兩者都有額度時才送出。"""
+
+    def __init__(self, requests_per_minute: float = LLM_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: float = LLM_TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    def reserve(self, tokens: int) -> float:
+        return max(self.requests.reserve(1), self.tokens.reserve(tokens))
+
+    def record_usage(self, estimated: int, actual: int):
+        self.tokens.adjust(actual - estimated)
+
+
+class _Flight:
+    """一次進行中的模型呼叫：保存已收到的片段，讓同步與非同步的等待者依序讀取。"""
+
+    def __init__(self):
+        self.messages: List[AIMessageChunk] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.followers = 0
+        self._cond = threading.Condition()
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+
+    def _notify(self):
+        # 呼叫端須持有 self._cond
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:  # 等待者的事件迴圈已關閉
+                pass
+
+    def publish(self, message: AIMessageChunk):
+        with self._cond:
+            self.messages.append(message)
+            self._notify()
+
+    def finish(self, error: Optional[BaseException] = None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._notify()
+
+    def _poll(self, index: int, event: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = None):
+        with self._cond:
+            if index >= len(self.messages) and not self.done:
+                if event is None:
+                    self._cond.wait()
+                else:
+                    self._async_waiters.append(event)
+            return self.messages[index:], self.done and index >= len(self.messages), self.error
+
+    def follow(self) -> Iterator[AIMessageChunk]:
+        index = 0
+        while True:
+            batch, finished, error = self._poll(index)
+            if finished:
+                if error is not None:
+                    raise error
+                return
+            index += len(batch)
+            yield from batch
+
+    async def afollow(self) -> AsyncIterator[AIMessageChunk]:
+        loop = asyncio.get_running_loop()
+        index = 0
+        while True:
+            event = asyncio.Event()
+            batch, finished, error = self._poll(index, (loop, event))
+            if finished:
+                if error is not None:
+                    raise error
+                return
+            if not batch:
+                await event.wait()
+                continue
+            index += len(batch)
+            for message in batch:
+                yield message
+
+
+def _drain(producer: Iterator):
+    # 錯誤已記錄在 flight 中並由等待者拋出
+    try:
+        for _ in producer:
+            pass
+    except Exception:
+        pass
+
+
+async def _adrain(producer: AsyncIterator):
+    try:
+        async for _ in producer:
+            pass
+    except Exception:
+        pass
+
+
+class _Abandoned(RuntimeError):
+    """發起呼叫的請求中途離開，且沒有其他等待者。"""
+
+
+class GuardedChatModel(BaseChatModel):
+    """
+    為內層聊天模型加上 single-flight、限流與重試的包裝模型，對外仍是一般的 BaseChatModel。
+
+    invoke 與 stream 都透過內層的串流呼叫實作，因此 invoke 的請求也能與進行中的串流合併。
+    發起呼叫的請求中途離開 (例如用戶端斷線) 時，若還有其他等待者，呼叫會在背景繼續完成。
+    """
+
+    model: BaseChatModel
+    single_flight: bool = LLM_SINGLE_FLIGHT
+    max_retries: int = LLM_MAX_RETRIES
+    limiter: Any = None
+
+    _flights: Dict[str, _Flight] = PrivateAttr(default_factory=dict)
+    _flights_lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        if self.limiter is None:
+            self.limiter = RateLimiter()
+
+    @property
+    def _llm_type(self) -> str:
+        return f"guarded-{self.model._llm_type}"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model": self.model._identifying_params}
+
+    # --- single-flight ---
+
+    def _flight_key(self, messages: List[BaseMessage], stop: Optional[List[str]], kwargs: dict) -> str:
+        payload = json.dumps([[message.type, message.content] for message in messages] + [stop, kwargs],
+                             ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _join(self, key: str) -> Tuple[_Flight, bool]:
+        """加入進行中的相同呼叫；沒有時建立新的，回傳 (flight, 是否由自己發起)。"""
+        with self._flights_lock:
+            flight = self._flights.get(key) if self.single_flight else None
+            if flight is not None:
+                flight.followers += 1
+                LLM_CALLS.inc(1, "coalesced")
+                return flight, False
+            flight = _Flight()
+            if self.single_flight:
+                self._flights[key] = flight
+            return flight, True
+
+    def _release(self, key: str, flight: _Flight):
+        with self._flights_lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def _abandon(self, key: str, flight: _Flight) -> bool:
+        """發起者離開時：沒有其他等待者就取消呼叫 (回傳 True)，否則由背景繼續完成。"""
+        with self._flights_lock:
+            if flight.followers:
+                return False
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            return True
+
+    # --- 限流與重試 ---
+
+    @staticmethod
+    def _prompt_tokens(messages: List[BaseMessage]) -> int:
+        return sum(estimate_tokens(message.content if isinstance(message.content, str) else str(message.content))
+                   for message in messages)
+
+    def _record_usage(self, estimated: int, messages: List[AIMessageChunk]):
+        usage = next((m.usage_metadata for m in reversed(messages) if m.usage_metadata), None)
+        if usage is not None:
+            actual = usage.get("total_tokens", 0)
+        else:
+            actual = estimated + estimate_tokens("".join(str(m.content) for m in messages))
+        self.limiter.record_usage(estimated, actual)
+
+    def _on_retry(self, attempt: int, error: Exception) -> float:
+        delay = backoff_delay(attempt)
+        LLM_CALLS.inc(1, "retried")
+        log_event("llm_retry", attempt=attempt + 1, max_retries=self.max_retries, delay_s=round(delay, 3),
+                  error=f"{type(error).__name__}: {error}")
+        return delay
+
+    def _produce(self, key: str, flight: _Flight, messages: List[BaseMessage],
+                 stop: Optional[List[str]], kwargs: dict) -> Iterator[AIMessageChunk]:
+        estimated = self._prompt_tokens(messages)
+        attempt = 0
+        try:
+            while True:
+                wait = self.limiter.reserve(estimated)
+                LLM_THROTTLE_SECONDS.observe(wait)
+                if wait > 0:
+                    time.sleep(wait)
+                LLM_CALLS.inc(1, "sent")
+                try:
+                    for message in self.model.stream(messages, config=_INNER_CONFIG, stop=stop, **kwargs):
+                        flight.publish(message)
+                        yield message
+                    break
+                except Exception as e:
+                    if flight.messages or attempt >= self.max_retries or not is_retryable_error(e):
+                        raise
+                    time.sleep(self._on_retry(attempt, e))
+                    attempt += 1
+            self._record_usage(estimated, flight.messages)
+            flight.finish()
+        except GeneratorExit:
+            flight.finish(_Abandoned("LLM 呼叫已被取消。"))
+            raise
+        except BaseException as e:
+            LLM_CALLS.inc(1, "failed")
+            flight.finish(e)
+            raise
+        finally:
+            self._release(key, flight)
+
+    async def _aproduce(self, key: str, flight: _Flight, messages: List[BaseMessage],
+                        stop: Optional[List[str]], kwargs: dict) -> AsyncIterator[AIMessageChunk]:
+        estimated = self._prompt_tokens(messages)
+        attempt = 0
+        try:
+            while True:
+                wait = self.limiter.reserve(estimated)
+                LLM_THROTTLE_SECONDS.observe(wait)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                LLM_CALLS.inc(1, "sent")
+                try:
+                    async for message in self.model.astream(messages, config=_INNER_CONFIG, stop=stop, **kwargs):
+                        flight.publish(message)
+                        yield message
+                    break
+                except Exception as e:
+                    if flight.messages or attempt >= self.max_retries or not is_retryable_error(e):
+                        raise
+                    await asyncio.sleep(self._on_retry(attempt, e))
+                    attempt += 1
+            self._record_usage(estimated, flight.messages)
+            flight.finish()
+        except (GeneratorExit, asyncio.CancelledError):
+            flight.finish(_Abandoned("LLM 呼叫已被取消。"))
+            raise
+        except BaseException as e:
+            LLM_CALLS.inc(1, "failed")
+            flight.finish(e)
+            raise
+        finally:
+            self._release(key, flight)
+
+    def _leave(self, flight: _Flight):
+        with self._flights_lock:
+            flight.followers -= 1
+
+    def _messages(self, messages: List[BaseMessage], stop: Optional[List[str]], kwargs: dict) -> Iterator[AIMessageChunk]:
+        key = self._flight_key(messages, stop, kwargs)
+        flight, leader = self._join(key)
+        if not leader:
+            try:
+                yield from flight.follow()
+            finally:
+                self._leave(flight)
+            return
+        producer = self._produce(key, flight, messages, stop, kwargs)
+        try:
+            # 不用 yield from：呼叫端離開時 producer 不能被連帶關閉
+            for message in producer:
+                yield message
+        except GeneratorExit:
+            if self._abandon(key, flight):
+                producer.close()
+            else:
+                # 還有其他等待者：在背景把這次呼叫跑完
+                threading.Thread(target=_drain, args=(producer,), daemon=True, name="llm-single-flight").start()
+            raise
+
+    async def _amessages(self, messages: List[BaseMessage], stop: Optional[List[str]],
+                         kwargs: dict) -> AsyncIterator[AIMessageChunk]:
+        key = self._flight_key(messages, stop, kwargs)
+        flight, leader = self._join(key)
+        task = None
+        if leader:
+            # 呼叫在獨立的 task 中進行，發起的請求被取消時不會連帶中斷其他等待者
+            task = asyncio.ensure_future(_adrain(self._aproduce(key, flight, messages, stop, kwargs)))
+        try:
+            async for message in flight.afollow():
+                yield message
+        except (GeneratorExit, asyncio.CancelledError):
+            if task is not None and self._abandon(key, flight):
+                task.cancel()
+            raise
+        finally:
+            if task is None:
+                self._leave(flight)
+
+    # --- BaseChatModel 介面 ---
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None,
+                **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        for message in self._messages(messages, stop, kwargs):
+            # 片段由所有等待者共用，各自複製一份再交給 LangChain (它會寫入 id 與 metadata)
+            chunk = ChatGenerationChunk(message=message.model_copy())
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        async for message in self._amessages(messages, stop, kwargs):
+            chunk = ChatGenerationChunk(message=message.model_copy())
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                         **kwargs: Any) -> ChatResult:
+        return await agenerate_from_stream(self._astream(messages, stop, run_manager, **kwargs))
@@ -0,0 +1,302 @@
+# src/metrics.py
+"""
+RAG 鏈與文件匯入的輕量級觀測工具。
+
+- 各階段的耗時以滑動視窗摘要 (p50/p95/p99) 與累計 _sum/_count 記錄。
+- 計數器與即時量測值 (佇列深度、進行中請求數、快取命中等)。
+- 以 Prometheus 文字格式輸出，供 /metrics 路由抓取。
+- 選用的 trace ID：以 contextvars 傳遞，啟用 RAG_TRACE_LOG 時隨每個階段寫成 JSON 結構化日誌。
+"""
+import contextvars
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple, Union
+
+from src.config import TRACE_LOG_ENABLED, METRICS_WINDOW_SIZE
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+_trace_id: contextvars.ContextVar = contextvars.ContextVar("rag_trace_id", default=None)
+# collect_stages() 區塊內各階段的累計耗時 (毫秒)；子執行緒複製 context 後共用同一個字典
+_stage_collector: contextvars.ContextVar = contextvars.ContextVar("rag_stage_collector", default=None)
+_collector_lock = threading.Lock()
+
+trace_logger = logging.getLogger("rag.trace")
+if TRACE_LOG_ENABLED and not trace_logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_logger.addHandler(_handler)
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+
+
+def new_trace_id(incoming: Optional[str] = None) -> str:
+    """設定目前請求的 trace ID (沿用用戶端傳入的值，或產生新的)，並回傳。"""
+    trace_id = (incoming or "").strip()[:64] or uuid.uuid4().hex[:16]
+    _trace_id.set(trace_id)
+    return trace_id
+
+
+def get_trace_id() -> Optional[str]:
+    return _trace_id.get()
+
+
+def log_event(event: str, **fields):
+    """寫出一行 JSON 結構化日誌 (僅在 RAG_TRACE_LOG 啟用時)。"""
+    if not TRACE_LOG_ENABLED:
+        return
+    record = {"ts": round(time.time(), 3), "event": event, "trace_id": get_trace_id()}
+    record.update(fields)
+    trace_logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *label_values: str):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for values, total in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, values)} {total}")
+        return lines
+
+
+class Gauge:
+    """即時量測值；可直接設定，或在抓取時呼叫 callback 取得目前值。"""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 callback: Optional[Callable[[], Union[float, Dict[LabelValues, float]]]] = None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.callback = callback
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, *label_values: str):
+        with self._lock:
+            self._values[label_values] = value
+
+    def inc(self, amount: float = 1, *label_values: str):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, amount: float = 1, *label_values: str):
+        self.inc(-amount, *label_values)
+
+    def _current(self) -> Dict[LabelValues, float]:
+        if self.callback is None:
+            with self._lock:
+                return dict(self._values)
+        try:
+            value = self.callback()
+        except Exception as e:
+            print(f"量測值 {self.name} 讀取失敗: {e}")
+            return {}
+        return value if isinstance(value, dict) else {(): value}
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for values, value in sorted(self._current().items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, values)} {value}")
+        return lines
+
+
+class Summary:
+    """
+    耗時/大小的摘要：累計 _sum 與 _count，
+    分位數則以每組標籤最近 window_size 筆樣本計算。
+    """
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 window_size: int = METRICS_WINDOW_SIZE):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.window_size = window_size
+        self._samples: Dict[LabelValues, deque] = {}
+        self._sums: Dict[LabelValues, float] = {}
+        self._counts: Dict[LabelValues, int] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        with self._lock:
+            samples = self._samples.get(label_values)
+            if samples is None:
+                samples = self._samples[label_values] = deque(maxlen=self.window_size)
+            samples.append(value)
+            self._sums[label_values] = self._sums.get(label_values, 0.0) + value
+            self._counts[label_values] = self._counts.get(label_values, 0) + 1
+
+    def quantiles(self, *label_values: str) -> Dict[float, float]:
+        with self._lock:
+            ordered = sorted(self._samples.get(label_values, ()))
+        if not ordered:
+            return {}
+        return {q: ordered[min(len(ordered) - 1, int(len(ordered) * q))] for q in QUANTILES}
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} summary"]
+        with self._lock:
+            keys = sorted(self._samples)
+        for values in keys:
+            for q, value in self.quantiles(*values).items():
+                quantile = 'quantile="%s"' % q
+                lines.append(f"{self.name}{_format_labels(self.labels, values, quantile)} {value}")
+            with self._lock:
+                total, count = self._sums[values], self._counts[values]
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, values)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, values)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            # 重複註冊 (例如重建 RAG 鏈) 時沿用既有的指標
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if isinstance(metric, Gauge) and metric.callback is not None:
+                    existing.callback = metric.callback
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: Tuple[str, ...] = (), callback=None) -> Gauge:
+        return self._register(Gauge(name, help_text, labels, callback))
+
+    def summary(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Summary:
+        return self._register(Summary(name, help_text, labels))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.summary(
+    "rag_stage_duration_seconds", "Duration of each RAG / ingestion stage.", ("stage",))
+STAGE_DOCUMENTS = registry.summary(
+    "rag_stage_documents", "Number of documents produced by each stage.", ("stage",))
+STAGE_CHARS = registry.summary(
+    "rag_stage_chars", "Prompt / response size in characters per stage.", ("stage", "kind"))
+STAGE_ERRORS = registry.counter(
+    "rag_stage_errors_total", "Stages that raised or fell back.", ("stage",))
+REQUESTS = registry.counter(
+    "rag_requests_total", "Chat requests by entry point.", ("entrypoint",))
+IN_FLIGHT = registry.gauge(
+    "rag_requests_in_flight", "Chat requests currently being answered.", ("entrypoint",))
+
+
+# 標記在子鏈/檢索器 metadata 中的階段名稱鍵，由 src/rag/tracing.py 的回呼讀取
+STAGE_METADATA_KEY = "rag_stage"
+
+
+def stage_metadata(stage: str) -> Dict[str, str]:
+    """供 .with_config(metadata=...) 或檢索器的 metadata 欄位使用，標記此呼叫屬於哪個階段。"""
+    return {STAGE_METADATA_KEY: stage}
+
+
+def observe_stage(stage: str, seconds: float, documents: Optional[int] = None, **fields):
+    """記錄一個已完成階段的耗時與選用的文件數，並寫出結構化日誌。"""
+    STAGE_SECONDS.observe(seconds, stage)
+    if documents is not None:
+        STAGE_DOCUMENTS.observe(documents, stage)
+    for kind in ("prompt_chars", "response_chars"):
+        if kind in fields:
+            STAGE_CHARS.observe(fields[kind], stage, kind.split("_")[0])
+    log_event("stage", stage=stage, duration_ms=round(seconds * 1000, 2),
+              **({"documents": documents} if documents is not None else {}), **fields)
+    collected = _stage_collector.get()
+    if collected is not None:
+        with _collector_lock:
+            collected[stage] = round(collected.get(stage, 0.0) + seconds * 1000, 2)
+
+
+@contextmanager
+def collect_stages():
+    """
+    收集 with 區塊內 (含提交到執行緒池或 asyncio.to_thread 的工作) 各階段的累計耗時，
+    供批次問答輸出每一題的時間分解：
+
+        with collect_stages() as timings:
+            chain.invoke(...)
+        timings  # {"retrieval": 12.3, "generation": 850.1, ...} (毫秒)
+    """
+    collected: Dict[str, float] = {}
+    token = _stage_collector.set(collected)
+    try:
+        yield collected
+    finally:
+        _stage_collector.reset(token)
+
+
+class StageSpan:
+    """stage_timer 產生的物件，可在階段進行中補上文件數與其他欄位。"""
+
+    def __init__(self):
+        self.documents: Optional[int] = None
+        self.fields: dict = {}
+
+    def set(self, documents: Optional[int] = None, **fields):
+        if documents is not None:
+            self.documents = documents
+        self.fields.update(fields)
+
+
+@contextmanager
+def stage_timer(stage: str, documents: Optional[int] = None, **fields):
+    """
+    以 with 區塊量測一個階段：
+
+        with stage_timer("bm25") as span:
+            docs = ...
+            span.set(documents=len(docs))
+    """
+    span = StageSpan()
+    span.set(documents, **fields)
+    start = time.perf_counter()
+    try:
+        yield span
+    except BaseException as e:
+        STAGE_ERRORS.inc(1, stage)
+        span.fields["error"] = type(e).__name__
+        raise
+    finally:
+        observe_stage(stage, time.perf_counter() - start, span.documents, **span.fields)
@@ -1,7 +1,148 @@
-from typing import List
+import hashlib
+from typing import Dict, List, Optional
+
+import numpy as np
 from langchain_core.documents import Document
 from langchain_community.document_transformers import LongContextReorder
 
+from .cache import TTLLRUCache
+from src.metrics import stage_timer
+from src.vector_store.bm25_index import tokenize
+from src.vector_store.embedding_cache import normalize_text
+from src.config import (
+    RERANKER_TYPE,
+    RERANKER_MODEL_NAME,
+    RERANK_TOP_K,
+    RERANK_SCORE_THRESHOLD,
+    RERANK_BATCH_SIZE,
+    RERANK_LEXICAL_WEIGHT,
+    RERANK_CACHE_MAX_ENTRIES,
+    RAG_CACHE_TTL_SECONDS,
+)
+
+
+class LexicalEmbeddingScorer:
+    """
+    不需額外模型的輕量評分器：詞彙覆蓋率與向量餘弦相似度的加權和。
+
+    - 詞彙：查詢的單字/雙字 token 有多少比例出現在片段中 (與 BM25 使用相同的斷詞)。
+    - 向量：以索引時使用的嵌入模型計算；片段向量通常已在嵌入快取中，不需重新計算。
+    """
+
+    def __init__(self, embeddings, lexical_weight: float = RERANK_LEXICAL_WEIGHT):
+        self.embeddings = embeddings
+        self.lexical_weight = lexical_weight
+
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        query_terms = set(tokenize(query))
+        lexical = np.zeros(len(texts), dtype=np.float32)
+        if query_terms:
+            for i, text in enumerate(texts):
+                lexical[i] = len(query_terms.intersection(tokenize(text))) / len(query_terms)
+
+        query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        doc_vectors = np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+        query_vector /= (np.linalg.norm(query_vector) or 1.0)
+        doc_vectors /= np.maximum(np.linalg.norm(doc_vectors, axis=1, keepdims=True), 1e-12)
+        semantic = doc_vectors @ query_vector
+
+        return (self.lexical_weight * lexical + (1 - self.lexical_weight) * semantic).tolist()
+
+
+class CrossEncoderScorer:
+    """以 CPU 上的 cross-encoder (例如 bge-reranker) 對 (查詢, 片段) 成對評分。"""
+
+    def __init__(self, model_name: str = RERANKER_MODEL_NAME, batch_size: int = RERANK_BATCH_SIZE):
+        from sentence_transformers import CrossEncoder
+        self.model = CrossEncoder(model_name, device="cpu")
+        self.batch_size = batch_size
+
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        scores = self.model.predict([(query, text) for text in texts], batch_size=self.batch_size)
+        return [float(s) for s in scores]
+
+
+class DocumentReranker:
+    """
+    依 (查詢, 片段) 分數重新排序檢索結果，只保留前 top_k 個 (且分數不低於門檻的) 片段。
+
+    分數以 (查詢雜湊, chunk ID) 為鍵快取，重複或相近的提問不需重新評分；
+    未命中的片段以 batch_size 為單位批次送進評分器。
+    """
+
+    def __init__(self, scorer, top_k: int = RERANK_TOP_K,
+                 score_threshold: Optional[float] = RERANK_SCORE_THRESHOLD,
+                 batch_size: int = RERANK_BATCH_SIZE,
+                 cache_max_entries: int = RERANK_CACHE_MAX_ENTRIES,
+                 cache_ttl_seconds: float = RAG_CACHE_TTL_SECONDS):
+        self.scorer = scorer
+        self.top_k = top_k
+        self.score_threshold = score_threshold
+        self.batch_size = max(1, batch_size)
+        self.score_cache = TTLLRUCache(cache_max_entries, cache_ttl_seconds)
+
+    @staticmethod
+    def _cache_key(query_hash: str, doc: Document) -> str:
+        chunk_id = doc.id or hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()
+        return f"{query_hash}:{chunk_id}"
+
+    def score(self, query: str, documents: List[Document]) -> List[float]:
+        query_hash = hashlib.sha1(normalize_text(query).encode("utf-8")).hexdigest()
+        keys = [self._cache_key(query_hash, doc) for doc in documents]
+        scores: Dict[str, float] = {}
+        missing = []
+        for key, doc in zip(keys, documents):
+            cached = self.score_cache.get(key)
+            if cached is not None:
+                scores[key] = cached
+            elif key not in scores:
+                scores[key] = None
+                missing.append((key, doc))
+
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            for (key, _), value in zip(batch, self.scorer.score(query, [doc.page_content for _, doc in batch])):
+                scores[key] = value
+                self.score_cache.set(key, value)
+        return [scores[key] for key in keys]
+
+    def rerank(self, query: str, documents: List[Document]) -> List[Document]:
+        if not documents:
+            return []
+        with stage_timer("rerank", documents=len(documents)) as span:
+            scores = self.score(query, documents)
+            ranked = sorted(zip(scores, documents), key=lambda pair: pair[0], reverse=True)
+            kept = ranked[:self.top_k] if self.top_k > 0 else ranked
+            if self.score_threshold is not None:
+                # 至少保留最高分的片段，避免門檻過高時回答完全沒有上下文
+                kept = [pair for pair in kept if pair[0] >= self.score_threshold] or kept[:1]
+            span.set(kept=len(kept))
+        print(f"--- 重新評分 {len(documents)} 份文件，保留前 {len(kept)} 份 "
+              f"(最高分 {kept[0][0]:.3f}，最低分 {kept[-1][0]:.3f}) ---")
+        return [doc for _, doc in kept]
+
+
+def create_reranker(embeddings, reranker_type: str = RERANKER_TYPE) -> Optional[DocumentReranker]:
+    """
+    依設定建立重新評分器。
+
+    cross_encoder 需要 sentence-transformers 套件；未安裝或模型載入失敗時退回 lexical。
+    設為 none 則不重新評分 (只做 LongContextReorder)。
+    """
+    if reranker_type == "none":
+        return None
+    if reranker_type == "cross_encoder":
+        try:
+            return DocumentReranker(CrossEncoderScorer())
+        except ImportError:
+            print("警告：未安裝 sentence-transformers，改用詞彙 + 向量評分重新排序。")
+        except Exception as e:
+            print(f"警告：無法載入 cross-encoder 模型 ({e})，改用詞彙 + 向量評分重新排序。")
+    elif reranker_type != "lexical":
+        print(f"警告：未知的重新評分器類型 '{reranker_type}'，改用詞彙 + 向量評分。")
+    return DocumentReranker(LexicalEmbeddingScorer(embeddings))
+
+
 def reorder_documents(documents: List[Document]) -> List[Document]:
     """
     對檢索到的文件列表進行重新排序，以優化 LLM 的處理效果。
@@ -21,8 +162,9 @@ def reorder_documents(documents: List[Document]) -> List[Document]:
     # LongContextReorder 是一個簡單的實作，它會改變文件的順序
     # 這樣最重要的資訊就分佈在上下文的兩端
     print(f"--- 正在對 {len(documents)} 份文件進行重新排序 (Re-ranking)... ---")
-    reorderer = LongContextReorder()
-    reordered_docs = reorderer.transform_documents(documents)
-    
+    with stage_timer("reorder", documents=len(documents)):
+        reorderer = LongContextReorder()
+        reordered_docs = reorderer.transform_documents(documents)
+
     print("✅ 文件重新排序完成。")
     return reordered_docs
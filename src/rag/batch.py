@@ -0,0 +1,225 @@
+# src/rag/batch.py
+"""
+批次問答：一次執行大量問題 (評估題組、FAQ 準備等)，以 JSONL 逐題輸出答案。
+
+輸入每行一題：{"id": "q1", "question": "...", "chat_history": [{"role": "user", "content": "..."}, ...]}
+(id 與 chat_history 可省略)。輸出每行一題，完成一題就寫出一題 (順序依完成先後)：
+{"id", "question", "standalone_question", "answer", "sources", "timings_ms", "deduplicated_from", "error"}
+
+- 所有沒有對話歷史的問題先以一次批次計算查詢向量，各題檢索時直接取用；
+- 正規化後相同的問題只執行一次，其餘題目沿用結果並標示 deduplicated_from；
+- 以 batch_as_completed 並行執行，同時執行的題數受 max_concurrency 限制。
+
+CLI 使用方式 (於專案根目錄執行)：
+    python -m src.rag.batch --input questions.jsonl --output answers.jsonl --concurrency 8
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from dotenv import load_dotenv
+
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.runnables import RunnableLambda
+
+from src.llm.gemini import get_gemini_model
+from src.metrics import collect_stages, get_trace_id, new_trace_id, stage_timer, REQUESTS
+from src.vector_store.artifact import resolve_artifact
+from src.vector_store.chroma_manager import ChromaManager, MANIFEST_FILENAME
+from src.vector_store.embedding_cache import normalize_text
+from src.rag.cache import RAGCache
+from src.rag.chain import create_batch_rag_chain
+from src.rag.ReRank import create_reranker
+from src.config import BATCH_MAX_CONCURRENCY, INDEX_ARTIFACT_DIR
+
+_ROLE_MESSAGES = {"user": HumanMessage, "human": HumanMessage, "assistant": AIMessage, "ai": AIMessage}
+
+
+class BatchItem:
+    """批次中的一題。"""
+
+    def __init__(self, item_id: str, question: str, chat_history: Optional[List[BaseMessage]] = None):
+        self.id = item_id
+        self.question = question
+        self.chat_history = chat_history or []
+
+    @property
+    def dedup_key(self) -> Optional[str]:
+        # 有對話歷史的問題會依歷史重寫，不能與其他題目共用結果
+        return None if self.chat_history else normalize_text(self.question)
+
+
+def _parse_history(raw) -> List[BaseMessage]:
+    messages = []
+    for entry in raw or []:
+        message_class = _ROLE_MESSAGES.get(entry.get("role"))
+        if message_class is None:
+            raise ValueError(f"不支援的對話角色: {entry.get('role')!r}")
+        messages.append(message_class(content=entry.get("content", "")))
+    return messages
+
+
+def parse_batch_items(lines: Iterable[str]) -> List[BatchItem]:
+    """解析 JSONL 輸入；格式錯誤時以 ValueError 指出行號。"""
+    items = []
+    for line_number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            raw = json.loads(line)
+            question = raw.get("question") if isinstance(raw, dict) else None
+            if not isinstance(question, str) or not question.strip():
+                raise ValueError("缺少 question 欄位")
+            items.append(BatchItem(str(raw.get("id", line_number)), question, _parse_history(raw.get("chat_history"))))
+        except (ValueError, AttributeError) as e:
+            raise ValueError(f"第 {line_number} 行格式錯誤: {e}") from e
+    return items
+
+
+def _sources(docs: List[Document]) -> List[dict]:
+    """送進提示的片段 → 來源清單 (合併過的片段列出所有原始 chunk ID)。"""
+    return [{
+        "chunk_ids": doc.metadata.get("chunk_ids") or ([doc.id] if doc.id else []),
+        "source": doc.metadata.get("source"),
+        "page": doc.metadata.get("page"),
+    } for doc in docs]
+
+
+def run_batch(chain, items: List[BatchItem], embeddings=None,
+              max_concurrency: int = BATCH_MAX_CONCURRENCY) -> Iterator[dict]:
+    """
+    以批次問答鏈 (create_batch_rag_chain) 執行所有題目，每完成一題就產生一筆結果。
+
+    embeddings 提供 prime_queries 時 (CachedEmbeddings)，先一次計算所有無歷史問題的查詢向量。
+    單題失敗不會中斷批次，該題的 error 欄位記錄錯誤訊息。
+    """
+    unique: List[BatchItem] = []
+    duplicates: Dict[str, List[BatchItem]] = {}
+    for item in items:
+        key = item.dedup_key
+        if key is not None and key in duplicates:
+            duplicates[key].append(item)
+            continue
+        if key is not None:
+            duplicates[key] = []
+        unique.append(item)
+    if len(unique) < len(items):
+        print(f"批次問答：{len(items)} 題中有 {len(items) - len(unique)} 題重複，只執行一次。")
+
+    if embeddings is not None and hasattr(embeddings, "prime_queries"):
+        questions = [item.question for item in unique if not item.chat_history]
+        with stage_timer("batch_embedding", documents=len(questions)):
+            embeddings.prime_queries(questions)
+
+    batch_trace_id = get_trace_id()
+
+    def answer_one(item: BatchItem) -> dict:
+        # 每題各自的 trace ID 與階段耗時 (batch_as_completed 在執行緒池中複製 context 執行)
+        trace_id = new_trace_id(f"{batch_trace_id}-{item.id}" if batch_trace_id else None)
+        REQUESTS.inc(1, "batch")
+        start = time.perf_counter()
+        with collect_stages() as timings:
+            result = chain.invoke({"input": item.question, "chat_history": item.chat_history})
+        return {
+            "trace_id": trace_id,
+            "standalone_question": result["standalone_question"],
+            "answer": result["answer"],
+            "sources": _sources(result["context"]),
+            "timings_ms": {"total": round((time.perf_counter() - start) * 1000, 2), **timings},
+        }
+
+    def record(item: BatchItem, output, deduplicated_from: Optional[str] = None) -> dict:
+        failed = isinstance(output, Exception)
+        return {
+            "id": item.id,
+            "question": item.question,
+            **({"trace_id": None, "standalone_question": None, "answer": None,
+                "sources": [], "timings_ms": {}} if failed else output),
+            "deduplicated_from": deduplicated_from,
+            "error": f"{type(output).__name__}: {output}" if failed else None,
+        }
+
+    runner = RunnableLambda(answer_one)
+    for index, output in runner.batch_as_completed(unique, config={"max_concurrency": max(1, max_concurrency)},
+                                                   return_exceptions=True):
+        item = unique[index]
+        if isinstance(output, Exception):
+            print(f"錯誤：批次問答第 {item.id} 題失敗: {output}")
+        yield record(item, output)
+        for duplicate in duplicates.get(item.dedup_key, ()) if item.dedup_key is not None else ():
+            yield record(duplicate, output, deduplicated_from=item.id)
+
+
+def iter_jsonl(records: Iterable[dict]) -> Iterator[str]:
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def main():
+    # 與 app.main 相同從 .env 讀取 GOOGLE_API_KEY 等設定
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="以 RAG 鏈批次回答 JSONL 檔案中的問題")
+    parser.add_argument("--input", required=True, help="輸入 JSONL 檔案 (- 表示標準輸入)")
+    parser.add_argument("--output", required=True, help="輸出 JSONL 檔案")
+    parser.add_argument("--concurrency", type=int, default=BATCH_MAX_CONCURRENCY, help="同時執行的題數")
+    parser.add_argument("--index", default=None,
+                        help="索引成品根目錄 (預設為 INDEX_ARTIFACT_DIR，未設定時使用 data/db)")
+    args = parser.parse_args()
+
+    if args.input == "-":
+        items = parse_batch_items(sys.stdin)
+    else:
+        with open(args.input, encoding="utf-8") as f:
+            items = parse_batch_items(f)
+
+    # 以唯讀方式開啟索引：批次執行不會修改索引，也可與線上服務共用同一份成品
+    artifacts_dir = args.index or INDEX_ARTIFACT_DIR
+    if artifacts_dir:
+        resolved = resolve_artifact(artifacts_dir)
+        if resolved is None:
+            parser.error(f"{artifacts_dir} 中沒有可用的索引成品")
+        artifact_path, metadata = resolved
+        manager = ChromaManager(artifact_path, metadata["collection_name"], read_only=True,
+                                backend=metadata.get("vector_backend", "chroma"))
+    else:
+        db_path = Path(__file__).parent.parent.parent / "data" / "db"
+        # 唯讀開啟不存在的索引會得到空集合，每題都答不出來；先確認服務已建立過索引
+        if not (db_path / MANIFEST_FILENAME).is_file():
+            parser.error(f"{db_path} 中沒有已建立的索引 (找不到 {MANIFEST_FILENAME})；"
+                         f"請先啟動服務完成索引，或以 --index 指定索引成品目錄")
+        manager = ChromaManager(str(db_path), "rag_collection", read_only=True)
+        if not manager.indexed_sources():
+            parser.error(f"{db_path} 的索引中沒有任何文件")
+
+    # 唯讀索引只有一個世代
+    cache = RAGCache(
+        embeddings=manager.embedding_function,
+        fetch_documents=manager.get_documents_by_ids,
+        current_generation=lambda: 1,
+    ).for_generation(1)
+    chain = create_batch_rag_chain(get_gemini_model(), manager.create_hybrid_retriever(), cache=cache,
+                                   reranker=create_reranker(manager.embedding_function))
+
+    output = open(args.output, "w", encoding="utf-8")
+    start = time.perf_counter()
+    failed = 0
+    try:
+        new_trace_id()
+        for record in run_batch(chain, items, manager.embedding_function, max_concurrency=args.concurrency):
+            failed += record["error"] is not None
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+    finally:
+        output.close()
+    print(f"✅ 批次問答完成：{len(items)} 題 ({failed} 題失敗)，耗時 {time.perf_counter() - start:.1f} 秒。")
+
+
+if __name__ == "__main__":
+    main()
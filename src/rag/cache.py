@@ -0,0 +1,209 @@
+# src/rag/cache.py
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+from src.vector_store.embedding_cache import normalize_text
+from src.config import (
+    RAG_CACHE_TTL_SECONDS,
+    RETRIEVAL_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_SIMILARITY_THRESHOLD,
+)
+
+
+class TTLLRUCache:
+    """執行緒安全的 LRU 快取，每個項目另有存活時間 (TTL)。"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def items(self) -> list:
+        """回傳所有未過期的 (key, value)。"""
+        now = time.monotonic()
+        with self._lock:
+            return [(key, item[1]) for key, item in self._data.items() if item[0] >= now]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class RAGCache:
+    """
+    RAG 鏈的兩層快取。
+
+    - 第一層 (檢索快取)：正規化後的獨立問題 → 檢索到的 chunk ID。
+    - 第二層 (語意答案快取)：以問題向量的餘弦相似度比對，
+      相似度達門檻的獨立問題直接重用先前的最終答案。
+
+    兩層都以 LRU + TTL 淘汰；每個項目記錄寫入它的 RAG 世代 (見 RAGEngine)。
+    只有目前使用中的世代能讀寫快取，新世代切換進來後舊項目全部失效，
+    仍在舊世代上完成的請求也不會把舊索引的結果寫進新世代的快取。
+    RAG 鏈透過 for_generation() 取得綁定自己世代的 GenerationCache。
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        fetch_documents: Callable[[List[str]], List[Document]],
+        current_generation: Callable[[], int],
+        similarity_threshold: float = ANSWER_CACHE_SIMILARITY_THRESHOLD,
+        ttl_seconds: float = RAG_CACHE_TTL_SECONDS,
+        retrieval_max_entries: int = RETRIEVAL_CACHE_MAX_ENTRIES,
+        answer_max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+    ):
+        self.embeddings = embeddings
+        self.fetch_documents = fetch_documents
+        self.current_generation = current_generation
+        self.similarity_threshold = similarity_threshold
+        self.retrieval_cache = TTLLRUCache(retrieval_max_entries, ttl_seconds)
+        self.answer_cache = TTLLRUCache(answer_max_entries, ttl_seconds)
+        # 問題向量的小型快取，避免查詢與寫入答案時重複嵌入同一個問題
+        self._vectors = TTLLRUCache(answer_max_entries, ttl_seconds)
+        # 比對與清空世代、以及寫入前的世代檢查都在此鎖內進行，切換世代時不會混入舊結果
+        self._lock = threading.Lock()
+        self._current_version = None
+        self.semantic_hits = 0
+
+    def _sync_version(self) -> int:
+        # 呼叫端須持有 self._lock
+        version = self.current_generation()
+        if version != self._current_version:
+            # 已切換到新世代：兩層快取中的內容都可能過期，直接清空
+            self.retrieval_cache.clear()
+            self.answer_cache.clear()
+            self._current_version = version
+        return version
+
+    def current_version(self) -> int:
+        with self._lock:
+            return self._sync_version()
+
+    def for_generation(self, version: int) -> "GenerationCache":
+        return GenerationCache(self, version)
+
+    def _question_vector(self, key: str) -> np.ndarray:
+        vector = self._vectors.get(key)
+        if vector is None:
+            vector = np.asarray(self.embeddings.embed_query(key), dtype=np.float32)
+            vector /= (np.linalg.norm(vector) or 1.0)
+            self._vectors.set(key, vector)
+        return vector
+
+    # --- 第一層：檢索快取 ---
+
+    def get_documents(self, question: str, version: int) -> Optional[List[Document]]:
+        if version != self.current_version():
+            return None
+        entry = self.retrieval_cache.get(normalize_text(question))
+        if entry is None or entry[0] != version:
+            return None
+        return self.fetch_documents(entry[1])
+
+    def put_documents(self, question: str, documents: List[Document], version: int):
+        ids = [doc.id for doc in documents]
+        if not ids or any(chunk_id is None for chunk_id in ids):
+            return
+        with self._lock:
+            if version == self._sync_version():
+                self.retrieval_cache.set(normalize_text(question), (version, ids))
+
+    # --- 第二層：語意答案快取 ---
+
+    def get_answer(self, question: str, version: int) -> Optional[str]:
+        if version != self.current_version():
+            return None
+        key = normalize_text(question)
+
+        exact = self.answer_cache.get(key)
+        if exact is not None and exact[0] == version:
+            return exact[2]
+
+        entries = [value for _, value in self.answer_cache.items() if value[0] == version]
+        if not entries:
+            return None
+        query_vector = self._question_vector(key)
+        similarities = np.stack([entry[1] for entry in entries]) @ query_vector
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.similarity_threshold:
+            self.semantic_hits += 1
+            print(f"語意答案快取命中 (相似度 {similarities[best]:.3f})。")
+            return entries[best][2]
+        return None
+
+    def put_answer(self, question: str, answer: str, version: int):
+        if not answer or version != self.current_version():
+            return
+        key = normalize_text(question)
+        vector = self._question_vector(key)
+        with self._lock:
+            if version == self._sync_version():
+                self.answer_cache.set(key, (version, vector, answer))
+
+    def stats(self) -> dict:
+        return {
+            "retrieval": {"entries": len(self.retrieval_cache),
+                          "hits": self.retrieval_cache.hits, "misses": self.retrieval_cache.misses},
+            "answer": {"entries": len(self.answer_cache),
+                       "hits": self.answer_cache.hits + self.semantic_hits,
+                       "misses": self.answer_cache.misses - self.semantic_hits},
+        }
+
+
+class GenerationCache:
+    """
+    綁定單一 RAG 世代的 RAGCache 介面，由該世代的 RAG 鏈使用。
+
+    current_version() 固定回傳建立時的世代；該世代被替換後，所有查詢都不會命中，寫入也會被忽略。
+    """
+
+    def __init__(self, cache: RAGCache, version: int):
+        self.cache = cache
+        self.version = version
+
+    def current_version(self) -> int:
+        return self.version
+
+    def get_documents(self, question: str) -> Optional[List[Document]]:
+        return self.cache.get_documents(question, self.version)
+
+    def put_documents(self, question: str, documents: List[Document], version: int):
+        self.cache.put_documents(question, documents, version)
+
+    def get_answer(self, question: str) -> Optional[str]:
+        return self.cache.get_answer(question, self.version)
+
+    def put_answer(self, question: str, answer: str, version: int):
+        self.cache.put_answer(question, answer, version)
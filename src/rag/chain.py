@@ -1,67 +1,377 @@
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import List, Optional
+
 from langchain.chains.combine_documents import create_stuff_documents_chain
+from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables import RunnablePassthrough, RunnableLambda
+from langchain_core.runnables import RunnablePassthrough, RunnableLambda, RunnableGenerator
 from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain_core.output_parsers import StrOutputParser
 
 # 導入我們自定義的模組
-from .query_expansion import create_query_expansion_chain
-from .ReRank import reorder_documents
-from src.config import QA_SYSTEM_PROMPT, CONTEXTUALIZE_Q_SYSTEM_PROMPT
+from .query_expansion import create_query_expansion_chain, parse_expanded_queries
+from .ReRank import DocumentReranker, reorder_documents
+from .context import assemble_context
+from .cache import GenerationCache
+from .history import create_session_store
+from .tracing import stage_metrics_handler
+from src.metrics import stage_metadata, stage_timer, STAGE_ERRORS
+from src.vector_store.hybrid_retriever import RankedList, reciprocal_rank_fusion
+from src.config import (
+    QA_SYSTEM_PROMPT,
+    CONTEXTUALIZE_Q_SYSTEM_PROMPT,
+    RAG_FAST_PIPELINE,
+    PRE_RETRIEVAL_STAGE_TIMEOUT,
+    QUERY_EXPANSION_COUNT,
+    RETRIEVAL_MAX_DOCUMENTS,
+    CONTEXT_MAX_TOKENS,
+)
 
 
-# 儲存每個 session 的歷史記錄 (In-memory)
-store = {}
+# 儲存每個 session 的歷史記錄 (後端依設定為記憶體或 SQLite，皆有淘汰與視窗限制)
+session_store = create_session_store()
 
 def get_session_history(session_id: str):
     """根據 session_id 獲取或創建一個對話歷史記錄"""
-    if session_id not in store:
-        store[session_id] = ChatMessageHistory()
-    return store[session_id]
+    return session_store.get(session_id)
+
+# 同步模式下用來並行執行檢索前 LLM 呼叫的共用執行緒池
+_pre_retrieval_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="pre-retrieval")
+
+def _submit(fn, *args):
+    """提交到共用執行緒池，並帶上目前的 contextvars (例如 trace ID)。"""
+    return _pre_retrieval_executor.submit(contextvars.copy_context().run, fn, *args)
 
-def create_conversational_rag_chain(model, retriever):
+class _StageTask:
     """
-    建立一個整合了 Pre-Retrieval 和 Post-Retrieval 的完整 RAG 鏈。
-    此版本修正了 RunnableWithMessageHistory 的輸入類型錯誤。
+    在共用執行緒池中以串流方式執行一個檢索前的 LLM 步驟 (輸出為字串)，逾時從提交時開始計算。
+
+    逾時後 result() 取消尚未開始的工作；已開始的工作在下一個串流片段到達時停止，
+    關閉與模型的串流並釋放執行緒，不會在背景繼續佔用共用執行緒池。
+    """
+
+    def __init__(self, runnable, inputs, config, timeout: float):
+        self.timeout = timeout
+        self._deadline = time.monotonic() + timeout
+        self._cancelled = threading.Event()
+        self._future = _submit(self._run, runnable, inputs, config)
+
+    def _run(self, runnable, inputs, config) -> str:
+        parts = []
+        for chunk in runnable.stream(inputs, config):
+            if self._cancelled.is_set():
+                break
+            parts.append(chunk)
+        return "".join(parts)
+
+    def result(self) -> str:
+        try:
+            return self._future.result(timeout=max(0.0, self._deadline - time.monotonic()))
+        except FutureTimeoutError:
+            self.cancel()
+            raise
+
+    def cancel(self):
+        self._cancelled.set()
+        self._future.cancel()
+
+def _ranked_lists(retriever, queries: List[str], config) -> List[RankedList]:
+    """
+    多查詢檢索：支援批次的混合檢索器一次取得所有 (查詢 × 檢索器) 的排序結果，
+    其他檢索器則以 batch 逐一查詢，每個查詢一組結果。
+    """
+    if hasattr(retriever, "ranked_lists"):
+        return retriever.ranked_lists(queries)
+    return [(1.0, docs) for docs in retriever.batch(queries, config)]
+
+def _fuse(retriever, ranked_lists: List[RankedList]) -> List[Document]:
+    if hasattr(retriever, "fuse"):
+        return retriever.fuse(ranked_lists)
+    return reciprocal_rank_fusion(ranked_lists, limit=RETRIEVAL_MAX_DOCUMENTS)
+
+def _expansion_fallback(reason: str) -> List[str]:
+    print(f"查詢擴展{reason}，僅使用未擴展的查詢結果。")
+    STAGE_ERRORS.inc(1, "expansion")
+    return []
+
+def create_standalone_question_runnable(rewrite_question_chain,
+                                        stage_timeout: float = PRE_RETRIEVAL_STAGE_TIMEOUT):
     """
+    建立快速模式的「獨立問題」步驟。
+
+    沒有對話歷史時略過問題重寫，直接使用原始問題；
+    重寫逾時或失敗時同樣退回原始問題。
+    """
+
+    def get_standalone_question(inputs, config):
+        if not inputs.get("chat_history"):
+            return inputs["input"]
+        task = _StageTask(rewrite_question_chain, inputs, config, stage_timeout)
+        try:
+            return task.result()
+        except FutureTimeoutError:
+            print(f"問題重寫逾時 ({stage_timeout}s)，改用原始問題。")
+        except Exception as e:
+            print(f"問題重寫失敗，改用原始問題: {e}")
+        STAGE_ERRORS.inc(1, "rewrite")
+        return inputs["input"]
+
+    async def aget_standalone_question(inputs, config):
+        if not inputs.get("chat_history"):
+            return inputs["input"]
+        try:
+            return await asyncio.wait_for(rewrite_question_chain.ainvoke(inputs, config), stage_timeout)
+        except asyncio.TimeoutError:
+            print(f"問題重寫逾時 ({stage_timeout}s)，改用原始問題。")
+        except Exception as e:
+            print(f"問題重寫失敗，改用原始問題: {e}")
+        STAGE_ERRORS.inc(1, "rewrite")
+        return inputs["input"]
+
+    return RunnableLambda(get_standalone_question, afunc=aget_standalone_question)
+
+def create_parallel_retrieval_runnable(query_expansion_chain, retriever,
+                                       stage_timeout: float = PRE_RETRIEVAL_STAGE_TIMEOUT,
+                                       reranker: Optional[DocumentReranker] = None,
+                                       expansion_count: int = QUERY_EXPANSION_COUNT):
+    """
+    建立快速模式的「檢索」步驟。
+
+    以獨立問題進行的檢索與查詢擴展的 LLM 呼叫同時進行；擴展回來的每個查詢變體
+    再各自檢索 (批次嵌入、批次向量查詢、每個變體各自 BM25)，
+    所有查詢與檢索器的排序結果以 RRF 融合。擴展逾時或失敗時只使用原始查詢的結果。
+    提供 reranker 時，融合後的結果依分數截斷為前 k 個。
+    回傳依相關性排序的片段，上下文組裝與 LongContextReorder 由後續步驟處理。
+    同時提供同步 (執行緒池) 與非同步 (asyncio) 兩種實作。
+    """
+
+    def retrieve_context(inputs, config):
+        with stage_timer("retrieval") as span:
+            question = inputs["standalone_question"]
+            expansion = None
+            if expansion_count > 0:
+                # 逾時從提交時開始計算 (與非同步版本的 wait_for 相同)，不是從原始查詢檢索完成後才開始
+                expansion = _StageTask(query_expansion_chain, {"question": question}, config, stage_timeout)
+            try:
+                ranked_lists = _ranked_lists(retriever, [question], config)
+            except BaseException:
+                if expansion is not None:
+                    expansion.cancel()
+                raise
+
+            variants = []
+            if expansion is not None:
+                try:
+                    variants = parse_expanded_queries(expansion.result(), question, expansion_count)
+                except FutureTimeoutError:
+                    variants = _expansion_fallback(f"逾時 ({stage_timeout}s)")
+                except Exception as e:
+                    variants = _expansion_fallback(f"失敗 ({e})")
+            if variants:
+                print(f"--- 各自檢索的擴展查詢 ---\n" + "\n".join(variants) + "\n--------------------------")
+                ranked_lists += _ranked_lists(retriever, variants, config)
+            docs = _fuse(retriever, ranked_lists)
+            span.set(documents=len(docs), queries=1 + len(variants))
+        if reranker is not None:
+            docs = reranker.rerank(question, docs)
+        return docs
+
+    async def aretrieve_context(inputs, config):
+        with stage_timer("retrieval") as span:
+            question = inputs["standalone_question"]
+            expansion = None
+            if expansion_count > 0:
+                expansion = asyncio.ensure_future(asyncio.wait_for(
+                    query_expansion_chain.ainvoke({"question": question}, config), stage_timeout
+                ))
+            try:
+                ranked_lists = await asyncio.to_thread(_ranked_lists, retriever, [question], config)
+            except BaseException:
+                if expansion is not None:
+                    expansion.cancel()
+                raise
+
+            variants = []
+            if expansion is not None:
+                try:
+                    variants = parse_expanded_queries(await expansion, question, expansion_count)
+                except asyncio.TimeoutError:
+                    variants = _expansion_fallback(f"逾時 ({stage_timeout}s)")
+                except Exception as e:
+                    variants = _expansion_fallback(f"失敗 ({e})")
+            if variants:
+                print(f"--- 各自檢索的擴展查詢 ---\n" + "\n".join(variants) + "\n--------------------------")
+                ranked_lists += await asyncio.to_thread(_ranked_lists, retriever, variants, config)
+            docs = _fuse(retriever, ranked_lists)
+            span.set(documents=len(docs), queries=1 + len(variants))
+        if reranker is not None:
+            docs = await asyncio.to_thread(reranker.rerank, question, docs)
+        return docs
+
+    return RunnableLambda(retrieve_context, afunc=aretrieve_context)
+
+def _with_retrieval_cache(context_runnable, cache):
+    """在檢索步驟外包一層檢索快取 (獨立問題 → chunk ID)。"""
+
+    def retrieve(inputs, config):
+        question = inputs["standalone_question"]
+        docs = cache.get_documents(question)
+        if docs is None:
+            version = cache.current_version()
+            docs = context_runnable.invoke(inputs, config)
+            cache.put_documents(question, docs, version)
+        return docs
+
+    async def aretrieve(inputs, config):
+        question = inputs["standalone_question"]
+        docs = await asyncio.to_thread(cache.get_documents, question)
+        if docs is None:
+            version = cache.current_version()
+            docs = await context_runnable.ainvoke(inputs, config)
+            cache.put_documents(question, docs, version)
+        return docs
+
+    return RunnableLambda(retrieve, afunc=aretrieve)
+
+def _answer_recorder(cache, question: str, version: int):
+    """原樣轉送串流中的答案片段，串流結束後將完整答案寫入語意答案快取。"""
+
+    def record(chunks):
+        parts = []
+        for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        cache.put_answer(question, "".join(parts), version)
+
+    async def arecord(chunks):
+        parts = []
+        async for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        await asyncio.to_thread(cache.put_answer, question, "".join(parts), version)
+
+    return RunnableGenerator(record, arecord)
+
+def create_rewrite_question_chain(model):
+    """建立「結合歷史紀錄重寫問題」鏈。"""
     # 【修改處】：直接使用從 config 導入的 CONTEXTUALIZE_Q_SYSTEM_PROMPT
     contextualize_q_prompt = ChatPromptTemplate.from_messages([
         ("system", CONTEXTUALIZE_Q_SYSTEM_PROMPT),
         MessagesPlaceholder("chat_history"),
         ("human", "{input}"),
     ])
-    rewrite_question_chain = contextualize_q_prompt | model | StrOutputParser()
-
-    # --- 步驟 2: 建立「文件檢索與後處理」鏈 ---
-    query_expansion_chain = create_query_expansion_chain(model)
-
-    def retrieval_and_postprocessing_chain(rewritten_question: str):
-        expanded_queries = query_expansion_chain.invoke({"question": rewritten_question})
-        full_query = rewritten_question + "\n" + expanded_queries
-        print(f"--- 執行檢索的完整查詢 ---\n{full_query}\n--------------------------")
-        retrieved_docs = retriever.invoke(full_query)
-        reranked_docs = reorder_documents(retrieved_docs)
-        return reranked_docs
+    chain = contextualize_q_prompt | model | StrOutputParser()
+    return chain.with_config(run_name="rewrite_question", metadata=stage_metadata("rewrite"))
 
-    # --- 步驟 3: 建立最終問答鏈 ---
+def create_question_answer_chain(model):
+    """建立將檢索到的文件填入 QA 提示並生成答案的鏈。"""
     qa_prompt = ChatPromptTemplate.from_messages([
         ("system", QA_SYSTEM_PROMPT),
         MessagesPlaceholder("chat_history"),
         ("human", "{input}"),
     ])
-    question_answer_chain = create_stuff_documents_chain(model, qa_prompt)
+    chain = create_stuff_documents_chain(model, qa_prompt)
+    return chain.with_config(run_name="generate_answer", metadata=stage_metadata("generation"))
 
-    # --- 步驟 4: 使用 LCEL 串起所有流程 ---
-    rag_chain = (
-        RunnablePassthrough.assign(
-            rewritten_question=rewrite_question_chain
-        ).assign(
-            context=lambda x: retrieval_and_postprocessing_chain(x["rewritten_question"])
+def _create_pipeline_steps(model, retriever, fast_pipeline: bool, reranker: Optional[DocumentReranker],
+                           context_max_tokens: int, expansion_count: int):
+    """
+    建立 RAG 鏈共用的各個步驟，回傳 (獨立問題, 檢索, 上下文組裝, 問答) 四個 Runnable；
+    對話式 RAG 鏈與批次問答鏈以相同的步驟組成。
+    """
+    rewrite_question_chain = create_rewrite_question_chain(model)
+
+    # --- 步驟 2: 建立「文件檢索與後處理」鏈 ---
+    query_expansion_chain = create_query_expansion_chain(model, expansion_count).with_config(
+        run_name="query_expansion", metadata=stage_metadata("expansion")
+    )
+
+    def retrieval_and_postprocessing_chain(rewritten_question: str):
+        queries = [rewritten_question]
+        if expansion_count > 0:
+            expanded_queries = query_expansion_chain.invoke({"question": rewritten_question})
+            queries += parse_expanded_queries(expanded_queries, rewritten_question, expansion_count)
+        print(f"--- 執行檢索的查詢 ---\n" + "\n".join(queries) + "\n--------------------------")
+        retrieved_docs = _fuse(retriever, _ranked_lists(retriever, queries, None))
+        if reranker is not None:
+            retrieved_docs = reranker.rerank(rewritten_question, retrieved_docs)
+        return retrieved_docs
+
+    def build_context(docs):
+        """將依相關性排序的片段組裝成符合預算的上下文，再把重要的文件放到頭尾。"""
+        return reorder_documents(assemble_context(docs, context_max_tokens))
+
+    context_assembly_step = RunnableLambda(build_context)
+
+    # --- 步驟 3: 建立最終問答鏈 ---
+    question_answer_chain = create_question_answer_chain(model)
+
+    if fast_pipeline:
+        standalone_question_step = create_standalone_question_runnable(rewrite_question_chain)
+        context_step = create_parallel_retrieval_runnable(query_expansion_chain, retriever,
+                                                          reranker=reranker,
+                                                          expansion_count=expansion_count)
+    else:
+        standalone_question_step = rewrite_question_chain
+        context_step = RunnableLambda(
+            lambda x: retrieval_and_postprocessing_chain(x["standalone_question"])
         )
-        | question_answer_chain
+    return standalone_question_step, context_step, context_assembly_step, question_answer_chain
+
+def create_conversational_rag_chain(model, retriever, fast_pipeline: bool = RAG_FAST_PIPELINE,
+                                    cache: Optional[GenerationCache] = None,
+                                    reranker: Optional[DocumentReranker] = None,
+                                    context_max_tokens: int = CONTEXT_MAX_TOKENS,
+                                    expansion_count: int = QUERY_EXPANSION_COUNT):
+    """
+    建立一個整合了 Pre-Retrieval 和 Post-Retrieval 的完整 RAG 鏈。
+    此版本修正了 RunnableWithMessageHistory 的輸入類型錯誤。
+
+    fast_pipeline 為 True 時使用並行/條件式的檢索前處理；
+    提供 cache (綁定此世代的 GenerationCache) 時，依獨立問題查詢檢索快取與語意答案快取；
+    提供 reranker 時，只有分數最高的前 k 個片段會被送進 QA 提示；
+    送進提示前再去除重複/重疊的文字、合併相鄰片段，並限制在 context_max_tokens 之內。
+    expansion_count 為查詢擴展產生的變體數，每個變體各自檢索後與原始查詢以 RRF 融合。
+    """
+    standalone_question_step, context_step, context_assembly_step, question_answer_chain = (
+        _create_pipeline_steps(model, retriever, fast_pipeline, reranker, context_max_tokens, expansion_count)
     )
 
+    # --- 步驟 4: 使用 LCEL 串起所有流程 ---
+    if cache is None:
+        rag_chain = (
+            RunnablePassthrough.assign(
+                standalone_question=standalone_question_step
+            ).assign(
+                context=context_step | context_assembly_step
+            )
+            | question_answer_chain
+        )
+    else:
+        cached_context_step = _with_retrieval_cache(context_step, cache)
+
+        def route_answer(inputs):
+            """語意答案快取命中時直接回傳快取答案，否則走完整的檢索與生成流程。"""
+            question = inputs["standalone_question"]
+            version = cache.current_version()
+            cached_answer = cache.get_answer(question)
+            if cached_answer is not None:
+                return RunnableLambda(lambda _: cached_answer)
+            return (
+                RunnablePassthrough.assign(context=cached_context_step | context_assembly_step)
+                | question_answer_chain
+                | _answer_recorder(cache, question, version)
+            )
+
+        rag_chain = (
+            RunnablePassthrough.assign(standalone_question=standalone_question_step)
+            | RunnableLambda(route_answer)
+        )
+
     # --- 【關鍵修正處】 ---
     # 我們建立一個新的鏈，其唯一的目的就是將 rag_chain 的字串輸出
     # 打包成一個符合規範的字典。
@@ -70,7 +380,10 @@ def create_conversational_rag_chain(model, retriever):
         return {"answer": answer_string}
 
     # 建立一個最終的可執行鏈，它包含了格式化輸出的步驟
-    final_chain = rag_chain | RunnableLambda(format_output)
+    # 每個 LLM 與檢索器呼叫的耗時、文件數與提示/回應大小都透過回呼記錄到 /metrics
+    final_chain = (rag_chain | RunnableLambda(format_output)).with_config(
+        callbacks=[stage_metrics_handler]
+    )
 
     # --- 步驟 5: 綁定對話歷史管理功能 ---
     conversational_rag_chain_with_summary = RunnableWithMessageHistory(
@@ -83,3 +396,32 @@ def create_conversational_rag_chain(model, retriever):
 
     return conversational_rag_chain_with_summary
 
+def create_batch_rag_chain(model, retriever, fast_pipeline: bool = RAG_FAST_PIPELINE,
+                           cache: Optional[GenerationCache] = None,
+                           reranker: Optional[DocumentReranker] = None,
+                           context_max_tokens: int = CONTEXT_MAX_TOKENS,
+                           expansion_count: int = QUERY_EXPANSION_COUNT):
+    """
+    建立批次問答用的 RAG 鏈：與對話式 RAG 鏈使用相同的檢索與生成步驟，但不綁定 session 歷史、
+    不查詢語意答案快取 (每題都重新生成)，並回傳中間結果供批次輸出使用。
+
+    輸入 {"input": 問題, "chat_history": 訊息列表 (可省略)}，
+    輸出 {"input", "chat_history", "standalone_question", "context": 送進提示的片段, "answer"}。
+    提供 cache 時，相同的獨立問題共用同一次檢索結果。
+    """
+    standalone_question_step, context_step, context_assembly_step, question_answer_chain = (
+        _create_pipeline_steps(model, retriever, fast_pipeline, reranker, context_max_tokens, expansion_count)
+    )
+    if cache is not None:
+        context_step = _with_retrieval_cache(context_step, cache)
+
+    def with_history(inputs):
+        return {**inputs, "chat_history": inputs.get("chat_history") or []}
+
+    batch_chain = (
+        RunnableLambda(with_history)
+        | RunnablePassthrough.assign(standalone_question=standalone_question_step)
+        | RunnablePassthrough.assign(context=context_step | context_assembly_step)
+        | RunnablePassthrough.assign(answer=question_answer_chain)
+    )
+    return batch_chain.with_config(run_name="batch_rag", callbacks=[stage_metrics_handler])
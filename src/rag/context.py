@@ -0,0 +1,139 @@
+# src/rag/context.py
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from .token_utils import estimate_tokens
+from src.metrics import stage_timer
+from src.vector_store.embedding_cache import normalize_text
+from src.config import CONTEXT_MAX_TOKENS
+
+# 同一檔案中兩個片段之間相隔不超過此字元數 (切割時被去掉的空白/分隔符) 即視為相鄰
+ADJACENT_GAP_CHARS = 2
+# 預算剩餘不足此 token 數時不再截斷片段放入，避免塞進只有半句話的碎片
+MIN_TRUNCATED_TOKENS = 40
+
+
+class _Span:
+    """同一來源中一段連續的文字，可能由多個重疊或相鄰的片段合併而成。"""
+
+    def __init__(self, doc: Document, rank: int):
+        self.rank = rank
+        self.text = doc.page_content
+        self.start: Optional[int] = doc.metadata.get("start_index")
+        self.end: Optional[int] = self.start + len(self.text) if self.start is not None else None
+        self.metadata = dict(doc.metadata)
+        self.chunk_ids = [doc.id] if doc.id else []
+
+    def try_merge(self, doc: Document, rank: int) -> bool:
+        """若 doc 與此段重疊或緊鄰，將其併入並回傳 True (只去掉重疊的部分)。"""
+        start = doc.metadata.get("start_index")
+        if self.start is None or start is None or start > self.end + ADJACENT_GAP_CHARS or start < self.start:
+            return False
+        end = start + len(doc.page_content)
+        if end > self.end:
+            if start >= self.end:
+                self.text += "\n" + doc.page_content if start > self.end else doc.page_content
+            else:
+                self.text += doc.page_content[self.end - start:]
+            self.end = end
+        self.rank = min(self.rank, rank)
+        if doc.id:
+            self.chunk_ids.append(doc.id)
+        return True
+
+    def to_document(self, text: Optional[str] = None) -> Document:
+        metadata = dict(self.metadata)
+        if self.start is not None:
+            metadata["start_index"] = self.start
+            metadata["end_index"] = self.end
+        if len(self.chunk_ids) > 1:
+            metadata["chunk_ids"] = list(self.chunk_ids)
+        return Document(page_content=text if text is not None else self.text, metadata=metadata,
+                        id=self.chunk_ids[0] if self.chunk_ids else None)
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """依比例截斷文字，使估計 token 數不超過 max_tokens。"""
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    cut = int(len(text) * max_tokens / tokens)
+    while cut > 0 and estimate_tokens(text[:cut]) > max_tokens:
+        cut = int(cut * 0.9)
+    return text[:cut]
+
+
+def assemble_context(documents: List[Document], max_tokens: int = CONTEXT_MAX_TOKENS) -> List[Document]:
+    """
+    將檢索結果整理成送進 QA 提示的上下文。
+
+    - 內容相同、或完全被其他片段包含的片段只保留一份。
+    - 同一檔案 (同一頁) 中重疊或相鄰的片段依 start_index 合併為一段連續文字，
+      切割時的重疊部分只出現一次。
+    - 依相關性順序 (輸入順序) 放入，總估計 token 數不超過 max_tokens，
+      超出預算的最後一段會被截斷，其餘捨棄。
+
+    Args:
+        documents: 依相關性由高到低排序的片段 (例如重新評分後的結果)。
+
+    Returns:
+        依相關性排序、已去重合併並符合預算的文件列表。
+    """
+    if not documents:
+        return []
+
+    with stage_timer("context_assembly", documents=len(documents)) as span:
+        # 1. 以正規化後的內容去除完全重複的片段 (例如 BM25 與向量檢索都找到同一片段)
+        unique: List[Tuple[int, Document]] = []
+        seen = set()
+        for rank, doc in enumerate(documents):
+            key = normalize_text(doc.page_content)
+            if key and key not in seen:
+                seen.add(key)
+                unique.append((rank, doc))
+
+        # 2. 同一來源 (同一頁) 的片段依位置排序後合併重疊/相鄰的部分
+        groups: Dict[tuple, List[Tuple[int, Document]]] = {}
+        spans: List[_Span] = []
+        for rank, doc in unique:
+            if doc.metadata.get("start_index") is None:
+                spans.append(_Span(doc, rank))
+            else:
+                groups.setdefault((doc.metadata.get("source"), doc.metadata.get("page")), []).append((rank, doc))
+        for items in groups.values():
+            items.sort(key=lambda item: item[1].metadata["start_index"])
+            current = None
+            for rank, doc in items:
+                if current is None or not current.try_merge(doc, rank):
+                    current = _Span(doc, rank)
+                    spans.append(current)
+
+        # 3. 完全包含在其他段落中的段落捨棄 (例如沒有位置資訊的舊索引片段)
+        spans.sort(key=lambda s: s.rank)
+        kept_spans: List[_Span] = []
+        for candidate in spans:
+            if any(candidate.text in other.text for other in kept_spans):
+                continue
+            contained = [other for other in kept_spans if other.text in candidate.text]
+            for other in contained:
+                candidate.rank = min(candidate.rank, other.rank)
+            kept_spans = [other for other in kept_spans if other not in contained] + [candidate]
+        kept_spans.sort(key=lambda s: s.rank)
+
+        # 4. 依相關性順序填入 token 預算
+        assembled: List[Document] = []
+        remaining = max_tokens
+        for candidate in kept_spans:
+            tokens = estimate_tokens(candidate.text)
+            if tokens <= remaining:
+                assembled.append(candidate.to_document())
+                remaining -= tokens
+                continue
+            if remaining >= MIN_TRUNCATED_TOKENS:
+                assembled.append(candidate.to_document(_truncate_to_tokens(candidate.text, remaining)))
+            remaining = 0
+            break
+
+        span.set(kept=len(assembled), tokens=max_tokens - remaining)
+    return assembled
@@ -0,0 +1,57 @@
+# src/rag/engine.py
+import threading
+from typing import Callable, List, Optional
+
+
+class RAGGeneration:
+    """一組一起建立、一起被替換的檢索器與 RAG 鏈 (以及共用同一個檢索器的批次問答鏈)。"""
+
+    def __init__(self, version: int, retriever, chain, batch_chain=None):
+        self.version = version
+        self.retriever = retriever
+        self.chain = chain
+        self.batch_chain = batch_chain
+
+
+class RAGEngine:
+    """
+    持有目前使用中的 RAG 世代 (generation)。
+
+    請求開始時以 current() 取得當下世代並用到結束；新的世代在背景建立完成後
+    以 swap() 原子性地替換，進行中的請求仍在舊世代上完成，不會看到建到一半的索引。
+    建立 RAG 鏈前可先以 reserve_version() 取得新世代的版本號 (例如綁定快取)，再交給 swap()。
+    """
+
+    def __init__(self):
+        self._current: Optional[RAGGeneration] = None
+        self._last_version = 0
+        self._lock = threading.Lock()
+        self._listeners: List[Callable[[RAGGeneration], None]] = []
+
+    def current(self) -> Optional[RAGGeneration]:
+        return self._current
+
+    def current_version(self) -> int:
+        """目前使用中的世代版本號，尚未有任何世代時為 0。"""
+        generation = self._current
+        return generation.version if generation is not None else 0
+
+    def reserve_version(self) -> int:
+        with self._lock:
+            self._last_version += 1
+            return self._last_version
+
+    def add_listener(self, listener: Callable[[RAGGeneration], None]):
+        """註冊在世代替換後被呼叫的回呼 (例如更新 LINE manager 的 RAG 鏈)。"""
+        self._listeners.append(listener)
+
+    def swap(self, retriever, chain, batch_chain=None, version: Optional[int] = None) -> RAGGeneration:
+        if version is None:
+            version = self.reserve_version()
+        with self._lock:
+            generation = RAGGeneration(version, retriever, chain, batch_chain)
+            self._current = generation
+        for listener in self._listeners:
+            listener(generation)
+        print(f"✅ RAG 世代已切換至第 {generation.version} 代。")
+        return generation
@@ -0,0 +1,208 @@
+# src/rag/history.py
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Sequence
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+
+from .token_utils import estimate_tokens
+from src.config import (
+    SESSION_STORE_BACKEND,
+    SESSION_DB_PATH,
+    SESSION_MAX_SESSIONS,
+    SESSION_IDLE_TTL_SECONDS,
+    SESSION_MAX_MESSAGES,
+    SESSION_MAX_TOKENS,
+)
+
+
+def window_messages(messages: List[BaseMessage], max_messages: int, max_tokens: int) -> List[BaseMessage]:
+    """只保留最近的訊息，使其同時符合則數與估計 token 數的上限。"""
+    window = []
+    total_tokens = 0
+    for message in reversed(messages[-max_messages:] if max_messages > 0 else []):
+        tokens = estimate_tokens(message.content if isinstance(message.content, str) else str(message.content))
+        if window and total_tokens + tokens > max_tokens:
+            break
+        window.append(message)
+        total_tokens += tokens
+    window.reverse()
+    # 讓視窗從使用者訊息開始，避免提示中出現沒有對應問題的回答
+    while len(window) > 1 and window[0].type != "human":
+        window.pop(0)
+    return window
+
+
+class WindowedChatMessageHistory(BaseChatMessageHistory):
+    """
+    記憶體中的對話歷史，只保存並回傳最近一段視窗內的訊息，
+    避免越來越長的歷史被送進問題重寫與問答提示。
+    """
+
+    def __init__(self, max_messages: int, max_tokens: int):
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self._messages: List[BaseMessage] = []
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return window_messages(self._messages, self.max_messages, self.max_tokens)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self._messages.extend(messages)
+        # 超出則數視窗的舊訊息不會再被讀取，直接丟棄
+        if len(self._messages) > self.max_messages:
+            del self._messages[:len(self._messages) - self.max_messages]
+
+    def clear(self) -> None:
+        self._messages = []
+
+
+class InMemorySessionStore:
+    """行程內的 session 儲存，以 LRU + 閒置 TTL 淘汰。"""
+
+    def __init__(self, max_sessions: int = SESSION_MAX_SESSIONS,
+                 idle_ttl_seconds: float = SESSION_IDLE_TTL_SECONDS,
+                 max_messages: int = SESSION_MAX_MESSAGES,
+                 max_tokens: int = SESSION_MAX_TOKENS):
+        self.max_sessions = max_sessions
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self._sessions: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> BaseChatMessageHistory:
+        now = time.monotonic()
+        with self._lock:
+            # OrderedDict 依最後存取時間排序，從最舊的開始淘汰閒置過久的 session
+            while self._sessions:
+                oldest_id, (last_access, _) = next(iter(self._sessions.items()))
+                if now - last_access <= self.idle_ttl_seconds:
+                    break
+                del self._sessions[oldest_id]
+
+            entry = self._sessions.pop(session_id, None)
+            history = entry[1] if entry else WindowedChatMessageHistory(self.max_messages, self.max_tokens)
+            self._sessions[session_id] = (now, history)
+
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            return history
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+class SQLiteChatMessageHistory(BaseChatMessageHistory):
+    """存放於 SQLite 的對話歷史，讀取時同樣套用則數與 token 視窗。"""
+
+    def __init__(self, store: "SQLiteSessionStore", session_id: str):
+        self.store = store
+        self.session_id = session_id
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        rows = self.store.connection().execute(
+            "SELECT message FROM messages WHERE session_id = ? ORDER BY seq DESC LIMIT ?",
+            (self.session_id, self.store.max_messages),
+        ).fetchall()
+        messages = messages_from_dict([json.loads(row[0]) for row in reversed(rows)])
+        return window_messages(messages, self.store.max_messages, self.store.max_tokens)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        conn = self.store.connection()
+        with conn:
+            conn.executemany(
+                "INSERT INTO messages (session_id, message) VALUES (?, ?)",
+                [(self.session_id, json.dumps(message_to_dict(m), ensure_ascii=False)) for m in messages],
+            )
+            # 只保留視窗內的訊息
+            conn.execute(
+                "DELETE FROM messages WHERE session_id = ? AND seq NOT IN ("
+                "SELECT seq FROM messages WHERE session_id = ? ORDER BY seq DESC LIMIT ?)",
+                (self.session_id, self.session_id, self.store.max_messages),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, last_access) VALUES (?, ?)",
+                (self.session_id, time.time()),
+            )
+
+    def clear(self) -> None:
+        conn = self.store.connection()
+        with conn:
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (self.session_id,))
+
+
+class SQLiteSessionStore:
+    """
+    以 SQLite 保存的 session 儲存，讓多個工作行程共用對話歷史，
+    而不是每個行程各自在記憶體中保存一份。閒置過久的 session 會被定期清除。
+    """
+
+    def __init__(self, db_path: str = SESSION_DB_PATH,
+                 idle_ttl_seconds: float = SESSION_IDLE_TTL_SECONDS,
+                 max_messages: int = SESSION_MAX_MESSAGES,
+                 max_tokens: int = SESSION_MAX_TOKENS,
+                 purge_interval_seconds: float = 300):
+        self.db_path = db_path
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.purge_interval_seconds = purge_interval_seconds
+        self._local = threading.local()
+        self._last_purge = 0.0
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        conn = self.connection()
+        with conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, message TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, seq)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, last_access REAL NOT NULL)"
+            )
+
+    def connection(self) -> sqlite3.Connection:
+        """每個執行緒各自使用一個連線 (sqlite3 連線不可跨執行緒共用)。"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            self._local.conn = conn
+        return conn
+
+    def _purge_idle_sessions(self):
+        now = time.time()
+        if now - self._last_purge < self.purge_interval_seconds:
+            return
+        self._last_purge = now
+        cutoff = now - self.idle_ttl_seconds
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "DELETE FROM messages WHERE session_id IN "
+                "(SELECT session_id FROM sessions WHERE last_access < ?)", (cutoff,)
+            )
+            conn.execute("DELETE FROM sessions WHERE last_access < ?", (cutoff,))
+
+    def get(self, session_id: str) -> BaseChatMessageHistory:
+        self._purge_idle_sessions()
+        return SQLiteChatMessageHistory(self, session_id)
+
+
+def create_session_store(backend: str = SESSION_STORE_BACKEND):
+    """依設定建立 session 儲存後端。"""
+    if backend == "sqlite":
+        print(f"對話歷史使用 SQLite 後端: {SESSION_DB_PATH}")
+        return SQLiteSessionStore()
+    if backend != "memory":
+        print(f"警告：未知的對話歷史後端 '{backend}'，改用記憶體後端。")
+    return InMemorySessionStore()
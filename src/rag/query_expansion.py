@@ -1,13 +1,18 @@
+import re
+from typing import List
+
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import Runnable
 
+from src.config import QUERY_EXPANSION_COUNT
+
 # 查詢擴展的提示模板
 # 指示 LLM 根據原始問題生成多個不同角度的查詢
 QUERY_EXPANSION_PROMPT = ChatPromptTemplate.from_template(
     """
 You are an AI assistant specializing in query expansion for retrieval systems.
-Your task is to rewrite a given user query into 1 different versions, aiming to improve document retrieval.
+Your task is to rewrite a given user query into {count} different versions, aiming to improve document retrieval.
 The expanded queries should cover different angles, use synonyms, or rephrase the original intent.
 Return ONLY the expanded queries, separated by newlines.
 
@@ -18,14 +23,29 @@ Expanded Queries:
 """
 )
 
-def create_query_expansion_chain(model) -> Runnable:
+# 模型有時會替每行加上編號或項目符號，例如 "1. "、"- "、"(2)"
+_LIST_MARKER_RE = re.compile(r"^\s*(?:[-*•]|\d+[.)、:]|\(\d+\))\s*")
+
+def create_query_expansion_chain(model, count: int = QUERY_EXPANSION_COUNT) -> Runnable:
     """
     建立一個用於查詢擴展的 LangChain 鏈。
 
     Args:
         model: 用於生成擴展查詢的語言模型。
+        count: 要求模型產生的查詢變體數。
 
     Returns:
-        一個接收問題並返回擴展查詢字串的 Runnable 鏈。
+        一個接收問題並返回擴展查詢字串 (每行一個) 的 Runnable 鏈。
     """
-    return QUERY_EXPANSION_PROMPT | model | StrOutputParser()
+    return QUERY_EXPANSION_PROMPT.partial(count=str(count)) | model | StrOutputParser()
+
+def parse_expanded_queries(text: str, original: str, max_count: int = QUERY_EXPANSION_COUNT) -> List[str]:
+    """將擴展結果拆成個別查詢：去除編號、空行、重複與原始問題本身，最多保留 max_count 個。"""
+    seen = {original.strip()}
+    queries = []
+    for line in (text or "").splitlines():
+        query = _LIST_MARKER_RE.sub("", line).strip()
+        if query and query not in seen:
+            seen.add(query)
+            queries.append(query)
+    return queries[:max_count]
@@ -0,0 +1,19 @@
+# src/rag/token_utils.py
+import re
+
+# 中日文字元大約一字一個 token；其他文字以「字詞」為單位估算
+_CJK = "㐀-䶿一-鿿豈-﫿぀-ヿ"
+_CJK_CHAR_RE = re.compile(f"[{_CJK}]")
+_WORD_RE = re.compile(rf"[A-Za-z0-9]+|[^\sA-Za-z0-9{_CJK}]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    不需載入 tokenizer 的快速 token 數估計，用於控制提示長度的預算。
+    對中文約為一字一 token，英文字詞約為 1.3 token。
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_CHAR_RE.findall(text))
+    words = len(_WORD_RE.findall(text))
+    return cjk + int(words * 1.3 + 0.5)
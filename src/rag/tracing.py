@@ -0,0 +1,105 @@
+# src/rag/tracing.py
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import LLMResult
+
+from src.metrics import observe_stage, STAGE_ERRORS, STAGE_METADATA_KEY
+
+
+def _content_length(content) -> int:
+    return len(content) if isinstance(content, str) else len(str(content))
+
+
+class StageMetricsCallbackHandler(BaseCallbackHandler):
+    """
+    以 LangChain 回呼記錄 LLM 與檢索器呼叫的耗時。
+
+    階段名稱取自 metadata 中的 rag_stage (例如 rewrite / expansion / generation / bm25)，
+    LLM 呼叫另外記錄首字延遲、提示與回應字元數。
+    """
+
+    # 回呼只做計時與記錄，直接在呼叫端執行緒中執行即可
+    run_inline = True
+
+    def __init__(self):
+        self._runs: Dict[UUID, dict] = {}
+        self._lock = threading.Lock()
+
+    def _start(self, run_id: UUID, metadata: Optional[Dict[str, Any]], default_stage: str, **fields):
+        stage = (metadata or {}).get(STAGE_METADATA_KEY, default_stage)
+        with self._lock:
+            self._runs[run_id] = {"stage": stage, "start": time.perf_counter(), "first_token": None, **fields}
+
+    def _finish(self, run_id: UUID) -> Optional[dict]:
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if run is not None:
+            run["elapsed"] = time.perf_counter() - run["start"]
+        return run
+
+    # --- LLM ---
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[BaseMessage]], *,
+                            run_id: UUID, metadata: Optional[Dict[str, Any]] = None, **kwargs: Any):
+        prompt_chars = sum(_content_length(m.content) for batch in messages for m in batch)
+        self._start(run_id, metadata, "llm", prompt_chars=prompt_chars)
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *,
+                     run_id: UUID, metadata: Optional[Dict[str, Any]] = None, **kwargs: Any):
+        self._start(run_id, metadata, "llm", prompt_chars=sum(len(p) for p in prompts))
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        with self._lock:
+            run = self._runs.get(run_id)
+            if run is None or run["first_token"] is not None:
+                return
+            run["first_token"] = time.perf_counter() - run["start"]
+        observe_stage(f"{run['stage']}_first_token", run["first_token"])
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        run = self._finish(run_id)
+        if run is None:
+            return
+        response_chars = sum(len(g.text) for batch in response.generations for g in batch)
+        fields = {"prompt_chars": run["prompt_chars"], "response_chars": response_chars}
+        for batch in response.generations:
+            for generation in batch:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    fields["input_tokens"] = usage.get("input_tokens")
+                    fields["output_tokens"] = usage.get("output_tokens")
+        observe_stage(run["stage"], run["elapsed"], **fields)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        run = self._finish(run_id)
+        if run is not None:
+            STAGE_ERRORS.inc(1, run["stage"])
+            observe_stage(run["stage"], run["elapsed"], error=type(error).__name__)
+
+    # --- 檢索器 ---
+
+    def on_retriever_start(self, serialized: Dict[str, Any], query: str, *,
+                           run_id: UUID, metadata: Optional[Dict[str, Any]] = None, **kwargs: Any):
+        self._start(run_id, metadata, kwargs.get("name") or "retriever", query_chars=len(query))
+
+    def on_retriever_end(self, documents: List[Document], *, run_id: UUID, **kwargs: Any):
+        run = self._finish(run_id)
+        if run is not None:
+            observe_stage(run["stage"], run["elapsed"], documents=len(documents),
+                          query_chars=run["query_chars"])
+
+    def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        run = self._finish(run_id)
+        if run is not None:
+            STAGE_ERRORS.inc(1, run["stage"])
+            observe_stage(run["stage"], run["elapsed"], error=type(error).__name__)
+
+
+# 所有 RAG 鏈共用同一個回呼實例
+stage_metrics_handler = StageMetricsCallbackHandler()
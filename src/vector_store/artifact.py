@@ -0,0 +1,81 @@
+# src/vector_store/artifact.py
+import json
+import os
+import shutil
+import time
+from typing import Optional, Tuple
+
+# 每個成品目錄中描述該版本的中繼資料檔
+ARTIFACT_METADATA_FILENAME = "artifact.json"
+# 成品根目錄中指向目前版本的指標檔
+CURRENT_POINTER_FILENAME = "CURRENT"
+ARTIFACT_FORMAT = 1
+
+
+def new_artifact_version() -> str:
+    """以建置時間產生可排序的成品版本名稱。"""
+    return time.strftime("v%Y%m%d-%H%M%S")
+
+
+def write_artifact_metadata(artifact_path: str, metadata: dict):
+    """寫入成品中繼資料；有此檔案的目錄才是建置完成的成品。"""
+    metadata = dict(metadata, format=ARTIFACT_FORMAT)
+    tmp_path = os.path.join(artifact_path, ARTIFACT_METADATA_FILENAME + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(metadata, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, os.path.join(artifact_path, ARTIFACT_METADATA_FILENAME))
+
+
+def read_artifact_metadata(artifact_path: str) -> Optional[dict]:
+    path = os.path.join(artifact_path, ARTIFACT_METADATA_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+    if metadata.get("format") != ARTIFACT_FORMAT:
+        print(f"警告：成品 {artifact_path} 的格式版本 {metadata.get('format')} 不受支援。")
+        return None
+    return metadata
+
+
+def publish_artifact(artifacts_dir: str, version: str):
+    """以暫存檔 + os.replace 原子性地將 CURRENT 指向新版本；之後啟動的工作行程會載入此版本。"""
+    tmp_path = os.path.join(artifacts_dir, CURRENT_POINTER_FILENAME + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version + "\n")
+    os.replace(tmp_path, os.path.join(artifacts_dir, CURRENT_POINTER_FILENAME))
+
+
+def resolve_artifact(artifacts_dir: str) -> Optional[Tuple[str, dict]]:
+    """回傳 CURRENT 所指成品的 (目錄, 中繼資料)；尚未建置任何成品時回傳 None。"""
+    pointer = os.path.join(artifacts_dir, CURRENT_POINTER_FILENAME)
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer, "r", encoding="utf-8") as f:
+        version = f.read().strip()
+    artifact_path = os.path.join(artifacts_dir, version)
+    metadata = read_artifact_metadata(artifact_path)
+    if metadata is None:
+        return None
+    return artifact_path, metadata
+
+
+def prune_artifacts(artifacts_dir: str, keep: int):
+    """
+    只保留最新的 keep 個成品 (永遠保留 CURRENT 所指的版本)。
+
+    建置中斷而沒有中繼資料的目錄也會被清除。
+    """
+    current = resolve_artifact(artifacts_dir)
+    current_version = os.path.basename(current[0]) if current else None
+    versions = sorted(
+        (name for name in os.listdir(artifacts_dir)
+         if os.path.isdir(os.path.join(artifacts_dir, name))),
+        reverse=True,
+    )
+    complete = [name for name in versions if read_artifact_metadata(os.path.join(artifacts_dir, name))]
+    for name in versions:
+        if name == current_version or (name in complete and complete.index(name) < keep):
+            continue
+        shutil.rmtree(os.path.join(artifacts_dir, name), ignore_errors=True)
+        print(f"已移除舊的索引成品 {name}。")
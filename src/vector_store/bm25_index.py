@@ -0,0 +1,240 @@
+# src/vector_store/bm25_index.py
+import math
+import os
+import pickle
+import re
+import unicodedata
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+# CJK 統一表意文字 (含擴充 A)、相容表意文字與日文假名
+_CJK_RANGES = "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3040-\u30ff"
+_TOKEN_RE = re.compile(f"[{_CJK_RANGES}]+|[a-z0-9]+(?:[._'-][a-z0-9]+)*")
+_CJK_RUN_RE = re.compile(f"^[{_CJK_RANGES}]")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    適用於繁體中文的斷詞器。
+
+    - 中日文字元：輸出單字 (unigram) 與相鄰雙字 (bigram)，
+      不需要詞典即可兼顧召回率 (單字) 與精準度 (雙字)。
+    - 英數字：以單字為單位並轉為小寫。
+    """
+    tokens = []
+    for match in _TOKEN_RE.finditer(unicodedata.normalize("NFKC", text).lower()):
+        run = match.group()
+        if _CJK_RUN_RE.match(run):
+            tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+class BM25Index:
+    """
+    可增量更新、可持久化的 BM25 稀疏索引。
+
+    索引只保存 chunk ID、文件長度與倒排表 (term → {slot: tf})，
+    文件內容本身留在向量資料庫中，不會在記憶體中重複保存一份。
+    查詢時對每個詞的 posting list 以 NumPy 向量化計分。
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, tokenizer: Callable[[str], List[str]] = tokenize):
+        self.k1 = k1
+        self.b = b
+        self.tokenizer = tokenizer
+
+        self.slot_ids: List[Optional[str]] = []   # slot → chunk ID (已刪除者為 None)
+        self.id_to_slot: Dict[str, int] = {}
+        self.doc_len: List[int] = []
+        self.slot_terms: List[Tuple[str, ...]] = []  # 刪除文件時需要知道它出現在哪些倒排表
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.total_len = 0
+
+        self._arrays: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._doc_len_array: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.id_to_slot)
+
+    # --- 增量更新 ---
+
+    def add(self, chunk_id: str, text: str):
+        """新增 (或取代) 一個文件片段。"""
+        if chunk_id in self.id_to_slot:
+            self.remove([chunk_id])
+
+        counts = Counter(self.tokenizer(text))
+        slot = len(self.slot_ids)
+        self.slot_ids.append(chunk_id)
+        self.id_to_slot[chunk_id] = slot
+        length = sum(counts.values())
+        self.doc_len.append(length)
+        self.slot_terms.append(tuple(counts))
+        self.total_len += length
+
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[slot] = tf
+            self._arrays.pop(term, None)
+        self._doc_len_array = None
+
+    def add_documents(self, chunk_ids: List[str], texts: List[str]):
+        for chunk_id, text in zip(chunk_ids, texts):
+            self.add(chunk_id, text)
+
+    def remove(self, chunk_ids: List[str]):
+        """依 chunk ID 移除文件片段；刪除比例過高時自動壓縮 slot。"""
+        for chunk_id in chunk_ids:
+            slot = self.id_to_slot.pop(chunk_id, None)
+            if slot is None:
+                continue
+            for term in self.slot_terms[slot]:
+                posting = self.postings.get(term)
+                if posting is not None:
+                    posting.pop(slot, None)
+                    if not posting:
+                        del self.postings[term]
+                self._arrays.pop(term, None)
+            self.total_len -= self.doc_len[slot]
+            self.slot_ids[slot] = None
+            self.doc_len[slot] = 0
+            self.slot_terms[slot] = ()
+        self._doc_len_array = None
+
+        if len(self.slot_ids) > 64 and len(self.id_to_slot) < len(self.slot_ids) // 2:
+            self._compact()
+
+    def _compact(self):
+        """重新編排 slot，移除已刪除文件留下的空位。"""
+        remap = {}
+        slot_ids, doc_len, slot_terms = [], [], []
+        for old_slot, chunk_id in enumerate(self.slot_ids):
+            if chunk_id is None:
+                continue
+            remap[old_slot] = len(slot_ids)
+            slot_ids.append(chunk_id)
+            doc_len.append(self.doc_len[old_slot])
+            slot_terms.append(self.slot_terms[old_slot])
+
+        self.postings = {
+            term: {remap[slot]: tf for slot, tf in posting.items()}
+            for term, posting in self.postings.items()
+        }
+        self.slot_ids, self.doc_len, self.slot_terms = slot_ids, doc_len, slot_terms
+        self.id_to_slot = {chunk_id: slot for slot, chunk_id in enumerate(slot_ids)}
+        self._arrays.clear()
+        self._doc_len_array = None
+
+    # --- 查詢 ---
+
+    def _posting_arrays(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        arrays = self._arrays.get(term)
+        if arrays is None:
+            posting = self.postings[term]
+            arrays = (
+                np.fromiter(posting.keys(), dtype=np.int64, count=len(posting)),
+                np.fromiter(posting.values(), dtype=np.float32, count=len(posting)),
+            )
+            self._arrays[term] = arrays
+        return arrays
+
+    def search(self, query: str, k: int = 5) -> List[Tuple[str, float]]:
+        """回傳 BM25 分數最高的 k 個 (chunk ID, 分數)。"""
+        n_docs = len(self.id_to_slot)
+        if n_docs == 0:
+            return []
+
+        if self._doc_len_array is None:
+            self._doc_len_array = np.asarray(self.doc_len, dtype=np.float32)
+        doc_len = self._doc_len_array
+        avgdl = self.total_len / n_docs or 1.0
+        scores = np.zeros(len(self.slot_ids), dtype=np.float32)
+
+        for term, query_tf in Counter(self.tokenizer(query)).items():
+            if term not in self.postings:
+                continue
+            slots, tfs = self._posting_arrays(term)
+            df = len(slots)
+            idf = math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * doc_len[slots] / avgdl)
+            scores[slots] += query_tf * idf * tfs * (self.k1 + 1.0) / (tfs + norm)
+
+        candidates = np.flatnonzero(scores)
+        if candidates.size == 0:
+            return []
+        if candidates.size > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(self.slot_ids[slot], float(scores[slot])) for slot in candidates]
+
+    def copy(self) -> "BM25Index":
+        """建立可獨立修改的副本，讓新世代的索引可以在不影響舊檢索器的情況下更新。"""
+        index = BM25Index(k1=self.k1, b=self.b, tokenizer=self.tokenizer)
+        index.slot_ids = list(self.slot_ids)
+        index.id_to_slot = dict(self.id_to_slot)
+        index.doc_len = list(self.doc_len)
+        index.slot_terms = list(self.slot_terms)
+        index.postings = {term: dict(posting) for term, posting in self.postings.items()}
+        index.total_len = self.total_len
+        return index
+
+    # --- 持久化 ---
+
+    def save(self, path: str):
+        """以暫存檔 + os.replace 原子性地寫入磁碟。"""
+        state = {
+            "k1": self.k1,
+            "b": self.b,
+            "slot_ids": self.slot_ids,
+            "doc_len": self.doc_len,
+            "slot_terms": self.slot_terms,
+            "postings": self.postings,
+            "total_len": self.total_len,
+        }
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        index = cls(k1=state["k1"], b=state["b"])
+        index.slot_ids = state["slot_ids"]
+        index.doc_len = state["doc_len"]
+        index.slot_terms = state["slot_terms"]
+        index.postings = state["postings"]
+        index.total_len = state["total_len"]
+        index.id_to_slot = {
+            chunk_id: slot for slot, chunk_id in enumerate(index.slot_ids) if chunk_id is not None
+        }
+        return index
+
+
+class BM25IndexRetriever(BaseRetriever):
+    """
+    以 BM25Index 為基礎的 LangChain 檢索器。
+
+    索引只回傳 chunk ID，文件內容透過 fetch_documents 從向量資料庫取回。
+    """
+
+    index: BM25Index
+    fetch_documents: Callable[[List[str]], List[Document]]
+    k: int = 5
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        hits = self.index.search(query, k=self.k)
+        if not hits:
+            return []
+        return self.fetch_documents([chunk_id for chunk_id, _ in hits])
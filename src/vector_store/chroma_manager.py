@@ -1,5 +1,7 @@
-from typing import List
+import os
+from typing import Callable, FrozenSet, List, Optional, Tuple
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_core.vectorstores import VectorStoreRetriever
 from langchain_chroma import Chroma
 import chromadb # <-- 導入 chromadb 以使用其設定
@@ -8,59 +10,366 @@ import chromadb # <-- 導入 chromadb 以使用其設定
 # 根據 LangChain 的更新，從新的套件導入 HuggingFaceEmbeddings
 from langchain_huggingface import HuggingFaceEmbeddings
 
-from langchain_community.retrievers import BM25Retriever
-from langchain.retrievers import EnsembleRetriever
+from .manifest import IndexManifest, assign_chunk_ids
+from .bm25_index import BM25Index
+from .hybrid_retriever import HybridFanOutRetriever
+from .embedding_cache import CachedEmbeddings
+from .numpy_store import NumpyVectorStore, mmr_select
+from src.config import EMBEDDING_MODEL_NAME, EMBEDDING_BATCH_SIZE, EMBEDDING_CACHE_SHARD_SIZE, VECTOR_STORE_BACKEND
+from src.metrics import stage_metadata
+
+# 索引清單檔名，與 ChromaDB 存放於同一目錄
+MANIFEST_FILENAME = "index_manifest.json"
+# 嵌入快取目錄名稱
+EMBEDDING_CACHE_DIRNAME = "embedding_cache"
+# BM25 稀疏索引檔名
+BM25_INDEX_FILENAME = "bm25_index.pkl"
+# numpy 向量索引後端的目錄名稱
+NUMPY_STORE_DIRNAME = "numpy_vectors"
+
+def load_embedding_model() -> Embeddings:
+    """載入嵌入模型 (bge-m3)；pre-fork 部署時在主行程載入一次，由各工作行程共用。"""
+    return HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
 
 class ChromaManager:
-    def __init__(self, db_path: str, collection_name: str):
+    def __init__(self, db_path: str, collection_name: str, embedding_function: Optional[Embeddings] = None,
+                 read_only: bool = False, bm25_index: Optional[BM25Index] = None,
+                 backend: str = VECTOR_STORE_BACKEND):
+        """
+        Args:
+            backend: 向量索引後端，chroma 或 numpy (見 NumpyVectorStore)；
+                兩者的新增/刪除/持久化語意相同，可用基準測試直接比較。
+            read_only: 以唯讀方式載入建置好的索引成品 (見 build_index)；
+                不做舊集合遷移、不寫入任何索引檔，所有更新操作都會失敗。
+            bm25_index: 已預先載入的 BM25 索引 (pre-fork 時由主行程載入)，省略則從 db_path 讀取。
+        """
         self.db_path = db_path
         self.collection_name = collection_name
-        self.embedding_function = HuggingFaceEmbeddings(
-            model_name="BAAI/bge-m3"
+        self.read_only = read_only
+        self.backend = backend
+        if embedding_function is None:
+            embedding_function = load_embedding_model()
+        # 以持久化快取包裝嵌入模型：相同文字 (依模型 + 正規化文字雜湊) 不會被重複嵌入
+        self.embedding_function = CachedEmbeddings(
+            embedding_function,
+            cache_dir=os.path.join(db_path, EMBEDDING_CACHE_DIRNAME),
+            model_name=getattr(embedding_function, "model_name", type(embedding_function).__name__),
+            batch_size=EMBEDDING_BATCH_SIZE,
+            shard_size=EMBEDDING_CACHE_SHARD_SIZE,
+            read_only=read_only,
         )
 
-        # --- 【修正處 2】---
-        # 明確地建立一個 ChromaDB 客戶端，並指定設定。
-        # 這有助於解決在開發伺服器重啟時的 SQLite 鎖定問題。
-        self.client = chromadb.PersistentClient(
-            path=db_path,
-            settings=chromadb.Settings(
-                # 這裡可以加入更多 ChromaDB 的微調設定
-                anonymized_telemetry=False # 建議關閉遙測
-            ),
-        )
+        if backend == "numpy":
+            self.client = None
+            self.vector_store = NumpyVectorStore(
+                os.path.join(db_path, NUMPY_STORE_DIRNAME, collection_name),
+                self.embedding_function,
+                read_only=read_only,
+            )
+        elif backend == "chroma":
+            # --- 【修正處 2】---
+            # 明確地建立一個 ChromaDB 客戶端，並指定設定。
+            # 這有助於解決在開發伺服器重啟時的 SQLite 鎖定問題。
+            self.client = chromadb.PersistentClient(
+                path=db_path,
+                settings=chromadb.Settings(
+                    # 這裡可以加入更多 ChromaDB 的微調設定
+                    anonymized_telemetry=False # 建議關閉遙測
+                ),
+            )
 
-        self.vector_store = Chroma(
-            client=self.client, # <-- 使用我們剛剛建立的客戶端
-            collection_name=collection_name,
-            embedding_function=self.embedding_function,
-        )
+            self.vector_store = Chroma(
+                client=self.client, # <-- 使用我們剛剛建立的客戶端
+                collection_name=collection_name,
+                embedding_function=self.embedding_function,
+            )
+        else:
+            raise ValueError(f"未知的向量索引後端 '{backend}'，可用：chroma、numpy。")
+
+        # 記錄每個來源檔案的內容雜湊與 chunk ID，用於增量索引
+        manifest_path = os.path.join(db_path, MANIFEST_FILENAME)
+        # BM25 索引與 ChromaDB 存放在一起，啟動時直接載入而不是重新建立
+        self.bm25_index_path = os.path.join(db_path, BM25_INDEX_FILENAME)
+        if not read_only and not os.path.exists(manifest_path) and self._vector_count() > 0:
+            # 舊版本沒有清單且使用隨機 ID，無法辨識重複向量，只能清空後重建一次
+            print("偵測到沒有索引清單的舊集合，將清空後以增量模式重新建立。")
+            self.vector_store.reset_collection()
+            if os.path.exists(self.bm25_index_path):
+                os.remove(self.bm25_index_path)
+        self.manifest = IndexManifest(manifest_path)
+        self.bm25_index = bm25_index if bm25_index is not None else self._load_bm25_index()
+        # 「在旁建立」的更新狀態 (見 begin_update)：每次更新遞增 epoch，
+        # 更新期間新增的片段與延後刪除的片段分別記錄，供各世代的向量檢索過濾
+        self._updating = False
+        self._update_epoch = 0
+        self._staged_adds: FrozenSet[str] = frozenset()
+        self._staged_deletes: FrozenSet[str] = frozenset()
+        if not read_only:
+            # 上次更新中斷時留下的延後刪除，在此補做
+            self.finish_update()
+
+    def _load_bm25_index(self) -> BM25Index:
+        if os.path.exists(self.bm25_index_path):
+            return BM25Index.load(self.bm25_index_path)
+        if self.read_only:
+            raise RuntimeError(f"索引成品 {self.db_path} 中缺少 BM25 索引檔。")
+
+        # 舊索引沒有 BM25 檔案時，從 ChromaDB 中的片段重建一次
+        index = BM25Index()
+        documents = self.get_all_documents()
+        if documents:
+            print(f"找不到 BM25 索引檔，正在從 {len(documents)} 個既有片段重建...")
+            index.add_documents([doc.id for doc in documents], [doc.page_content for doc in documents])
+            index.save(self.bm25_index_path)
+        return index
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError("索引以唯讀模式載入，請以 build_index 建置新的索引成品。")
+
+    def _vector_count(self) -> int:
+        if self.backend == "numpy":
+            return self.vector_store.count()
+        return self.vector_store._collection.count()
+
+    def _persist_vectors(self):
+        # ChromaDB 每次寫入即落地；numpy 後端需明確寫入矩陣檔
+        if self.backend == "numpy":
+            self.vector_store.persist()
 
-    def add_documents(self, documents: List[Document]):
-        """將文檔添加到 ChromaDB"""
-        self.vector_store.add_documents(documents)
+    def _save_indexes(self):
+        # 向量先落地再寫清單，中斷時清單不會記錄實際不存在的片段
+        self._persist_vectors()
+        self.manifest.save()
+        self.bm25_index.save(self.bm25_index_path)
+
+    def add_documents(self, documents: List[Document], ids: Optional[List[str]] = None):
+        """將文檔添加到 ChromaDB 與 BM25 索引"""
+        if not documents:
+            return
+        self._check_writable()
+        ids = self.vector_store.add_documents(documents, ids=ids)
+        if self._updating:
+            # 以新的 frozenset 取代 (不就地修改)，進行中的檢索讀到的集合不會改變
+            self._staged_adds = self._staged_adds | frozenset(ids)
+        self.bm25_index.add_documents(ids, [doc.page_content for doc in documents])
         print(f"成功將 {len(documents)} 個文檔片段添加到 ChromaDB。")
 
-    def create_hybrid_retriever(self, documents: List[Document]) -> EnsembleRetriever:
+    def delete_documents(self, ids: List[str]):
+        """依 chunk ID 從 ChromaDB 與 BM25 索引刪除文檔片段"""
+        if not ids:
+            return
+        self._check_writable()
+        self.bm25_index.remove(ids)
+        if self._updating:
+            # 舊世代的檢索器可能仍在讀取這些片段，等 finish_update() 再從 ChromaDB 刪除
+            self.manifest.pending_deletes.extend(ids)
+            self._staged_deletes = self._staged_deletes | frozenset(ids)
+            return
+        self.vector_store.delete(ids=ids)
+        print(f"已從 ChromaDB 刪除 {len(ids)} 個過期的文檔片段。")
+
+    def begin_update(self):
         """
-        建立一個結合了 BM25 關鍵字搜尋和 Chroma 向量搜尋的混合式檢索器。
+        開始一次「在旁建立」的索引更新。
+
+        BM25 索引改在副本上修改，既有檢索器持有的舊索引不受影響；
+        新片段雖然寫入向量索引，但更新開始前建立的檢索器會過濾掉它們，
+        過期片段的刪除則延後到 finish_update() (更新期間建立的新檢索器會過濾掉它們)。
+        因此舊世代在切換前只看得到舊索引，不會看到建到一半的新舊混合結果。
         """
-        if not documents:
-            print("警告：沒有提供文件給 BM25，僅使用向量檢索。")
-            return self.get_vector_retriever()
+        self._check_writable()
+        self.bm25_index = self.bm25_index.copy()
+        self._staged_adds = frozenset()
+        self._update_epoch += 1
+        self._updating = True
 
-        print("正在建立混合式檢索器 (Hybrid Retriever)...")
-        bm25_retriever = BM25Retriever.from_documents(documents)
-        bm25_retriever.k = 5
+    def finish_update(self):
+        """新世代切換完成後，實際刪除延後的過期片段，新片段也對所有檢索器可見。"""
+        if self.manifest.pending_deletes:
+            ids = self.manifest.pending_deletes
+            self.manifest.pending_deletes = []
+            self.vector_store.delete(ids=ids)
+            self._persist_vectors()
+            self.manifest.save()
+            print(f"已從 ChromaDB 刪除 {len(ids)} 個過期的文檔片段。")
+        # 刪除完成後才解除過濾，新世代在這之間也不會看到過期片段
+        self._updating = False
+        self._staged_adds = frozenset()
+        self._staged_deletes = frozenset()
+
+    def _hidden_ids(self, epoch: int) -> FrozenSet[str]:
+        """在 epoch 建立的檢索器目前不應看到的片段。"""
+        if not self._updating:
+            return frozenset()
+        if epoch < self._update_epoch:
+            # 舊世代：看不到這次更新新增的片段 (延後刪除的片段仍在索引中)
+            return self._staged_adds
+        # 更新期間建立的新世代：看得到新片段，但看不到等待刪除的片段
+        return self._staged_deletes
+
+    @property
+    def index_version(self) -> int:
+        """索引內容的版本號，每次新增、更新或刪除來源檔案後遞增。"""
+        return self.manifest.index_version
+
+    def is_source_current(self, source_key: str, file_hash: str) -> bool:
+        """判斷來源檔案自上次索引後是否未變更。"""
+        return self.manifest.get_hash(source_key) == file_hash
+
+    def indexed_sources(self) -> List[str]:
+        return list(self.manifest.sources.keys())
+
+    def upsert_source(self, source_key: str, file_hash: str, documents: List[Document]):
+        """以增量方式更新單一來源檔案的片段 (見 upsert_sources)。"""
+        self.upsert_sources([(source_key, file_hash, documents)])
 
-        vector_retriever = self.get_vector_retriever()
+    def upsert_sources(self, sources: List[Tuple[str, str, List[Document]]]):
+        """
+        以增量方式批次更新多個來源檔案的片段。
+
+        每個片段依內容得到確定性的 ID (切割時已指定的 id 直接沿用)，只有新增的片段會被嵌入並寫入，
+        已不存在的舊片段會被刪除，內容未變的片段則原封不動。
+        整批的新片段以一次呼叫寫入，讓嵌入模型能以完整批次運算。
+        """
+        if not sources:
+            return
+        self._check_writable()
+        all_stale, all_fresh = [], []
+        for source_key, file_hash, documents in sources:
+            if all(doc.id for doc in documents):
+                new_ids = [doc.id for doc in documents]
+            else:
+                new_ids = assign_chunk_ids(source_key, documents)
+
+            old_ids = set(self.manifest.get_chunk_ids(source_key))
+            new_id_set = set(new_ids)
+            stale_ids = [chunk_id for chunk_id in old_ids if chunk_id not in new_id_set]
+            fresh = [(chunk_id, doc) for chunk_id, doc in zip(new_ids, documents) if chunk_id not in old_ids]
+            all_stale.extend(stale_ids)
+            all_fresh.extend(fresh)
+
+            self.manifest.set_source(source_key, file_hash, new_ids)
+            print(f"'{source_key}'：新增 {len(fresh)} 個片段，刪除 {len(stale_ids)} 個片段，"
+                  f"保留 {len(new_ids) - len(fresh)} 個片段。")
+
+        self.delete_documents(all_stale)
+        self.add_documents([doc for _, doc in all_fresh], ids=[chunk_id for chunk_id, _ in all_fresh])
+        self._save_indexes()
+
+    def delete_source(self, source_key: str):
+        """移除已被刪除之來源檔案的所有向量。"""
+        self._check_writable()
+        self.delete_documents(self.manifest.get_chunk_ids(source_key))
+        self.manifest.remove_source(source_key)
+        self._save_indexes()
+        print(f"來源檔案 '{source_key}' 已不存在，已移除其索引。")
+
+    def persist(self):
+        """將嵌入快取中尚未寫入的向量落地，並印出快取命中統計。"""
+        self.embedding_function.flush()
+        stats = self.embedding_function.stats()
+        print(f"嵌入快取：命中 {stats['hits']}、未命中 {stats['misses']} (命中率 {stats['hit_rate']:.1%})。")
+
+    def get_all_documents(self) -> List[Document]:
+        """從 ChromaDB 取回目前索引中的所有文檔片段 (供 BM25 使用)。"""
+        if self.backend == "numpy":
+            return self.vector_store.get_all_documents()
+        result = self.vector_store.get(include=["documents", "metadatas"])
+        return [
+            Document(page_content=content, metadata=metadata or {}, id=chunk_id)
+            for chunk_id, content, metadata in zip(
+                result["ids"], result["documents"], result["metadatas"]
+            )
+        ]
+
+    def get_documents_by_ids(self, ids: List[str]) -> List[Document]:
+        """依 chunk ID 取回文檔片段，並保持傳入 ID 的順序。"""
+        if not ids:
+            return []
+        if self.backend == "numpy":
+            return self.vector_store.get_by_ids(ids)
+        result = self.vector_store.get(ids=ids, include=["documents", "metadatas"])
+        by_id = {
+            chunk_id: Document(page_content=content, metadata=metadata or {}, id=chunk_id)
+            for chunk_id, content, metadata in zip(
+                result["ids"], result["documents"], result["metadatas"]
+            )
+        }
+        return [by_id[chunk_id] for chunk_id in ids if chunk_id in by_id]
+
+    def mmr_search_by_vectors(self, vectors: List[List[float]], k: int = 5, fetch_k: int = 20,
+                              lambda_mult: float = 0.7, exclude: FrozenSet[str] = frozenset()) -> List[List[Document]]:
+        """
+        以多個查詢向量進行 MMR 檢索，每個查詢各回傳 k 個片段。
 
-        ensemble_retriever = EnsembleRetriever(
-            retrievers=[bm25_retriever, vector_retriever], weights=[0.5, 0.5]
+        所有查詢以一次 Chroma 查詢取回 fetch_k 個候選 (含向量)，再各自做 MMR 重選。
+        numpy 後端以一次矩陣乘法計算所有查詢的候選；兩種後端使用同一個向量化 MMR。
+        exclude 中的片段不會成為候選 (多取 len(exclude) 個候選再過濾，結果與索引中沒有它們時相同)。
+        """
+        if not vectors:
+            return []
+        if self.backend == "numpy":
+            return self.vector_store.mmr_search_by_vectors(vectors, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult,
+                                                           exclude=exclude)
+        count = self.vector_store._collection.count()
+        if count == 0:
+            return [[] for _ in vectors]
+        result = self.vector_store._collection.query(
+            query_embeddings=vectors,
+            n_results=min(fetch_k + len(exclude), count),
+            include=["documents", "metadatas", "embeddings"],
+        )
+        results = []
+        for i, vector in enumerate(vectors):
+            ids = result["ids"][i]
+            keep = [j for j, chunk_id in enumerate(ids) if chunk_id not in exclude][:fetch_k]
+            if not keep:
+                results.append([])
+                continue
+            selected = mmr_select(vector, [result["embeddings"][i][j] for j in keep], k=k, lambda_mult=lambda_mult)
+            results.append([
+                Document(page_content=result["documents"][i][keep[j]], metadata=result["metadatas"][i][keep[j]] or {},
+                         id=ids[keep[j]])
+                for j in selected
+            ])
+        return results
+
+    def _generation_vector_search(self) -> Callable[[List[List[float]], int, int, float], List[List[Document]]]:
+        """回傳綁定目前 epoch 的向量檢索：之後開始的更新所新增的片段，對此檢索器不可見。"""
+        epoch = self._update_epoch
+
+        def vector_search(vectors, k, fetch_k, lambda_mult):
+            return self.mmr_search_by_vectors(vectors, k, fetch_k, lambda_mult, exclude=self._hidden_ids(epoch))
+
+        return vector_search
+
+    def create_hybrid_retriever(self) -> HybridFanOutRetriever:
+        """
+        建立一個結合了 BM25 關鍵字搜尋和 Chroma 向量搜尋的混合式檢索器。
+        BM25 使用持久化的增量索引，不需在每次啟動或上傳時重新建立。
+        檢索器支援多個查詢變體一起檢索 (批次嵌入 + 批次向量查詢 + RRF 融合)。
+        """
+        if len(self.bm25_index) == 0:
+            print("警告：BM25 索引中沒有文件，僅使用向量檢索。")
+
+        print("正在建立混合式檢索器 (Hybrid Retriever)...")
+        hybrid_retriever = HybridFanOutRetriever(
+            # 持有目前這份 BM25 索引；begin_update() 之後的修改在副本上進行，不影響此檢索器
+            bm25_index=self.bm25_index,
+            fetch_documents=self.get_documents_by_ids,
+            embed_queries=self.embedding_function.embed_queries,
+            # 向量索引由所有世代共用，依建立時的 epoch 過濾尚未切換 (或已被取代) 的片段
+            vector_search=self._generation_vector_search(),
+            k=5,
+            bm25_k=5,
+            fetch_k=20,
+            lambda_mult=0.7,
+            metadata=stage_metadata("hybrid_retrieval"),
         )
-        
+
         print("✅ 混合式檢索器建立完成！")
-        return ensemble_retriever
+        return hybrid_retriever
 
     def get_vector_retriever(self) -> VectorStoreRetriever:
         """
@@ -73,6 +382,7 @@ class ChromaManager:
                 'k': 5,          # 最終要返回的文檔數量
                 'fetch_k': 20,   # 初始獲取的候選文檔數量
                 'lambda_mult': 0.7 # 控制多樣性。1為最大多樣性，0為最大相關性。
-            }
+            },
+            metadata=stage_metadata("vector_mmr"),
         )
 
@@ -0,0 +1,225 @@
+# src/vector_store/embedding_cache.py
+import atexit
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from typing import Dict, List, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from src.metrics import stage_timer
+from .query_embedder import QueryEmbeddingService
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """正規化文字 (NFKC + 合併空白)，讓只差在空白或全半形的文字共用同一個快取項目。"""
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    包裝任意 Embeddings 的持久化嵌入快取。
+
+    - 快取鍵為 (模型名稱, 正規化文字) 的 SHA-256。
+    - 向量以 float16 存成 NumPy 分片 (shard_XXXXX.npy)，讀取時使用 memory-map，
+      不會把整個快取載入成 Python list。
+    - 分片索引 (鍵 → 分片, 列) 存放於同目錄下的 SQLite；分片編號在 SQLite 寫入交易中配置，
+      多個行程 (例如 build_index 與服務) 共用同一個快取目錄時不會寫到同一個分片。
+    - 只有快取未命中的文字會依 batch_size 分批送進底層模型。
+    - read_only 時 (例如讀取建置好的索引成品) 只查詢快取，新算出的向量不寫回磁碟。
+    - 查詢向量由 QueryEmbeddingService 處理 (記憶體 LRU + 跨請求微批次)，不寫入持久化快取。
+    """
+
+    def __init__(
+        self,
+        underlying: Embeddings,
+        cache_dir: str,
+        model_name: str,
+        batch_size: int = 32,
+        shard_size: int = 4096,
+        read_only: bool = False,
+    ):
+        self.underlying = underlying
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.batch_size = max(1, batch_size)
+        self.shard_size = max(1, shard_size)
+        self.read_only = read_only
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.RLock()
+        db_path = os.path.join(cache_dir, "index.sqlite")
+        if read_only and os.path.exists(db_path):
+            # 多個工作行程共用同一份索引成品：以唯讀模式開啟，不會互相鎖定
+            self._db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            # 其他行程寫入時等待鎖釋放，而不是立即失敗
+            self._db = sqlite3.connect(db_path if not read_only else ":memory:", check_same_thread=False,
+                                       timeout=60)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, shard INTEGER, row INTEGER)"
+            )
+            self._db.commit()
+        row = self._db.execute("SELECT MAX(shard) FROM vectors").fetchone()
+        # 此行程所知的分片數 (僅供統計；其他行程寫入的分片在下次 flush 時才會反映)
+        self._shard_count = (row[0] + 1) if row[0] is not None else 0
+
+        self._shards: Dict[int, np.ndarray] = {}
+        # 尚未寫入分片的新向量 (鍵 → float16 向量)
+        self._pending: Dict[str, np.ndarray] = {}
+        # 查詢向量：先查記憶體 LRU，再查持久化的文件向量，都未命中才合併成批次計算
+        self.queries = QueryEmbeddingService(underlying, self._key, lookup=self._lookup_persisted)
+
+        atexit.register(self.flush)
+
+    # --- 快取鍵與讀寫 ---
+
+    def _key(self, text: str) -> str:
+        raw = f"{self.model_name}\0{normalize_text(text)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _shard_path(self, shard: int) -> str:
+        return os.path.join(self.cache_dir, f"shard_{shard:05d}.npy")
+
+    def _get_shard(self, shard: int) -> np.ndarray:
+        if shard not in self._shards:
+            self._shards[shard] = np.load(self._shard_path(shard), mmap_mode="r")
+        return self._shards[shard]
+
+    def _lookup(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """批次查詢快取，回傳命中的鍵與向量。"""
+        found: Dict[str, np.ndarray] = {}
+        to_query = []
+        for key in keys:
+            if key in self._pending:
+                found[key] = self._pending[key]
+            else:
+                to_query.append(key)
+
+        # SQLite 的參數數量有上限，分批查詢
+        for start in range(0, len(to_query), 500):
+            batch = to_query[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = self._db.execute(
+                f"SELECT key, shard, row FROM vectors WHERE key IN ({placeholders})", batch
+            ).fetchall()
+            for key, shard, row in rows:
+                found[key] = self._get_shard(shard)[row]
+        return found
+
+    def flush(self):
+        """將尚未持久化的向量寫成新的分片，並更新 SQLite 索引。"""
+        with self._lock:
+            if not self._pending or self.read_only:
+                return
+            items: List[Tuple[str, np.ndarray]] = list(self._pending.items())
+            for start in range(0, len(items), self.shard_size):
+                batch = items[start:start + self.shard_size]
+                matrix = np.stack([vector for _, vector in batch]).astype(np.float16)
+
+                # 在寫入交易中配置分片編號：BEGIN IMMEDIATE 取得資料庫的寫入鎖後才讀取目前最大編號，
+                # 其他共用此目錄的行程要等此交易提交後才能配置下一個編號
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    row = self._db.execute("SELECT MAX(shard) FROM vectors").fetchone()
+                    shard = (row[0] + 1) if row[0] is not None else 0
+
+                    # 先寫暫存檔再 rename，確保索引指到的分片一定是完整的
+                    tmp_path = f"{self._shard_path(shard)}.{os.getpid()}.tmp"
+                    with open(tmp_path, "wb") as f:
+                        np.save(f, matrix)
+                    os.replace(tmp_path, self._shard_path(shard))
+
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO vectors (key, shard, row) VALUES (?, ?, ?)",
+                        [(key, shard, row) for row, (key, _) in enumerate(batch)],
+                    )
+                    self._db.commit()
+                    self._shard_count = shard + 1
+                except BaseException:
+                    self._db.rollback()
+                    raise
+            self._pending.clear()
+
+    # --- Embeddings 介面 ---
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self._lock:
+            keys = [self._key(text) for text in texts]
+            cached = self._lookup(keys)
+
+            # 同一批中重複的文字只需計算一次
+            missing: Dict[str, str] = {}
+            for key, text in zip(keys, texts):
+                if key not in cached and key not in missing:
+                    missing[key] = text
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+
+        missing_items = list(missing.items())
+        for start in range(0, len(missing_items), self.batch_size):
+            batch = missing_items[start:start + self.batch_size]
+            with stage_timer("embed_documents", documents=len(batch)):
+                vectors = self.underlying.embed_documents([text for _, text in batch])
+            with self._lock:
+                for (key, _), vector in zip(batch, vectors):
+                    stored = np.asarray(vector, dtype=np.float16)
+                    if not self.read_only:
+                        self._pending[key] = stored
+                    cached[key] = stored
+
+        with self._lock:
+            if len(self._pending) >= self.shard_size:
+                self.flush()
+
+        return [cached[key].astype(np.float32).tolist() for key in keys]
+
+    def _lookup_persisted(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        with self._lock:
+            return self._lookup(keys)
+
+    def prime_queries(self, texts: List[str]) -> int:
+        """
+        以批次預先計算一組查詢的向量 (例如批次問答的所有問題)，之後的 embed_query /
+        embed_queries 直接取用，不會在各題中各自呼叫模型。回傳實際計算的查詢數。
+        """
+        return self.queries.prime(texts, self.batch_size)
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        一次嵌入多個查詢：未命中的查詢與其他請求同時到達的查詢合併成一次批次計算。
+        底層模型的 embed_query 與 embed_documents 對同一段文字須產生相同向量 (bge-m3 即是如此)。
+        """
+        return [vector.tolist() for vector in self.queries.embed(texts)]
+
+    def embed_query(self, text: str) -> List[float]:
+        """查詢向量優先從快取讀取；未命中時經由微批次計算，結果只留在記憶體 LRU 中。"""
+        return self.queries.embed([text])[0].tolist()
+
+    # --- 統計 ---
+
+    def stats(self) -> dict:
+        """回傳快取命中統計，用於觀察重新索引時省下多少嵌入運算。"""
+        total = self.hits + self.misses
+        return {
+            "model": self.model_name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "pending": len(self._pending),
+            "shards": self._shard_count,
+            "queries": self.queries.stats(),
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
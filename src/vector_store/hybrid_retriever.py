@@ -0,0 +1,106 @@
+# src/vector_store/hybrid_retriever.py
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from .bm25_index import BM25Index
+from src.metrics import stage_timer
+from src.config import RRF_K, RETRIEVAL_MAX_DOCUMENTS
+
+# (權重, 依相關性排序的文件)；每個查詢變體的每個檢索器各產生一組
+RankedList = Tuple[float, List[Document]]
+
+# BM25 與向量查詢同時進行用的執行緒池 (向量查詢在 Chroma 的原生程式碼中執行，不佔用 GIL)
+_bm25_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="bm25")
+
+
+def reciprocal_rank_fusion(ranked_lists: List[RankedList], k: int = RRF_K,
+                           limit: Optional[int] = None) -> List[Document]:
+    """
+    以加權 Reciprocal Rank Fusion 融合多組排序結果：score(d) = Σ weight / (k + rank)。
+
+    同一片段 (依 chunk ID，沒有 ID 時依內容) 在多組結果中出現時分數相加，
+    因此被多個查詢變體或多個檢索器同時找到的片段會排在前面。
+    """
+    scores: Dict[str, float] = {}
+    documents: Dict[str, Document] = {}
+    for weight, docs in ranked_lists:
+        for rank, doc in enumerate(docs, start=1):
+            key = doc.id or doc.page_content
+            scores[key] = scores.get(key, 0.0) + weight / (k + rank)
+            documents.setdefault(key, doc)
+    ordered = sorted(scores, key=scores.get, reverse=True)
+    if limit is not None:
+        ordered = ordered[:limit]
+    return [documents[key] for key in ordered]
+
+
+class HybridFanOutRetriever(BaseRetriever):
+    """
+    BM25 + 向量 MMR 的多查詢混合檢索器。
+
+    多個查詢變體一起檢索：所有查詢向量以一次批次嵌入計算，向量檢索以一次批次查詢完成，
+    BM25 則對每個變體各自計分；最後以 RRF 跨查詢、跨檢索器融合成單一排序。
+    """
+
+    bm25_index: Optional[BM25Index] = None
+    fetch_documents: Callable[[List[str]], List[Document]]
+    embed_queries: Callable[[List[str]], List[List[float]]]
+    # (查詢向量列表, k, fetch_k, lambda_mult) → 每個查詢各一組 MMR 結果
+    vector_search: Callable[[List[List[float]], int, int, float], List[List[Document]]]
+    k: int = 5
+    bm25_k: int = 5
+    fetch_k: int = 20
+    lambda_mult: float = 0.7
+    bm25_weight: float = 0.5
+    vector_weight: float = 0.5
+    rrf_k: int = RRF_K
+    max_documents: int = RETRIEVAL_MAX_DOCUMENTS
+
+    def _bm25_search(self, queries: List[str]) -> List[List[Document]]:
+        with stage_timer("bm25", queries=len(queries)) as span:
+            hits = [[chunk_id for chunk_id, _ in self.bm25_index.search(q, k=self.bm25_k)] for q in queries]
+            # 各變體找到的片段往往重疊，合併後只向資料庫取一次
+            unique_ids = list(dict.fromkeys(chunk_id for ids in hits for chunk_id in ids))
+            by_id = {doc.id: doc for doc in self.fetch_documents(unique_ids)}
+            span.set(documents=len(unique_ids))
+        return [[by_id[chunk_id] for chunk_id in ids if chunk_id in by_id] for ids in hits]
+
+    def ranked_lists(self, queries: List[str]) -> List[RankedList]:
+        """回傳每個查詢變體在每個檢索器上的排序結果，供 reciprocal_rank_fusion 融合。"""
+        queries = [q for q in queries if q.strip()]
+        if not queries:
+            return []
+        use_bm25 = self.bm25_index is not None and len(self.bm25_index) > 0
+        bm25_future = None
+        if use_bm25:
+            bm25_future = _bm25_executor.submit(contextvars.copy_context().run, self._bm25_search, queries)
+
+        with stage_timer("query_embedding", documents=len(queries)):
+            vectors = self.embed_queries(queries)
+        with stage_timer("vector_mmr", queries=len(queries)) as span:
+            vector_results = self.vector_search(vectors, self.k, self.fetch_k, self.lambda_mult)
+            span.set(documents=sum(len(docs) for docs in vector_results))
+
+        lists = [(self.vector_weight, docs) for docs in vector_results]
+        if bm25_future is not None:
+            lists.extend((self.bm25_weight, docs) for docs in bm25_future.result())
+        return lists
+
+    def fuse(self, ranked_lists: List[RankedList]) -> List[Document]:
+        with stage_timer("fusion", lists=len(ranked_lists)) as span:
+            docs = reciprocal_rank_fusion(ranked_lists, k=self.rrf_k, limit=self.max_documents)
+            span.set(documents=len(docs))
+        return docs
+
+    def retrieve_many(self, queries: List[str]) -> List[Document]:
+        return self.fuse(self.ranked_lists(queries))
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return self.retrieve_many([query])
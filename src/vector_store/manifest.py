@@ -0,0 +1,108 @@
+# src/vector_store/manifest.py
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional
+
+from langchain_core.documents import Document
+
+
+def compute_file_hash(file_path: str, chunk_size: int = 1 << 20, salt: str = "") -> str:
+    """
+    以串流方式計算檔案內容的 SHA-256，避免一次讀入大檔案。
+
+    salt 一併納入雜湊 (例如切割方式的識別字串)，salt 改變時所有檔案都會被視為已變更。
+    """
+    digest = hashlib.sha256(salt.encode("utf-8"))
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def make_chunk_id(source_key: str, content: str, occurrence: int = 0) -> str:
+    """
+    依據來源檔案與片段內容產生確定性的 chunk ID。
+
+    同一檔案中完全相同的片段以 occurrence 區分，
+    因此內容未變的片段在重新索引時會得到相同的 ID，不需重新嵌入。
+    """
+    raw = f"{source_key}\0{occurrence}\0{content}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def assign_chunk_ids(source_key: str, documents: List[Document]) -> List[str]:
+    """為同一來源檔案的所有片段 (依檔案中的順序) 產生 chunk ID，並寫入各片段的 id。"""
+    ids = []
+    occurrences: Dict[str, int] = {}
+    for doc in documents:
+        occurrence = occurrences.get(doc.page_content, 0)
+        occurrences[doc.page_content] = occurrence + 1
+        doc.id = make_chunk_id(source_key, doc.page_content, occurrence)
+        ids.append(doc.id)
+    return ids
+
+
+class IndexManifest:
+    """
+    記錄每個來源檔案的內容雜湊與其 chunk ID 的清單檔 (JSON)。
+
+    結構：
+        {"version": 1, "index_version": 3, "sources": {"<相對路徑>": {"hash": "...", "chunk_ids": [...]}}}
+
+    index_version 在每次索引內容變更時遞增 (記錄於索引成品與 /metrics)；
+    快取失效改以切換完成的 RAG 世代為準，更新進行中的遞增不會影響仍在服務的舊世代。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.sources: Dict[str, dict] = {}
+        self.index_version = 0
+        # 延後刪除的 chunk ID：新世代切換完成前，舊檢索器仍可能需要它們
+        self.pending_deletes: List[str] = []
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.sources = data.get("sources", {})
+            self.index_version = data.get("index_version", 0)
+            self.pending_deletes = data.get("pending_deletes", [])
+        except (OSError, ValueError) as e:
+            print(f"警告：無法讀取索引清單 {self.path}，將視為空清單重新建立。({e})")
+            self.sources = {}
+
+    def save(self):
+        """以暫存檔 + os.replace 原子性地寫回清單，避免中途中斷造成檔案損毀。"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "version": 1,
+                    "index_version": self.index_version,
+                    "pending_deletes": self.pending_deletes,
+                    "sources": self.sources,
+                },
+                f, ensure_ascii=False,
+            )
+        os.replace(tmp_path, self.path)
+
+    def get_hash(self, source_key: str) -> Optional[str]:
+        entry = self.sources.get(source_key)
+        return entry["hash"] if entry else None
+
+    def get_chunk_ids(self, source_key: str) -> List[str]:
+        entry = self.sources.get(source_key)
+        return list(entry["chunk_ids"]) if entry else []
+
+    def set_source(self, source_key: str, file_hash: str, chunk_ids: List[str]):
+        self.sources[source_key] = {"hash": file_hash, "chunk_ids": list(chunk_ids)}
+        self.index_version += 1
+
+    def remove_source(self, source_key: str):
+        if self.sources.pop(source_key, None) is not None:
+            self.index_version += 1
@@ -0,0 +1,490 @@
+# src/vector_store/numpy_store.py
+import os
+import pickle
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from src.config import NUMPY_VECTOR_DTYPE, NUMPY_IVF_LISTS, NUMPY_IVF_PROBE, NUMPY_IVF_MIN_VECTORS
+
+# 向量矩陣 (無標頭的原始二進位檔，只會附加或整個改寫) 與其餘狀態的檔名
+VECTORS_FILENAME = "vectors.bin"
+STATE_FILENAME = "state.pkl"
+# 暴力搜尋時每次轉成 float32 計算的列數，限制暫存記憶體
+SCORE_BLOCK_ROWS = 32768
+# 每個 IVF 分群至少應有的向量數，不足時減少分群數
+IVF_MIN_POINTS_PER_LIST = 39
+KMEANS_ITERATIONS = 10
+KMEANS_MAX_SAMPLE = 65536
+_INT8_SCALE = 127.0
+_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def mmr_select(query_vector, candidates, k: int, lambda_mult: float) -> List[int]:
+    """
+    向量化的 Maximal Marginal Relevance 重選，回傳被選中的候選索引 (依選取順序)。
+
+    每一步只需一次矩陣-向量乘法更新「與已選片段的最大相似度」，
+    不像逐一計算 cosine_similarity 的實作那樣每步重算整個相似度矩陣。
+    """
+    candidates = normalize_rows(candidates)
+    if len(candidates) == 0 or k <= 0:
+        return []
+    query = normalize_rows(np.asarray(query_vector, dtype=np.float32).reshape(1, -1))[0]
+    relevance = candidates @ query
+    redundancy = np.full(len(candidates), -np.inf, dtype=np.float32)
+    available = np.ones(len(candidates), dtype=bool)
+    selected: List[int] = []
+    for _ in range(min(k, len(candidates))):
+        if selected:
+            scores = lambda_mult * relevance - (1.0 - lambda_mult) * redundancy
+        else:
+            scores = relevance.copy()
+        scores[~available] = -np.inf
+        index = int(np.argmax(scores))
+        selected.append(index)
+        available[index] = False
+        redundancy = np.maximum(redundancy, candidates @ candidates[index])
+    return selected
+
+
+def _spherical_kmeans(vectors: np.ndarray, n_lists: int, seed: int = 0) -> np.ndarray:
+    """以抽樣的 spherical k-means 訓練 IVF 粗分群中心 (已正規化)。"""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > KMEANS_MAX_SAMPLE:
+        vectors = vectors[np.sort(rng.choice(len(vectors), KMEANS_MAX_SAMPLE, replace=False))]
+    vectors = normalize_rows(vectors)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = np.bincount(assignment, minlength=n_lists) == 0
+        # 空的分群以隨機向量重新初始化
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    行程內的向量索引，可作為 Chroma 的替代後端 (VECTOR_STORE_BACKEND=numpy)。
+
+    - 向量正規化後以 float16 / int8 (或 float32) 存成原始矩陣檔，讀取時使用 memory-map；
+      多個工作行程載入同一份檔案時共用作業系統的分頁快取。
+    - 新增的向量先留在記憶體中，persist() 時附加到檔案尾端；刪除只做標記，
+      刪除比例過高時於 persist() 重寫整個矩陣 (與 BM25Index 的壓縮相同)。
+    - top-k 以分塊的 NumPy 矩陣乘法計算，多個查詢向量一次算完；
+      向量數達 NUMPY_IVF_MIN_VECTORS 且設定 NUMPY_IVF_LISTS 時，改為只掃描最近的
+      NUMPY_IVF_PROBE 個 IVF 粗分群 (近似搜尋)。
+    - 片段文字與 metadata 與向量依 slot 對齊，一併存放於 state.pkl。
+    """
+
+    def __init__(self, path: str, embedding_function: Embeddings, dtype: str = NUMPY_VECTOR_DTYPE,
+                 ivf_lists: int = NUMPY_IVF_LISTS, ivf_probe: int = NUMPY_IVF_PROBE,
+                 ivf_min_vectors: int = NUMPY_IVF_MIN_VECTORS, read_only: bool = False):
+        if dtype not in _DTYPES:
+            raise ValueError(f"不支援的向量儲存型別 '{dtype}'，可用：{', '.join(_DTYPES)}。")
+        self.path = path
+        self._embedding = embedding_function
+        self.dtype = dtype
+        self.ivf_lists = ivf_lists
+        self.ivf_probe = max(1, ivf_probe)
+        self.ivf_min_vectors = ivf_min_vectors
+        self.read_only = read_only
+        self._lock = threading.RLock()
+
+        self.dim: Optional[int] = None
+        self.slot_ids: List[Optional[str]] = []   # slot → chunk ID (已刪除者為 None)
+        self.id_to_slot: Dict[str, int] = {}
+        self.contents: List[Optional[str]] = []
+        self.metadatas: List[Optional[dict]] = []
+        self._base: Optional[np.ndarray] = None   # 已寫入檔案的列 (memory-map)
+        self._base_rows = 0
+        self._tail: List[np.ndarray] = []         # 尚未寫入檔案的列
+        self._centroids: Optional[np.ndarray] = None
+        self._assignment = np.zeros(0, dtype=np.int32)  # slot → IVF 分群 (-1 表示未分群)
+        self._snapshot = None
+        self._load()
+
+    # --- 持久化 ---
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.path, VECTORS_FILENAME)
+
+    @property
+    def _state_path(self) -> str:
+        return os.path.join(self.path, STATE_FILENAME)
+
+    def _open_base(self):
+        if self._base_rows == 0 or self.dim is None:
+            self._base = None
+            return
+        self._base = np.memmap(self._vectors_path, dtype=_DTYPES[self.dtype], mode="r",
+                               shape=(self._base_rows, self.dim))
+
+    def _load(self):
+        if not os.path.exists(self._state_path):
+            return
+        with open(self._state_path, "rb") as f:
+            state = pickle.load(f)
+        if state["dtype"] != self.dtype:
+            raise RuntimeError(f"向量索引 {self.path} 以 {state['dtype']} 儲存，與設定的 {self.dtype} 不符；"
+                               f"請刪除後重新建立索引。")
+        self.dim = state["dim"]
+        self.slot_ids = state["slot_ids"]
+        self.contents = state["contents"]
+        self.metadatas = state["metadatas"]
+        self._base_rows = state["rows"]
+        self._centroids = state["centroids"]
+        self._assignment = state["assignment"]
+        self.id_to_slot = {chunk_id: slot for slot, chunk_id in enumerate(self.slot_ids) if chunk_id is not None}
+        self._open_base()
+
+    def persist(self):
+        """
+        將記憶體中的新向量附加到矩陣檔，並以暫存檔 + os.replace 原子性地寫入狀態檔。
+
+        狀態檔記錄的列數才是有效範圍，附加到一半中斷時多出的列會被忽略。
+        """
+        if self.read_only:
+            return
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            deleted = len(self.slot_ids) - len(self.id_to_slot)
+            if len(self.slot_ids) > 64 and deleted > len(self.slot_ids) // 2:
+                self._compact()
+            elif self._tail:
+                with open(self._vectors_path, "ab") as f:
+                    f.seek(self._base_rows * self.dim * np.dtype(_DTYPES[self.dtype]).itemsize)
+                    f.truncate()
+                    for rows in self._tail:
+                        f.write(np.ascontiguousarray(rows).tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._base_rows = len(self.slot_ids)
+                self._tail = []
+                self._open_base()
+            self._maybe_train_ivf()
+
+            state = {
+                "dtype": self.dtype,
+                "dim": self.dim,
+                "rows": self._base_rows,
+                "slot_ids": self.slot_ids,
+                "contents": self.contents,
+                "metadatas": self.metadatas,
+                "centroids": self._centroids,
+                "assignment": self._assignment,
+            }
+            tmp_path = self._state_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._state_path)
+            self._snapshot = None
+
+    def _compact(self):
+        """重寫矩陣檔，移除已刪除片段留下的空位 (IVF 分群需重新訓練)。"""
+        alive = [slot for slot, chunk_id in enumerate(self.slot_ids) if chunk_id is not None]
+        matrix = self._gather_stored(np.asarray(alive, dtype=np.int64))
+        tmp_path = self._vectors_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(np.ascontiguousarray(matrix).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._vectors_path)
+
+        self.slot_ids = [self.slot_ids[slot] for slot in alive]
+        self.contents = [self.contents[slot] for slot in alive]
+        self.metadatas = [self.metadatas[slot] for slot in alive]
+        self.id_to_slot = {chunk_id: slot for slot, chunk_id in enumerate(self.slot_ids)}
+        self._base_rows = len(alive)
+        self._tail = []
+        self._centroids = None
+        self._assignment = np.full(len(alive), -1, dtype=np.int32)
+        self._open_base()
+
+    def _maybe_train_ivf(self):
+        """向量數達門檻時訓練 IVF 分群，之後新增的列只指派到最近的分群。"""
+        if self.ivf_lists <= 0 or self._base is None or len(self.id_to_slot) < self.ivf_min_vectors:
+            return
+        if self._centroids is None:
+            n_lists = max(1, min(self.ivf_lists, self._base_rows // IVF_MIN_POINTS_PER_LIST))
+            print(f"正在為 {self._base_rows} 個向量訓練 {n_lists} 個 IVF 分群...")
+            self._centroids = _spherical_kmeans(self._dequantize(self._base), n_lists)
+            self._assignment = np.full(self._base_rows, -1, dtype=np.int32)
+        unassigned = np.flatnonzero(self._assignment[:self._base_rows] < 0)
+        for start in range(0, len(unassigned), SCORE_BLOCK_ROWS):
+            slots = unassigned[start:start + SCORE_BLOCK_ROWS]
+            self._assignment[slots] = np.argmax(
+                self._dequantize(self._base[slots]) @ self._centroids.T, axis=1
+            )
+
+    # --- 量化 ---
+
+    def _quantize(self, vectors: np.ndarray) -> np.ndarray:
+        if self.dtype == "int8":
+            return np.clip(np.rint(vectors * _INT8_SCALE), -127, 127).astype(np.int8)
+        return vectors.astype(_DTYPES[self.dtype])
+
+    def _dequantize(self, rows: np.ndarray) -> np.ndarray:
+        rows = np.asarray(rows, dtype=np.float32)
+        return rows / _INT8_SCALE if self.dtype == "int8" else rows
+
+    def _gather_stored(self, slots: np.ndarray) -> np.ndarray:
+        """依 slot 取回儲存格式的向量列 (檔案中的列或記憶體中的新列)。"""
+        if self.dim is None:
+            return np.zeros((0, 0), dtype=_DTYPES[self.dtype])
+        tail = np.concatenate(self._tail) if self._tail else None
+        rows = np.empty((len(slots), self.dim), dtype=_DTYPES[self.dtype])
+        in_base = slots < self._base_rows
+        if in_base.any():
+            rows[in_base] = self._base[slots[in_base]]
+        if (~in_base).any():
+            rows[~in_base] = tail[slots[~in_base] - self._base_rows]
+        return rows
+
+    # --- 新增 / 刪除 ---
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError("向量索引以唯讀模式載入。")
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, *,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        self._check_writable()
+        texts = list(texts)
+        if not texts:
+            return []
+        if ids is None:
+            raise ValueError("NumpyVectorStore 需要明確的片段 ID。")
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = normalize_rows(self._embedding.embed_documents(texts))
+
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"向量維度 {vectors.shape[1]} 與索引的 {self.dim} 不符。")
+            self._delete_locked([chunk_id for chunk_id in ids if chunk_id in self.id_to_slot])
+            first_slot = len(self.slot_ids)
+            for offset, (chunk_id, text, metadata) in enumerate(zip(ids, texts, metadatas)):
+                self.slot_ids.append(chunk_id)
+                self.id_to_slot[chunk_id] = first_slot + offset
+                self.contents.append(text)
+                self.metadatas.append(dict(metadata or {}))
+            self._tail.append(self._quantize(vectors))
+            self._assignment = np.concatenate([self._assignment, np.full(len(texts), -1, dtype=np.int32)])
+            self._snapshot = None
+        return list(ids)
+
+    def _delete_locked(self, ids: List[str]):
+        for chunk_id in ids:
+            slot = self.id_to_slot.pop(chunk_id, None)
+            if slot is None:
+                continue
+            self.slot_ids[slot] = None
+            self.contents[slot] = None
+            self.metadatas[slot] = None
+        self._snapshot = None
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        self._check_writable()
+        if not ids:
+            return None
+        with self._lock:
+            self._delete_locked(ids)
+        return True
+
+    def reset_collection(self):
+        """清空所有向量與片段 (與 Chroma.reset_collection 相同用途)。"""
+        self._check_writable()
+        with self._lock:
+            self.dim = None
+            self.slot_ids, self.contents, self.metadatas = [], [], []
+            self.id_to_slot = {}
+            self._base, self._base_rows, self._tail = None, 0, []
+            self._centroids = None
+            self._assignment = np.zeros(0, dtype=np.int32)
+            self._snapshot = None
+            for filename in (VECTORS_FILENAME, STATE_FILENAME):
+                if os.path.exists(os.path.join(self.path, filename)):
+                    os.remove(os.path.join(self.path, filename))
+
+    # --- 讀取 ---
+
+    def count(self) -> int:
+        return len(self.id_to_slot)
+
+    def _document(self, slot: int, records=None) -> Optional[Document]:
+        slot_ids, contents, metadatas = records or (self.slot_ids, self.contents, self.metadatas)
+        chunk_id = slot_ids[slot]
+        if chunk_id is None:
+            return None
+        return Document(page_content=contents[slot], metadata=dict(metadatas[slot]), id=chunk_id)
+
+    def get_by_ids(self, ids: List[str], /) -> List[Document]:
+        documents = []
+        for chunk_id in ids:
+            slot = self.id_to_slot.get(chunk_id)
+            doc = self._document(slot) if slot is not None else None
+            if doc is not None:
+                documents.append(doc)
+        return documents
+
+    def get_all_documents(self) -> List[Document]:
+        return [doc for doc in (self._document(slot) for slot in range(len(self.slot_ids))) if doc is not None]
+
+    # --- 搜尋 ---
+
+    def _get_snapshot(self):
+        """取得搜尋用的一致狀態；新增或刪除後才重新建立，搜尋本身不持有鎖。"""
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None:
+                tail = np.concatenate(self._tail) if self._tail else None
+                alive = np.fromiter((chunk_id is not None for chunk_id in self.slot_ids),
+                                    dtype=bool, count=len(self.slot_ids))
+                ivf = None
+                if self._centroids is not None and len(self.id_to_slot) >= self.ivf_min_vectors:
+                    base_assignment = self._assignment[:self._base_rows]
+                    order = np.argsort(base_assignment, kind="stable").astype(np.int64)
+                    bounds = np.searchsorted(base_assignment[order], np.arange(len(self._centroids) + 1))
+                    ivf = (self._centroids, order, bounds)
+                # 壓縮會重新編排 slot，快照保留當時的片段列表，進行中的搜尋不受影響
+                records = (self.slot_ids, self.contents, self.metadatas)
+                self._snapshot = (self._base, self._base_rows, tail, alive, ivf, records)
+            return self._snapshot
+
+    def _rows(self, snapshot, slots: np.ndarray) -> np.ndarray:
+        base, base_rows, tail = snapshot[:3]
+        rows = np.empty((len(slots), self.dim), dtype=np.float32)
+        in_base = slots < base_rows
+        if in_base.any():
+            rows[in_base] = self._dequantize(base[slots[in_base]])
+        if (~in_base).any():
+            rows[~in_base] = self._dequantize(tail[slots[~in_base] - base_rows])
+        return rows
+
+    def _score_all(self, snapshot, queries: np.ndarray) -> np.ndarray:
+        """暴力搜尋：分塊計算所有查詢對所有列的相似度 (m × rows)。"""
+        base, base_rows, tail, alive = snapshot[:4]
+        scores = np.empty((len(queries), len(alive)), dtype=np.float32)
+        for start in range(0, base_rows, SCORE_BLOCK_ROWS):
+            end = min(start + SCORE_BLOCK_ROWS, base_rows)
+            scores[:, start:end] = (self._dequantize(base[start:end]) @ queries.T).T
+        if tail is not None:
+            scores[:, base_rows:] = (self._dequantize(tail) @ queries.T).T
+        scores[:, ~alive] = -np.inf
+        return scores
+
+    def _candidate_slots(self, snapshot, query: np.ndarray) -> np.ndarray:
+        """IVF：最近的 ivf_probe 個分群中的列，加上尚未寫入檔案 (未分群) 的新列。"""
+        _, base_rows, _, alive, (centroids, order, bounds), _ = snapshot
+        probe = np.argsort(-(centroids @ query))[:self.ivf_probe]
+        slots = [order[bounds[i]:bounds[i + 1]] for i in probe]
+        slots.append(np.arange(base_rows, len(alive), dtype=np.int64))
+        slots = np.concatenate(slots)
+        return slots[alive[slots]]
+
+    def search_by_vectors(self, vectors, k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """回傳每個查詢向量的 (slot, 相似度)，依相似度由高到低排序，最多 k 個。"""
+        return self._search(self._get_snapshot(), vectors, k)
+
+    def _search(self, snapshot, vectors, k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        if self.dim is None or not len(vectors) or not len(snapshot[3]):
+            return [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)) for _ in vectors]
+        queries = normalize_rows(np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1))
+
+        if snapshot[4] is not None:
+            results = []
+            for query in queries:
+                slots = self._candidate_slots(snapshot, query)
+                results.append((slots, self._rows(snapshot, slots) @ query))
+        else:
+            all_slots = np.arange(len(snapshot[3]), dtype=np.int64)
+            results = [(all_slots, row) for row in self._score_all(snapshot, queries)]
+
+        top = []
+        for slots, scores in results:
+            valid = np.isfinite(scores)
+            slots, scores = slots[valid], scores[valid]
+            if len(scores) > k:
+                keep = np.argpartition(-scores, k - 1)[:k]
+                slots, scores = slots[keep], scores[keep]
+            order = np.argsort(-scores)
+            top.append((slots[order], scores[order]))
+        return top
+
+    def mmr_search_by_vectors(self, vectors, k: int = 5, fetch_k: int = 20,
+                              lambda_mult: float = 0.7, exclude: frozenset = frozenset()) -> List[List[Document]]:
+        """多個查詢一次取回 fetch_k 個候選 (不含 exclude 中的片段)，再各自以向量化 MMR 重選 k 個。"""
+        snapshot = self._get_snapshot()
+        results = []
+        for vector, (slots, _) in zip(vectors, self._search(snapshot, vectors, fetch_k + len(exclude))):
+            if exclude:
+                slot_ids = snapshot[5][0]
+                slots = np.asarray([slot for slot in slots if slot_ids[slot] not in exclude][:fetch_k], dtype=np.int64)
+            selected = mmr_select(vector, self._rows(snapshot, slots), k, lambda_mult) if len(slots) else []
+            docs = [self._document(int(slots[i]), snapshot[5]) for i in selected]
+            results.append([doc for doc in docs if doc is not None])
+        return results
+
+    # --- VectorStore 介面 ---
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4) -> List[Tuple[Document, float]]:
+        snapshot = self._get_snapshot()
+        slots, scores = self._search(snapshot, [embedding], k)[0]
+        pairs = [(self._document(int(slot), snapshot[5]), float(score)) for slot, score in zip(slots, scores)]
+        return [(doc, score) for doc, score in pairs if doc is not None]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self._embedding.embed_query(query), k)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(self._embedding.embed_query(query), k)
+
+    def max_marginal_relevance_search_by_vector(self, embedding: List[float], k: int = 4, fetch_k: int = 20,
+                                                lambda_mult: float = 0.5, **kwargs: Any) -> List[Document]:
+        return self.mmr_search_by_vectors([embedding], k, fetch_k, lambda_mult)[0]
+
+    def max_marginal_relevance_search(self, query: str, k: int = 4, fetch_k: int = 20,
+                                      lambda_mult: float = 0.5, **kwargs: Any) -> List[Document]:
+        return self.max_marginal_relevance_search_by_vector(
+            self._embedding.embed_query(query), k, fetch_k, lambda_mult
+        )
+
+    def _select_relevance_score_fn(self):
+        # 分數即為正規化向量的餘弦相似度
+        return lambda score: score
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None, *,
+                   ids: Optional[List[str]] = None, path: Optional[str] = None,
+                   **kwargs: Any) -> "NumpyVectorStore":
+        if path is None:
+            raise ValueError("NumpyVectorStore.from_texts 需要指定 path。")
+        store = cls(path, embedding, **kwargs)
+        store.add_texts(texts, metadatas, ids=ids)
+        store.persist()
+        return store
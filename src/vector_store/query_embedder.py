@@ -0,0 +1,196 @@
+# src/vector_store/query_embedder.py
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from src.metrics import registry, stage_timer
+from src.config import QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_MAX_BATCH, QUERY_EMBEDDING_MAX_WAIT_MS
+
+QUERY_EMBEDDING_BATCH = registry.summary(
+    "rag_query_embedding_batch_size", "Queries per micro-batched query-embedding forward pass.")
+
+# (快取鍵, 查詢文字, 等待結果的 Future)
+_Request = Tuple[str, str, Future]
+
+
+class QueryEmbeddingService:
+    """
+    查詢向量服務：以正規化查詢文字為鍵的記憶體 LRU 快取，加上跨請求的動態微批次。
+
+    - 快取命中 (重複的問題) 直接回傳，不經過模型；
+    - 未命中的查詢交給背景執行緒：第一筆到達後最多再等 max_wait_ms，
+      期間其他請求 (網頁、LINE、批次問答) 的查詢一起組成一次前向運算，最多 max_batch_size 筆；
+    - 同一個查詢正在計算時，後到的請求等待同一個結果，不會重複計算。
+
+    max_wait_ms <= 0 時不等待，未命中的查詢在呼叫端的執行緒中直接計算。
+    背景執行緒在第一次使用時才啟動，pre-fork 部署時各工作行程會各自啟動自己的執行緒。
+    """
+
+    def __init__(self, embeddings: Embeddings, key_fn: Callable[[str], str],
+                 lookup: Optional[Callable[[List[str]], Dict[str, np.ndarray]]] = None,
+                 cache_size: int = QUERY_EMBEDDING_CACHE_SIZE,
+                 max_batch_size: int = QUERY_EMBEDDING_MAX_BATCH,
+                 max_wait_ms: float = QUERY_EMBEDDING_MAX_WAIT_MS):
+        """
+        Args:
+            key_fn: 查詢文字 → 快取鍵 (含正規化)。
+            lookup: LRU 未命中時先查詢的其他來源 (例如持久化的文件向量快取)，回傳命中的鍵與向量。
+        """
+        self.embeddings = embeddings
+        self._key = key_fn
+        self._lookup = lookup
+        self.cache_size = max(1, cache_size)
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._queue: Deque[_Request] = deque()
+        self._cond = threading.Condition()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_pid: Optional[int] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+
+    # --- 快取 ---
+
+    def _put(self, key: str, vector: np.ndarray):
+        # 呼叫端須持有 self._cond
+        self._cache[key] = vector
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _claim(self, keys: List[str], texts: List[str]) -> Tuple[Dict[str, np.ndarray], Dict[str, Future], List[_Request]]:
+        """
+        依序查詢 LRU 與 lookup，回傳 (已有的向量, 要等待的 Future, 需要由呼叫端安排計算的新請求)。
+        """
+        found: Dict[str, np.ndarray] = {}
+        waits: Dict[str, Future] = {}
+        with self._cond:
+            for key in keys:
+                if key in found:
+                    continue
+                vector = self._cache.get(key)
+                if vector is not None:
+                    self._cache.move_to_end(key)
+                    found[key] = vector
+            self.hits += sum(1 for key in keys if key in found)
+        unresolved = [(key, text) for key, text in dict(zip(keys, texts)).items() if key not in found]
+        if unresolved and self._lookup is not None:
+            persisted = self._lookup([key for key, _ in unresolved])
+            if persisted:
+                with self._cond:
+                    self.hits += len(persisted)
+                    for key, vector in persisted.items():
+                        vector = np.asarray(vector, dtype=np.float32)
+                        self._put(key, vector)
+                        found[key] = vector
+                unresolved = [(key, text) for key, text in unresolved if key not in found]
+
+        new: List[_Request] = []
+        with self._cond:
+            for key, text in unresolved:
+                future = self._inflight.get(key)
+                if future is None:
+                    future = Future()
+                    self._inflight[key] = future
+                    new.append((key, text, future))
+                waits[key] = future
+            self.misses += len(unresolved)
+        return found, waits, new
+
+    # --- 計算 ---
+
+    def _compute(self, batch: List[_Request]):
+        try:
+            with stage_timer("query_embedding_batch", documents=len(batch)):
+                vectors = self.embeddings.embed_documents([text for _, text, _ in batch])
+        except BaseException as e:
+            with self._cond:
+                for key, _, _ in batch:
+                    self._inflight.pop(key, None)
+            for _, _, future in batch:
+                future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        QUERY_EMBEDDING_BATCH.observe(len(batch))
+        arrays = [np.asarray(vector, dtype=np.float32) for vector in vectors]
+        with self._cond:
+            self.batches += 1
+            for (key, _, _), vector in zip(batch, arrays):
+                self._put(key, vector)
+                self._inflight.pop(key, None)
+        for (_, _, future), vector in zip(batch, arrays):
+            future.set_result(vector)
+
+    def _ensure_worker(self):
+        # 呼叫端須持有 self._cond；fork 後的子行程沒有父行程的執行緒，需重新啟動
+        if self._worker is None or self._worker_pid != os.getpid() or not self._worker.is_alive():
+            self._worker_pid = os.getpid()
+            self._worker = threading.Thread(target=self._run, name="query-embedding", daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                # 第一筆到達後再等一小段時間，讓同時到達的查詢併入同一批
+                deadline = time.monotonic() + self.max_wait
+                while len(self._queue) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), self.max_batch_size))]
+            self._compute(batch)
+
+    # --- 公開介面 ---
+
+    def embed(self, texts: List[str]) -> List[np.ndarray]:
+        """回傳各查詢的 float32 向量 (順序與 texts 相同)。"""
+        keys = [self._key(text) for text in texts]
+        found, waits, new = self._claim(keys, texts)
+        if new:
+            if self.max_wait > 0:
+                with self._cond:
+                    self._queue.extend(new)
+                    self._ensure_worker()
+                    self._cond.notify()
+            else:
+                for start in range(0, len(new), self.max_batch_size):
+                    self._compute(new[start:start + self.max_batch_size])
+        for key, future in waits.items():
+            found[key] = future.result()
+        return [found[key] for key in keys]
+
+    def prime(self, texts: List[str], batch_size: Optional[int] = None) -> int:
+        """
+        在呼叫端的執行緒中以批次預先計算一組查詢 (例如批次問答的所有問題)，不經過微批次的等待。
+        回傳實際計算的查詢數。
+        """
+        _, _, new = self._claim([self._key(text) for text in texts], texts)
+        batch_size = max(1, batch_size or self.max_batch_size)
+        for start in range(0, len(new), batch_size):
+            self._compute(new[start:start + batch_size])
+        return len(new)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "batches": self.batches,
+            "cached": len(self._cache),
+        }